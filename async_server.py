@@ -0,0 +1,618 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Async serving mode for the stops API in z5370300.py.
+
+Exposes the same routes and payloads as the Flask-RESTX app:
+
+   GET    /stops?after=...&before=...&limit=...&name=...&include=...
+   PUT    /stops?query=...&max_age=...
+   PATCH  /stops
+   GET    /stops/search?q=...&limit=...
+   GET    /stops/nearby?lat=...&lon=...&radius=...&k=...
+   GET    /stops/<id>?include=...
+   DELETE /stops/<id>
+   PATCH  /stops/<id>
+   GET    /operator-profiles/<id>?stream=true|false
+   GET    /guide?stream=true|false&pair=uniform|popular|nearby&radius=...
+   POST   /guide?source=...&destination=...&pair=...&radius=...
+   GET    /guide/jobs/<job_id>
+   GET    /guide/jobs/<job_id>/result
+   GET    /metrics
+   GET    /metrics/profile
+   PUT    /metrics/profile?enabled=true|false
+
+The server runs on aiohttp's event loop. Upstream transport.rest calls use a
+shared aiohttp.ClientSession, and Gemini calls use generate_content_async, so
+a request waiting on either no longer holds a thread. SQLite access reuses the
+pooled helpers of z5370300.py, run on the default thread executor so the event
+loop never blocks on the database.
+
+Usage:
+
+   python async_server.py [--host 127.0.0.1] [--port 5001]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from datetime import datetime
+
+from aiohttp import ClientSession, TCPConnector, web
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import HTTPException
+
+import tracing
+import upstream
+from upstream import UpstreamUnavailable
+import z5370300 as service
+
+routes = web.RouteTableDef()
+_departures_inflight = {}
+
+
+def message(text, status, **extra):
+   return web.json_response({"message": text, **extra}, status=status)
+
+
+def payload_invalid(errors):
+   # the 400 flask-restx answers for a body that fails @api.expect(..., validate=True)
+   return message("Input payload validation failed", 400, errors=errors)
+
+
+class QueryRequest:
+   # the parts of a Flask request that reqparse reads, for a query string without a body
+   def __init__(self, query):
+      self.values = MultiDict(list(query.items()))
+
+   def get_json(self, silent=False):
+      return None
+
+
+def query_args(parser, request):
+   # parser.parse_args() of the Flask route, over the query string of request. A missing or
+   # unparsable argument raises the 400 flask-restx answers, with the same body.
+   with service.app.app_context():
+      try:
+         return parser.parse_args(req=QueryRequest(request.query))
+      except HTTPException as e:
+         raise web.HTTPBadRequest(text=json.dumps(e.data), content_type="application/json")
+
+
+async def fetch_departures(client, stop_id):
+   # async twin of service.fetch_departures: same cache, single flight via shared tasks
+   departures = service.departures_cache.peek(stop_id)
+   if departures is not None:
+      return departures
+   task = _departures_inflight.get(stop_id)
+   if task is None:
+      task = asyncio.ensure_future(_load_departures(client, stop_id))
+      _departures_inflight[stop_id] = task
+      task.add_done_callback(lambda _: _departures_inflight.pop(stop_id, None))
+   return await asyncio.shield(task)
+
+
+async def _load_departures(client, stop_id):
+   cache = service.departures_cache
+   if cache.shared_store is not None:
+      # another worker process may have fetched it already, see service.share_across_workers
+      payload = await asyncio.to_thread(cache.load_shared, stop_id)
+      if payload is not None:
+         return payload
+   url = f'{service.TRANSPORT_REST_URL}/stops/{stop_id}/departures'
+   status, payload, size = await upstream.get_json_async(client, url, endpoint="departures")
+   if cache.shared_store is not None:
+      await asyncio.to_thread(cache.put, stop_id, payload, size)
+   else:
+      cache.put(stop_id, payload, size)
+   return payload
+
+
+async def operator_profile(operator):
+   # async twin of service.get_operator_profile
+   cached = await asyncio.to_thread(service.profile_cache_get, operator)
+   if cached is not None and time.time() - cached[1] < service.PROFILE_TTL:
+      return cached[0]
+   start = time.perf_counter()
+   try:
+      with tracing.span("gemini.profile"):
+         response = await asyncio.wait_for(
+            service.gemini.generate_content_async(service.profile_prompt(operator)),
+            service.PROFILE_CALL_TIMEOUT)
+      optinfo = response.text.replace('\n', '')
+   except Exception:
+      service.profile_usage.record_call("single", time.perf_counter() - start)
+      if cached is not None:
+         return cached[0]
+      raise
+   service.profile_usage.record_call("single", time.perf_counter() - start, response, 1)
+   await asyncio.to_thread(service.profile_cache_put, operator, optinfo)
+   return optinfo
+
+
+async def generate_operator_profiles_batched(operators):
+   # async twin of service.generate_operator_profiles_batched
+   start = time.perf_counter()
+   try:
+      with tracing.span("gemini.profile_batch"):
+         response = await asyncio.wait_for(
+            service.gemini.generate_content_async(service.batch_profile_prompt(operators)),
+            service.PROFILE_CALL_TIMEOUT)
+         profiles = service.parse_batch_profiles(response.text, operators)
+   except Exception:
+      service.profile_usage.record_call("batch", time.perf_counter() - start)
+      raise
+   service.profile_usage.record_call("batch", time.perf_counter() - start, response, len(profiles))
+   for operator, optinfo in profiles.items():
+      await asyncio.to_thread(service.profile_cache_put, operator, optinfo)
+   return profiles
+
+
+async def _profiles_batched(operators):
+   # async twin of service._profiles_batched
+   found = {}
+   stale = []
+   for operator in operators:
+      cached = await asyncio.to_thread(service.profile_cache_get, operator)
+      if cached is not None and time.time() - cached[1] < service.PROFILE_TTL:
+         found[operator] = cached[0]
+      else:
+         stale.append(operator)
+   batches = [stale[i:i + service.PROFILE_BATCH_MAX] for i in range(0, len(stale), service.PROFILE_BATCH_MAX)]
+   results = await asyncio.gather(*(generate_operator_profiles_batched(batch) for batch in batches),
+                                  return_exceptions=True)
+   for batch, generated in zip(batches, results):
+      if isinstance(generated, BaseException):
+         tracing.error("gemini.profile_batch", f"{len(batch)} operators: {generated!r}")
+      else:
+         found.update(generated)
+   return found, len(stale)
+
+
+async def get_operator_profiles(operators):
+   # async twin of service.get_operator_profiles
+   start = time.monotonic()
+   found = {}
+   generated = None
+   if service.PROFILE_MODE == "batched":
+      found, generated = await _profiles_batched(operators)
+   rest = [operator for operator in operators if operator not in found]
+   if rest:
+      # the remaining model calls run concurrently; the total wait is capped by PROFILE_DEADLINE
+      tasks = [asyncio.ensure_future(operator_profile(operator)) for operator in rest]
+      done, pending = await asyncio.wait(tasks, timeout=max(0, start + service.PROFILE_DEADLINE - time.monotonic()))
+      for task in pending:
+         task.cancel()
+      for operator, task in zip(rest, tasks):
+         if task in done and task.exception() is None:
+            found[operator] = task.result()
+   service.profile_usage.record_request(service.PROFILE_MODE, time.monotonic() - start,
+                                        len(rest) if generated is None else generated)
+   profiles = [{"operator_name": operator, "information": found[operator]} for operator in operators if operator in found]
+   missing = [operator for operator in operators if operator not in found]
+   return profiles, missing
+
+
+async def stream_model(prompt, span, **kwargs):
+   # async twin of service.stream_model
+   start = time.perf_counter()
+   first = True
+   try:
+      response = await service.gemini.generate_content_async(prompt, stream=True, **kwargs)
+      async for chunk in response:
+         if first:
+            tracing.record_span(f"{span}.first_chunk", time.perf_counter() - start)
+            first = False
+         text = chunk.text.replace('\n', '')
+         if text:
+            yield text
+   finally:
+      tracing.record_span(span, time.perf_counter() - start)
+
+
+async def sse_response(request, events):
+   response = web.StreamResponse(headers={"Content-Type": "text/event-stream", **service.SSE_HEADERS})
+   await response.prepare(request)
+   async for event, data in events:
+      await response.write(service.sse(event, data).encode())
+   await response.write_eof()
+   return response
+
+
+async def _stream_operator_profile(operator, cached, events):
+   # async twin of service._stream_operator_profile
+   parts = []
+   try:
+      async for text in stream_model(service.profile_prompt(operator), "gemini.profile_stream"):
+         parts.append(text)
+         await events.put(("chunk", {"operator_name": operator, "text": text}))
+   except Exception as e:
+      if cached is not None:
+         await events.put(("profile", {"operator_name": operator, "information": cached[0]}))
+      else:
+         await events.put(("error", {"operator_name": operator, "message": str(e)}))
+      return
+   information = ''.join(parts)
+   await asyncio.to_thread(service.profile_cache_put, operator, information)
+   await events.put(("profile", {"operator_name": operator, "information": information}))
+
+
+async def stream_operator_profiles(stop_id, operators):
+   # async twin of service.stream_operator_profiles
+   events = asyncio.Queue()
+   pending = set()
+   tasks = []
+   for operator in operators:
+      cached = await asyncio.to_thread(service.profile_cache_get, operator)
+      if cached is not None and time.time() - cached[1] < service.PROFILE_TTL:
+         yield "profile", {"operator_name": operator, "information": cached[0]}
+      else:
+         pending.add(operator)
+         tasks.append(asyncio.ensure_future(_stream_operator_profile(operator, cached, events)))
+   deadline = time.monotonic() + service.PROFILE_DEADLINE
+   missing = []
+   try:
+      while pending:
+         try:
+            event, data = await asyncio.wait_for(events.get(), max(0, deadline - time.monotonic()))
+         except asyncio.TimeoutError:
+            break
+         if event != "chunk":
+            pending.discard(data["operator_name"])
+         if event == "error":
+            missing.append(data["operator_name"])
+         yield event, data
+   finally:
+      for task in tasks:
+         task.cancel()
+   missing += [operator for operator in operators if operator in pending]
+   yield "done", {"stop_id": stop_id, "missing_operators": missing}
+
+
+async def stream_guide(source_name, destination_name):
+   # async twin of service.stream_guide
+   cached = await asyncio.to_thread(service.guide_cache_get, source_name, destination_name)
+   if cached is not None and time.time() - cached[1] < service.GUIDE_TTL:
+      yield "chunk", {"text": cached[0]}
+   else:
+      parts = []
+      try:
+         async for text in stream_model(service.guide_prompt(source_name, destination_name), "gemini.guide_stream"):
+            parts.append(text)
+            yield "chunk", {"text": text}
+      except Exception as e:
+         tracing.error("gemini.guide_stream", e)
+         yield "error", {"message": "Service Unavailable"}
+         return
+      await asyncio.to_thread(service.guide_cache_put, source_name, destination_name, ''.join(parts))
+   yield "done", {"source": source_name, "destination": destination_name}
+
+
+@routes.put('/stops')
+async def put_stops(request):
+   args = query_args(service.parser_query, request)
+   query = args["query"]
+   if args["max_age"] is not None:
+      if not service.max_age_valid(args["max_age"]):
+         return message("Invalid field in request", 400)
+      local = await asyncio.to_thread(service.local_locations, query, args["max_age"], request.host)
+      if local is not None:
+         return web.json_response(local)
+   url = f'{service.TRANSPORT_REST_URL}/locations'
+   try:
+      code, locations, _ = await upstream.get_json_async(
+         request.app["client"], url, endpoint="locations", params={"query": query or "", "results": "5"})
+   except UpstreamUnavailable:
+      return message("Service Unavailable.", 503)
+   if code == 400:
+      return message("Invalid field in request", 400)
+   elif code == 404 or not locations:
+      return message("Not found.", 404)
+   elif code == 503:
+      return message("Service Unavailable.", 503)
+
+   put_list = []
+   rows = []
+   last_updated = datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
+   for item in locations:
+      stop_id = int(item["id"])
+      put_list.append({
+         "stop_id": stop_id,
+         "last_updated": last_updated,
+         "_links": {"self": {"href": f"http://{request.host}/stops/{stop_id}"}}
+      })
+      rows.append((stop_id, last_updated, item["name"], item["location"]["latitude"], item["location"]["longitude"]))
+   await asyncio.to_thread(service.db_upsert_many, rows)
+
+   put_list = sorted(put_list, key=lambda x: x['stop_id'])
+   return web.json_response({"message": put_list}, status=200)
+
+
+@routes.get('/stops')
+async def list_stops(request):
+   args = query_args(service.parser_list, request)
+   if not 1 <= args["limit"] <= service.STOPS_PAGE_MAX or (args["after"] is not None and args["before"] is not None):
+      return message("Invalid field in request", 400)
+   fields = args["include"].split(',') if args["include"] else None
+   page = await asyncio.to_thread(service.stops_page, args["after"], args["before"], args["limit"], args["name"],
+                                  fields, request.host)
+   return web.json_response(page)
+
+
+@routes.patch('/stops')
+async def patch_stops(request):
+   try:
+      items = await request.json()
+   except ValueError:
+      return message("Invalid field in request", 400)
+   if isinstance(items, list):
+      errors = {}
+      for item in items:
+         if isinstance(item, dict):
+            errors = {**service.payload_errors(item, bulk=True), **errors}
+      if errors:
+         return payload_invalid(errors)
+   body, status = await asyncio.to_thread(service.bulk_patch, items, request.host)
+   return web.json_response(body, status=status)
+
+
+@routes.get('/stops/search')
+async def search(request):
+   args = query_args(service.parser_search, request)
+   if not 1 <= args["limit"] <= service.SEARCH_MAX_LIMIT:
+      return message("Invalid field in request", 400)
+   return web.json_response(await asyncio.to_thread(service.search_document, args["q"], args["limit"], request.host))
+
+
+@routes.get('/stops/nearby')
+async def nearby(request):
+   args = query_args(service.parser_nearby, request)
+   if not service.nearby_args_valid(args["lat"], args["lon"], args["radius"], args["k"]):
+      return message("Invalid field in request", 400)
+   return web.json_response(await asyncio.to_thread(service.nearby_document, args["lat"], args["lon"], args["radius"],
+                                                    args["k"], request.host))
+
+
+@routes.get(r'/stops/{stop_id:\d+}')
+async def get_stop(request):
+   stop_id = int(request.match_info["stop_id"])
+   fields = request.query.get("include")
+   if fields:
+      fields = fields.split(',')
+   found = await asyncio.to_thread(service.cached_stop, stop_id, fields, request.host)
+   if found is None:
+      return message("Not found.", 404)
+   details, prev_stop_id, next_stop_id, data, modified_at = found
+   next_departure = staleness = None
+   if not fields or 'next_departure' in fields:
+      prefetched = service.prefetched_next_departure(stop_id)
+      if prefetched is not None:
+         next_departure, staleness = prefetched
+      else:
+         try:
+            departures = await fetch_departures(request.app["client"], stop_id)
+         except UpstreamUnavailable:
+            return message("Service Unavailable.", 503)
+         next_departure = service.next_departure_from(service.departures_list(departures))
+      if not next_departure:
+         return message("next_departure Not found.", 404)
+      modified = None
+   else:
+      modified = service.last_modified(modified_at)
+   headers = {"ETag": service.stop_etag(details, prev_stop_id, next_stop_id, fields, request.host, next_departure)}
+   if modified:
+      headers["Last-Modified"] = modified
+   if service.not_modified(headers["ETag"], modified, request.headers.get("If-None-Match"),
+                           request.headers.get("If-Modified-Since")):
+      return web.Response(status=304, headers=headers)
+
+   if next_departure:
+      data['next_departure'] = next_departure
+      if staleness is not None:
+         data['_staleness'] = staleness
+   return web.json_response(data, headers=headers)
+
+
+@routes.delete(r'/stops/{stop_id:\d+}')
+async def delete_stop(request):
+   stop_id = int(request.match_info["stop_id"])
+   data = await asyncio.to_thread(service.db_read, stop_id)
+   if len(data) == 0:
+      return message("The stop_id {} was not found in the database.".format(stop_id), 404, stop_id=stop_id)
+   await asyncio.to_thread(service.db_delete, stop_id)
+   return message("The stop_id {} was removed from the database.".format(stop_id), 200, stop_id=stop_id)
+
+
+@routes.patch(r'/stops/{stop_id:\d+}')
+async def patch_stop(request):
+   stop_id = int(request.match_info["stop_id"])
+   try:
+      updates = await request.json()
+   except ValueError:
+      return message("Invalid field in request", 400)
+   if not isinstance(updates, dict) or len(updates) == 0:
+      return message("Invalid field in request", 400)
+   errors = service.payload_errors(updates)
+   if errors:
+      return payload_invalid(errors)
+   details = await asyncio.to_thread(service.db_read, stop_id)
+   if len(details) == 0:
+      return message("Not found.", 404)
+   if 'stop_id' in updates or '_links' in updates:
+      return message("Invalid field in request", 400)
+   precondition = request.headers.get("If-Match")
+   if not service.if_match(precondition, details[0]):
+      return message("Precondition Failed", 412)
+   valid, text = service.merge_updates(details[0], updates)
+   if not valid:
+      return message(text, 400)
+   row = (updates['last_updated'], updates['name'], updates['latitude'], updates['longitude'])
+   if precondition:
+      if not await asyncio.to_thread(service.db_update_if_unchanged, details[0], *row):
+         return message("Precondition Failed", 412)
+   else:
+      await asyncio.to_thread(service.db_update, stop_id, *row)
+   etag = await asyncio.to_thread(service.patched_etag, stop_id, row, request.host)
+   return web.json_response({
+      "stop_id": stop_id,
+      "last_updated": updates['last_updated'],
+      "_links": {"self": {"href": f"http://{request.host}/stops/{stop_id}"}}
+   }, headers={"ETag": etag})
+
+
+@routes.get(r'/operator-profiles/{stop_id:\d+}')
+async def operator_profiles(request):
+   stop_id = int(request.match_info["stop_id"])
+   details = await asyncio.to_thread(service.db_read, stop_id)
+   if len(details) == 0:
+      return message("Not found.", 404)
+   prefetched = service.prefetched_operators(stop_id)
+   if prefetched is not None:
+      name = prefetched[0]
+   else:
+      try:
+         departures = await fetch_departures(request.app["client"], stop_id)
+      except UpstreamUnavailable:
+         return message("Service Unavailable.", 503)
+      name = service.operators_from(service.departures_list(departures))
+   if len(name) == 0:
+      return message("Not found.", 404)
+   if query_args(service.parser_stream, request)["stream"]:
+      return await sse_response(request, stream_operator_profiles(stop_id, name))
+
+   profiles, missing = await get_operator_profiles(name)
+   if len(profiles) == 0:
+      return message("Service Unavailable.", 503)
+   result = {"stop_id": stop_id, "profiles": profiles}
+   if missing:
+      result["missing_operators"] = missing
+   return web.json_response(result)
+
+
+def guide_result(job_id):
+   return web.FileResponse(service.guide_job_path(job_id), headers={
+      "Content-Type": "text/plain",
+      "Content-Disposition": f"attachment; filename={service.txt_file}"
+   })
+
+
+@routes.get('/guide')
+async def guide(request):
+   # jobs run on service.guide_executor; this route waits for its job without holding a thread
+   args = query_args(service.parser_guide_get, request)
+   mode, radius = args["pair"], args["radius"]
+   if not service.pair_args_valid(mode, radius):
+      return message("Bad Request", 400)
+   if args["stream"]:
+      pair = await asyncio.to_thread(service.random_guide_pair, mode, radius)
+      if pair is None:
+         return message("Bad Request", 400)
+      return await sse_response(request, stream_guide(*pair))
+   job, future = await asyncio.to_thread(service.submit_guide_job, None, None, mode, radius)
+   if job is None:
+      return message("Bad Request", 400)
+   if future is not None:
+      try:
+         # shielded: a timeout or a closed connection must not cancel the job itself
+         await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), service.GUIDE_WAIT)
+      except Exception:
+         return message("Service Unavailable", 503)
+   return guide_result(job["job_id"])
+
+
+@routes.post('/guide')
+async def create_guide_job(request):
+   args = query_args(service.parser_guide, request)
+   if (args["source"] is None) != (args["destination"] is None):
+      return message("Bad Request", 400)
+   if not service.pair_args_valid(args["pair"], args["radius"]):
+      return message("Bad Request", 400)
+   job, _ = await asyncio.to_thread(service.submit_guide_job, args["source"], args["destination"], args["pair"],
+                                    args["radius"])
+   if job is None:
+      return message("Bad Request", 400)
+   data = service.guide_job_document(job, request.host)
+   return web.json_response(data, status=200 if job["status"] == 'done' else 202,
+                            headers={"Location": data["_links"]["self"]["href"]})
+
+
+@routes.get('/guide/jobs/{job_id}')
+async def guide_job(request):
+   job = await asyncio.to_thread(service.guide_job_get, request.match_info["job_id"])
+   if job is None:
+      return message("Not found.", 404)
+   return web.json_response(service.guide_job_document(job, request.host))
+
+
+@routes.get('/guide/jobs/{job_id}/result')
+async def guide_job_result(request):
+   job = await asyncio.to_thread(service.guide_job_get, request.match_info["job_id"])
+   if job is None:
+      return message("Not found.", 404)
+   if job["status"] == 'failed':
+      return message("Service Unavailable", 503)
+   if job["status"] != 'done':
+      return web.json_response(service.guide_job_document(job, request.host), status=202)
+   return guide_result(job["job_id"])
+
+
+@routes.get('/metrics')
+async def metrics(request):
+   return web.json_response(service.service_metrics())
+
+
+@routes.get('/metrics/profile')
+async def profile(request):
+   return web.Response(text=tracing.profiler.folded(), headers={
+      "X-Profiler-Running": str(tracing.profiler.running).lower(),
+      "X-Profiler-Samples": str(tracing.profiler.samples),
+   })
+
+
+@routes.put('/metrics/profile')
+async def toggle_profiler(request):
+   if query_args(service.parser_profiler, request)["enabled"]:
+      if not tracing.profiler.running:
+         tracing.profiler.clear()
+      tracing.profiler.start()
+   else:
+      tracing.profiler.stop()
+   return web.json_response({"running": tracing.profiler.running, "samples": tracing.profiler.samples})
+
+
+@web.middleware
+async def trace_requests(request, handler):
+   token = tracing.start_trace()
+   response = None
+   try:
+      response = await handler(request)
+      return response
+   finally:
+      resource = request.match_info.route.resource
+      route = resource.canonical if resource is not None else "unmatched"
+      timing = tracing.finish_trace(token, f"{request.method} {route}")
+      if timing and response is not None and not response.prepared:
+         response.headers["Server-Timing"] = timing
+
+
+async def _client_session(app):
+   app["client"] = ClientSession(connector=TCPConnector(limit=upstream.POOL_SIZE * 5))
+   yield
+   await app["client"].close()
+
+
+def make_app():
+   app = web.Application(middlewares=[trace_requests])
+   app.add_routes(routes)
+   app.cleanup_ctx.append(_client_session)
+   return app
+
+
+if __name__ == "__main__":
+   cli = argparse.ArgumentParser(description="Serve the stops API on an asyncio event loop.")
+   cli.add_argument("--host", default="127.0.0.1")
+   cli.add_argument("--port", type=int, default=5001)
+   args = cli.parse_args()
+   web.run_app(make_app(), host=args.host, port=args.port)
@@ -0,0 +1,1494 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmarks for the stops API in z5370300.py.
+
+Every scenario runs against a throw-away working directory, so the real
+database file is never touched, and talks to the Flask app through its test
+client rather than over the network.
+
+Usage:
+
+   python benchmark.py stops-get [--rows N] [--requests N] [--threads N]
+   python benchmark.py upsert [--rows N] [--batch N]
+   python benchmark.py departures [--stops N] [--requests N] [--latency S]
+   python benchmark.py profiles [--requests N] [--model-latency S] [--token-latency S] [--drop F]
+   python benchmark.py upstream [--requests N]
+   python benchmark.py async-vs-sync [--requests N] [--concurrency N] [--latency S]
+   python benchmark.py stops-list [--rows N] [--limit N]
+   python benchmark.py nearby [--sizes N,N] [--radius M] [--k N]
+   python benchmark.py departures-parse [--departures N] [--repeat N]
+   python benchmark.py stops-cli [--rows N] [--chunk-size N]
+   python benchmark.py validate [--rows N] [--invalid F]
+   python benchmark.py stop-cache [--rows N] [--requests N] [--threads N]
+   python benchmark.py tracing [--rows N] [--requests N] [--rounds N]
+   python benchmark.py streaming [--model-latency S] [--requests N]
+   python benchmark.py sampler [--rows N] [--samples N] [--requests N] [--batch N]
+   python benchmark.py import-time [--runs N] [--top N] [--budget-ms MS]
+   python benchmark.py search [--rows N] [--requests N] [--latency S]
+   python benchmark.py load [--sizes N,N] [--concurrency N,N] [--requests N] [--server sync|async|both]
+                            [--fixtures PATH] [--out PATH] [--compare PATH]
+   python benchmark.py load-compare BASELINE CURRENT [--threshold F]
+   python benchmark.py record-fixtures --out PATH [--query TEXT ...] [--stops N]
+   python benchmark.py workers [--workers N,N] [--server sync|async] [--requests N] [--min-scaling F]
+
+Scenarios that need transport.rest start a local stub server (StubUpstream)
+and point the service at it through TRANSPORT_REST_URL. Gemini is replaced
+by FakeModel, which answers after an injected delay.
+
+The load scenario is the end-to-end benchmark. For each stops table size it
+starts the real server in a subprocess and drives GET and PUT /stops,
+GET /stops/<id>, /operator-profiles/<id> and /guide over HTTP at each
+concurrency level. The request sequences come from --seed, so every run and
+server kind replays the same requests. Each cell of the report (server,
+rows, endpoint, concurrency) has req/s, latency percentiles in ms, status
+counts, upstream calls and the server's current and peak RSS. The JSON
+written by --out also records the commit, host and settings of the run;
+load-compare, or --compare on the next run, flags cells whose throughput
+or p99 got worse by more than --threshold. Caches stay warm from one cell
+to the next within a server, as they would in production.
+
+The stub answers with synthetic payloads unless --fixtures names a file
+written by record-fixtures, which saves live /locations and /departures
+answers. Replayed departures are moved to the current time.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import types
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVICE_MODULE = "z5370300"
+
+
+OPERATORS = ["DB Regio AG", "DB Fernverkehr AG", "S-Bahn Berlin GmbH", "BVG", "ODEG", "Flixtrain", "Arriva"]
+
+
+def departures_payload(stop_id, count, bulky=False, platformless=0):
+   # Synthetic departures in the v6.db.transport.rest shape. bulky=True adds the stop,
+   # remarks and line details a large hub returns (~2 KB per departure); the first
+   # platformless entries have no platform, like the buses listed at a hub.
+   now = datetime.now(timezone.utc)
+   departures = []
+   for i in range(count):
+      when = (now + timedelta(minutes=2 + i // 4)).astimezone(timezone(timedelta(hours=1)))
+      departure = {
+         "tripId": f"1|{stop_id}|{i}",
+         "when": when.strftime("%Y-%m-%dT%H:%M:%S%z")[:-2] + ":00",
+         "platform": None if i < platformless else str(1 + i % 12),
+         "direction": f"Destination {i}",
+         "line": {"name": f"RE {i % 9}", "operator": {"name": OPERATORS[i % len(OPERATORS)]}},
+      }
+      if bulky:
+         departure["stop"] = {"type": "stop", "id": str(stop_id), "name": "Berlin Hbf",
+                              "location": {"type": "location", "latitude": 52.525, "longitude": 13.369},
+                              "products": {p: True for p in ("nationalExpress", "national", "regional", "suburban",
+                                                              "bus", "subway", "tram", "taxi")}}
+         departure["line"].update({"id": f"re-{i % 9}", "fahrtNr": str(10000 + i), "mode": "train",
+                                   "product": "regional", "productName": "RE"})
+         departure["remarks"] = [{"type": "hint", "code": f"FK{j}", "text": "Bicycles conveyed - subject to "
+                                  "reservation, number of bicycles conveyed limited"} for j in range(6)]
+         departure["plannedWhen"] = departure["when"]
+         departure["plannedPlatform"] = departure["platform"]
+      departures.append(departure)
+   return {"departures": departures, "realtimeDataUpdatedAt": int(now.timestamp())}
+
+
+def shift_times(value, seconds):
+   # copy of a transport.rest payload with every when/plannedWhen moved by seconds
+   if isinstance(value, list):
+      return [shift_times(item, seconds) for item in value]
+   if not isinstance(value, dict):
+      return value
+   shifted = {}
+   for key, item in value.items():
+      if key in ("when", "plannedWhen") and isinstance(item, str):
+         item = (datetime.fromisoformat(item) + timedelta(seconds=seconds)).isoformat()
+      elif key == "realtimeDataUpdatedAt" and isinstance(item, int):
+         item += int(seconds)
+      else:
+         item = shift_times(item, seconds)
+      shifted[key] = item
+   return shifted
+
+
+class Fixtures:
+   """Recorded transport.rest answers, written by `benchmark.py record-fixtures`.
+
+   /locations answers are replayed by query. A stop without a recording of
+   its own gets the recorded departures of stop number stop_id % n, so any
+   synthetic stops table can be served from a handful of recordings.
+   Departure times are moved forward by the time since the recording and
+   re-encoded every REFRESH seconds, so the service always sees upcoming
+   departures.
+   """
+
+   REFRESH = 60
+
+   def __init__(self, data):
+      self.recorded_at = datetime.fromisoformat(data["recorded_at"])
+      self.locations = {query: json.dumps(body).encode() for query, body in data["locations"].items()}
+      self._departures = sorted(data["departures"].items())
+      self._encoded = {}
+      self._shifted_at = None
+      self._lock = threading.Lock()
+
+   @classmethod
+   def load(cls, path):
+      with open(path, encoding="utf-8") as f:
+         return cls(json.load(f))
+
+   @property
+   def queries(self):
+      return sorted(self.locations)
+
+   def departures(self, stop_id):
+      with self._lock:
+         if self._shifted_at is None or time.monotonic() - self._shifted_at > self.REFRESH:
+            offset = (datetime.now(timezone.utc) - self.recorded_at).total_seconds()
+            self._encoded = {key: json.dumps(shift_times(body, offset)).encode() for key, body in self._departures}
+            self._shifted_at = time.monotonic()
+         encoded = self._encoded
+      if stop_id in encoded:
+         return encoded[stop_id]
+      return encoded[self._departures[int(stop_id) % len(self._departures)][0]]
+
+
+class StubUpstream:
+   """Local stand-in for v6.db.transport.rest with optional injected latency.
+
+   Answers are synthetic unless fixtures (a Fixtures) are given; /locations
+   queries without a recording still get a synthetic answer.
+   """
+
+   def __init__(self, latency=0.0, departures=60, fixtures=None):
+      self.latency = latency
+      self.departures = departures
+      self.fixtures = fixtures
+      self.fail_status = None     # answer every request with this status when set
+      self.calls = Counter()
+      self._server = None
+
+   def start(self):
+      stub = self
+
+      class Handler(BaseHTTPRequestHandler):
+         protocol_version = "HTTP/1.1"
+         disable_nagle_algorithm = True
+
+         def do_GET(self):
+            url = urlparse(self.path)
+            time.sleep(stub.latency)
+            if stub.fail_status:
+               stub.calls["failed"] += 1
+               self.send_response(stub.fail_status)
+               self.send_header("Content-Length", "0")
+               self.end_headers()
+               return
+            match = re.fullmatch(r"/stops/(\d+)/departures", url.path)
+            if match:
+               stub.calls["departures"] += 1
+               if stub.fixtures:
+                  data = stub.fixtures.departures(match.group(1))
+               else:
+                  data = json.dumps(departures_payload(match.group(1), stub.departures)).encode()
+            elif url.path == "/locations":
+               stub.calls["locations"] += 1
+               query = parse_qs(url.query).get("query", [""])[0]
+               data = stub.fixtures and stub.fixtures.locations.get(query)
+               if not data:
+                  data = json.dumps([{"id": str(8000000 + i), "name": f"{query} {i}",
+                                      "location": {"latitude": 52.5 + i / 100, "longitude": 13.4}}
+                                     for i in range(5)]).encode()
+            else:
+               self.send_error(404)
+               return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+         def log_message(self, *args):
+            pass
+
+      class Server(ThreadingHTTPServer):
+         request_queue_size = 256
+
+      self._server = Server(("127.0.0.1", 0), Handler)
+      self._server.daemon_threads = True
+      threading.Thread(target=self._server.serve_forever, daemon=True).start()
+      return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+   def stop(self):
+      self._server.shutdown()
+
+
+class FakeModel:
+   """Stand-in for the Gemini model with a fixed response latency.
+
+   With stream=True the answer arrives in `chunks` pieces spread evenly over
+   the same latency, like a streamed model response. token_latency adds time
+   per output token (about 4 characters), as a real model generates longer
+   answers more slowly. A batched profile prompt is answered with a JSON
+   object that leaves out about a `drop` share of the names.
+   """
+
+   def __init__(self, latency=0.5, chunks=10, token_latency=0.0, drop=0.0):
+      self.latency = latency
+      self.chunks = chunks
+      self.token_latency = token_latency
+      self.drop = drop
+      self.calls = 0
+      self._rng = random.Random(0)
+      self._lock = threading.Lock()
+
+   def _answer(self, prompt):
+      with self._lock:
+         self.calls += 1
+         draws = [self._rng.random() for _ in range(100)]
+      names = re.search(r"^(\[.*\])$", prompt, re.M)
+      if names:
+         text = json.dumps({name: f"Generated text about {name}. It runs trains and buses in the region."
+                            for name, draw in zip(json.loads(names.group(1)), draws) if draw >= self.drop})
+      else:
+         text = f"Generated text for prompt: {prompt[:60]}\nSecond line."
+      step = -(-len(text) // self.chunks)
+      return [text[i:i + step] for i in range(0, len(text), step)]
+
+   def generate_content(self, prompt, request_options=None, stream=False, **kwargs):
+      parts = self._answer(prompt)
+      if stream:
+         return self._stream(parts)
+      text = "".join(parts)
+      time.sleep(self.latency + self.token_latency * len(text) / 4)
+      return FakeResponse(text, prompt)
+
+   def _stream(self, parts):
+      for part in parts:
+         time.sleep(self.latency / len(parts))
+         yield FakeResponse(part)
+
+   async def generate_content_async(self, prompt, request_options=None, stream=False, **kwargs):
+      parts = self._answer(prompt)
+      if stream:
+         return self._stream_async(parts)
+      text = "".join(parts)
+      await asyncio.sleep(self.latency + self.token_latency * len(text) / 4)
+      return FakeResponse(text, prompt)
+
+   async def _stream_async(self, parts):
+      for part in parts:
+         await asyncio.sleep(self.latency / len(parts))
+         yield FakeResponse(part)
+
+
+class FakeResponse:
+   def __init__(self, text, prompt=None):
+      self.text = text
+      # token counts like the usage metadata of a real response, at about 4 characters a token
+      self.usage_metadata = None if prompt is None else types.SimpleNamespace(
+         prompt_token_count=len(prompt) // 4, candidates_token_count=len(text) // 4)
+
+
+def load_service(workdir, **env):
+   # The service reads its configuration and creates its database relative to
+   # the current directory at import time.
+   os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+   os.environ.update(env)
+   os.chdir(workdir)
+   if HERE not in sys.path:
+      sys.path.insert(0, HERE)
+   return importlib.import_module(SERVICE_MODULE)
+
+
+def seed_stops(service, rows, first=0):
+   # stop ids 8000000 + i, scattered uniformly over roughly the area of Germany
+   now = time.strftime('%Y-%m-%d-%H:%M:%S')
+   rng = random.Random(first)
+   with service.db_pool.connection() as cnx, cnx:
+      cnx.executemany(
+         'INSERT OR REPLACE INTO stops (stop_id, last_updated, name, latitude, longitude) VALUES (?, ?, ?, ?, ?)',
+         ((8000000 + i, now, f"Stop {i}", rng.uniform(47.3, 55.0), rng.uniform(5.9, 15.0))
+          for i in range(first, first + rows)))
+   return [8000000 + i for i in range(first, first + rows)]
+
+
+def run_requests(app, paths, threads):
+   def worker(chunk):
+      client = app.test_client()
+      for path in chunk:
+         response = client.get(path)
+         assert response.status_code == 200, (path, response.status_code)
+
+   chunks = [paths[i::threads] for i in range(threads)]
+   start = time.perf_counter()
+   # the handlers print() debug output; keep it out of the report
+   with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(max_workers=threads) as pool:
+      list(pool.map(worker, chunks))
+   return time.perf_counter() - start
+
+
+def bench_stops_get(args):
+   service = load_service(tempfile.mkdtemp())
+   stop_ids = seed_stops(service, args.rows)
+   rng = random.Random(0)
+   # next_departure is left out so the numbers only measure the local read path.
+   paths = [f"/stops/{rng.choice(stop_ids)}?include=name,last_updated,latitude,longitude"
+            for _ in range(args.requests)]
+
+   for label, size in (("connect per call", 0), (f"pool of {args.pool_size}", args.pool_size)):
+      service.db_pool.close()
+      service.db_pool = service.ConnectionPool(size)
+      elapsed = run_requests(service.app, paths, args.threads)
+      print(f"GET /stops/<id> {label:>18}: {len(paths) / elapsed:9.1f} req/s")
+
+
+def bench_upsert(args):
+   service = load_service(tempfile.mkdtemp())
+   now = time.strftime('%Y-%m-%d-%H:%M:%S')
+   rows = [(9000000 + i, now, f"Stop {i}", 52.5, 13.4) for i in range(args.rows)]
+
+   # The old PUT path: one read plus one committed insert/update per stop.
+   start = time.perf_counter()
+   for row in rows:
+      if len(service.db_read(row[0])) == 0:
+         service.db_insert(*row)
+      else:
+         service.db_update(*row)
+   elapsed = time.perf_counter() - start
+   print(f"per-row insert/update: {len(rows) / elapsed:10.1f} rows/s, {len(rows) / elapsed:9.1f} commits/s")
+
+   # Second pass hits the ON CONFLICT branch for every row, like re-running a PUT.
+   for label in ("bulk upsert (insert)", "bulk upsert (update)"):
+      if label.endswith("(insert)"):
+         with service.db_pool.connection() as cnx, cnx:
+            cnx.execute('DELETE FROM stops')
+      start = time.perf_counter()
+      service.import_stops(rows, chunk_size=args.batch)
+      elapsed = time.perf_counter() - start
+      commits = -(-len(rows) // args.batch)
+      print(f"{label:>21}: {len(rows) / elapsed:10.1f} rows/s, {commits / elapsed:9.1f} commits/s "
+            f"({args.batch} rows per commit)")
+
+
+def bench_departures(args):
+   stub = StubUpstream(latency=args.latency)
+   service = load_service(tempfile.mkdtemp(), TRANSPORT_REST_URL=stub.start())
+   stop_ids = seed_stops(service, args.stops)
+   rng = random.Random(0)
+   paths = [f"/stops/{rng.choice(stop_ids)}?include=next_departure" for _ in range(args.requests)]
+
+   for label, ttl in (("no cache", 0), (f"ttl {args.ttl:g}s", args.ttl)):
+      service.departures_cache = service.DeparturesCache(ttl, service.DEPARTURES_CACHE_BYTES)
+      stub.calls.clear()
+      elapsed = run_requests(service.app, paths, args.threads)
+      # /operator-profiles reads the same payload right after GET /stops/<id>
+      for stop_id in stop_ids:
+         service.get_departing_info(stop_id)
+      stats = service.departures_cache.stats()
+      print(f"{label:>9}: {len(paths) / elapsed:8.1f} req/s, {stub.calls['departures']:5d} upstream calls, "
+            f"hits={stats['hits']} misses={stats['misses']} shared={stats['shared']}")
+   stub.stop()
+
+
+def bench_profiles(args):
+   stub = StubUpstream()
+   service = load_service(tempfile.mkdtemp(), TRANSPORT_REST_URL=stub.start(), PROFILE_TTL="0")
+   model = service.gemini = FakeModel(args.model_latency, token_latency=args.token_latency, drop=args.drop)
+   stop_ids = seed_stops(service, 10)
+   paths = [f"/operator-profiles/{stop_ids[i % len(stop_ids)]}" for i in range(args.requests)]
+
+   print(f"{args.model_latency * 1000:.0f} ms per model call "
+         f"+ {args.token_latency * 1000:g} ms per output token, batched replies drop {args.drop:.0%} of the names")
+   for mode, workers in (("per-operator", 1), ("per-operator", service.PROFILE_WORKERS),
+                         ("batched", service.PROFILE_WORKERS)):
+      service.PROFILE_MODE = mode
+      service.profile_executor = ThreadPoolExecutor(max_workers=workers)
+      service.profile_usage = service.ProfileUsage()
+      model.calls = 0
+      elapsed = run_requests(service.app, paths, 1)
+      calls = service.profile_usage.stats()["calls"]
+      tokens = sum(entry["prompt_tokens"] + entry["output_tokens"] for entry in calls.values())
+      label = f"{mode}, {workers} worker{'s' if workers != 1 else ''}"
+      print(f"GET /operator-profiles/<id> {label:>23}: {elapsed / len(paths) * 1000:8.1f} ms per request, "
+            f"{model.calls / len(paths):4.1f} model calls ({calls.get('single', {}).get('calls', 0) / len(paths):.1f} "
+            f"single), {tokens / len(paths):6.0f} tokens per request")
+   stub.stop()
+
+
+def bench_upstream(args):
+   import requests
+   stub = StubUpstream()
+   service = load_service(tempfile.mkdtemp(), TRANSPORT_REST_URL=stub.start(),
+                          UPSTREAM_BACKOFF="0.01", UPSTREAM_BREAKER_COOLDOWN="60")
+   upstream = service.upstream
+   url = f"{service.TRANSPORT_REST_URL}/stops/8000000/departures"
+
+   for label, get in (("new connection per call", requests.get),
+                      ("shared keep-alive session", lambda u: upstream.get(u, endpoint="departures"))):
+      start = time.perf_counter()
+      for _ in range(args.requests):
+         get(url)
+      elapsed = time.perf_counter() - start
+      print(f"{label:>26}: {elapsed / args.requests * 1000:7.2f} ms per call")
+
+   # Failing upstream: retries until the breaker opens, then callers fail fast.
+   stub.fail_status = 503
+   timings = []
+   for _ in range(upstream.BREAKER_FAILURES + 3):
+      start = time.perf_counter()
+      try:
+         upstream.get(url, endpoint="departures")
+      except upstream.UpstreamUnavailable:
+         pass
+      timings.append((time.perf_counter() - start) * 1000)
+   print("failing upstream, ms per call: " + ", ".join(f"{t:.1f}" for t in timings))
+   print(f"upstream requests made: {stub.calls['failed']}, breaker: {upstream.breaker.state}")
+   print(json.dumps(upstream.metrics(), indent=2))
+   stub.stop()
+
+
+def free_port():
+   with socket.socket() as s:
+      s.bind(("127.0.0.1", 0))
+      return s.getsockname()[1]
+
+
+def serve(args):
+   # Child process entry point used by the load tests: serve one app until killed.
+   service = load_service(args.workdir)
+   if args.kind == "async":
+      from aiohttp import web
+      import async_server
+      service.gemini = FakeModel(args.model_latency)
+      web.run_app(async_server.make_app(), host="127.0.0.1", port=args.port, print=None, access_log=None)
+   else:
+      import logging
+      from werkzeug.serving import make_server
+      logging.getLogger("werkzeug").setLevel(logging.ERROR)
+      service.gemini = FakeModel(args.model_latency)
+      sys.stdout = io.StringIO()
+      make_server("127.0.0.1", args.port, service.app, threaded=True).serve_forever()
+
+
+def start_server(kind, workdir, env, model_latency=0.0):
+   port = free_port()
+   process = subprocess.Popen(
+      [sys.executable, os.path.abspath(__file__), "_serve", kind, "--port", str(port), "--workdir", workdir,
+       "--model-latency", str(model_latency)],
+      env={**os.environ, **env}, stdout=subprocess.DEVNULL)
+   return process, wait_for_port(process, port, f"{kind} server")
+
+
+def wait_for_port(process, port, label):
+   deadline = time.monotonic() + 30
+   while time.monotonic() < deadline:
+      try:
+         socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+         return f"http://127.0.0.1:{port}"
+      except OSError:
+         time.sleep(0.1)
+   process.kill()
+   raise RuntimeError(f"{label} did not start")
+
+
+async def load_test(base_url, paths, concurrency):
+   """Issue paths against base_url with at most concurrency requests in flight.
+
+   A path is a GET unless given as a (method, path) pair. Returns (elapsed
+   seconds, sorted latencies in seconds, status counts); requests that fail
+   without an answer are counted under "error".
+   """
+   import aiohttp
+
+   queue = list(reversed(paths))
+   latencies = []
+   statuses = Counter()
+
+   async def worker(client):
+      while queue:
+         method, path = queue.pop() if isinstance(queue[-1], tuple) else ("GET", queue.pop())
+         start = time.perf_counter()
+         try:
+            async with client.request(method, base_url + path) as response:
+               await response.read()
+               statuses[response.status] += 1
+         except (aiohttp.ClientError, asyncio.TimeoutError):
+            statuses["error"] += 1
+            continue
+         latencies.append(time.perf_counter() - start)
+
+   connector = aiohttp.TCPConnector(limit=concurrency)
+   async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120)) as client:
+      start = time.perf_counter()
+      await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+      elapsed = time.perf_counter() - start
+   return elapsed, sorted(latencies), statuses
+
+
+def percentile(samples, p):
+   return samples[min(len(samples) - 1, int(p * len(samples)))] if samples else float("nan")
+
+
+def bench_async_vs_sync(args):
+   stub = StubUpstream(latency=args.latency)
+   workdir = tempfile.mkdtemp()
+   # every request goes to the (slow) stub: the departures cache is switched off
+   env = {"TRANSPORT_REST_URL": stub.start(), "DEPARTURES_TTL": "0", "PROFILE_TTL": "0",
+          "UPSTREAM_POOL_SIZE": str(args.concurrency)}
+   service = load_service(workdir, **env)
+   stop_ids = seed_stops(service, 100)
+   rng = random.Random(0)
+   paths = [f"/stops/{rng.choice(stop_ids)}" for _ in range(args.requests)]
+
+   for kind in ("sync", "async"):
+      process, base_url = start_server(kind, workdir, env)
+      try:
+         elapsed, latencies, statuses = asyncio.run(load_test(base_url, paths, args.concurrency))
+      finally:
+         process.kill()
+         process.wait()
+      print(f"{kind:>5}: {len(paths) / elapsed:8.1f} req/s at concurrency {args.concurrency}, "
+            f"p50 {percentile(latencies, 0.5) * 1000:.0f} ms, p99 {percentile(latencies, 0.99) * 1000:.0f} ms, "
+            f"statuses {dict(statuses)}")
+   stub.stop()
+
+
+def bench_stops_list(args):
+   service = load_service(tempfile.mkdtemp())
+   start = time.perf_counter()
+   stop_ids = seed_stops(service, args.rows)
+   print(f"seeded {args.rows} stops in {time.perf_counter() - start:.1f} s")
+   client = service.app.test_client()
+
+   def timed(fn, repeat=20):
+      samples = []
+      for _ in range(repeat):
+         start = time.perf_counter()
+         fn()
+         samples.append(time.perf_counter() - start)
+      return sorted(samples)[len(samples) // 2] * 1000
+
+   print(f"{'depth':>10} {'GET /stops keyset':>18} {'OFFSET scan':>12}")
+   for fraction in (0, 0.01, 0.1, 0.5, 0.99):
+      depth = int(args.rows * fraction)
+      cursor = stop_ids[depth - 1] if depth else None
+      path = f"/stops?limit={args.limit}" + (f"&after={cursor}" if cursor else "")
+      keyset = timed(lambda: client.get(path))
+
+      def offset_page():
+         with service.db_pool.connection() as cnx:
+            cnx.execute('SELECT * FROM stops ORDER BY stop_id LIMIT ? OFFSET ?', (args.limit, depth)).fetchall()
+
+      print(f"{depth:>10} {keyset:>15.2f} ms {timed(offset_page):>9.2f} ms")
+
+   prefix_ms = timed(lambda: client.get(f"/stops?limit={args.limit}&name=Stop%2099"))
+   print(f"name prefix 'Stop 99': {prefix_ms:.2f} ms")
+
+
+def bench_nearby(args):
+   import numpy as np
+   service = load_service(tempfile.mkdtemp())
+   client = service.app.test_client()
+   rng = random.Random(1)
+   centres = [(rng.uniform(47.5, 54.8), rng.uniform(6.1, 14.8)) for _ in range(50)]
+   seeded = 0
+   for size in (int(n) for n in args.sizes.split(",")):
+      seed_stops(service, size - seeded, first=seeded)
+      seeded = size
+
+      samples = []
+      found = 0
+      for lat, lon in centres:
+         start = time.perf_counter()
+         response = client.get(f"/stops/nearby?lat={lat}&lon={lon}&radius={args.radius}&k={args.k}")
+         samples.append(time.perf_counter() - start)
+         found += response.json["count"]
+
+      # baseline without the index: scan every row and compute all distances
+      scan = []
+      for lat, lon in centres[:5]:
+         start = time.perf_counter()
+         with service.db_pool.connection() as cnx:
+            coords = np.array(cnx.execute('SELECT latitude, longitude FROM stops').fetchall())
+         distances = service.haversine(lat, lon, coords[:, 0], coords[:, 1])
+         np.sort(distances[distances <= args.radius])[:args.k]
+         scan.append(time.perf_counter() - start)
+
+      print(f"{size:>9} stops: R*Tree {percentile(sorted(samples), 0.5) * 1000:7.2f} ms p50, "
+            f"{percentile(sorted(samples), 0.99) * 1000:7.2f} ms p99 ({found / len(centres):.1f} hits/query); "
+            f"full scan {percentile(sorted(scan), 0.5) * 1000:8.1f} ms p50")
+
+
+def bench_departures_parse(args):
+   service = load_service(tempfile.mkdtemp())
+
+   # the previous implementation: decode everything, rebuild the window and strptime per entry
+   def old_next_departure(body):
+      for departure in json.loads(body)['departures']:
+         if departure['platform'] and departure['direction']:
+            current_time = datetime.now(timezone.utc)
+            maximum_from_now = current_time + timedelta(minutes=120)
+            when = datetime.strptime(departure['when'], "%Y-%m-%dT%H:%M:%S%z")
+            if current_time <= when <= maximum_from_now:
+               return departure['platform']
+
+   def old_operators(body):
+      names = []
+      for departure in json.loads(body)['departures']:
+         current_time = datetime.now(timezone.utc)
+         maximum_from_now = current_time + timedelta(minutes=90)
+         when = datetime.strptime(departure['when'], "%Y-%m-%dT%H:%M:%S%z")
+         if current_time <= when <= maximum_from_now:
+            if departure['line']['operator']['name'] not in names:
+               names.append(departure['line']['operator']['name'])
+            if len(names) == 5:
+               return names
+
+   def chunks(body):
+      return (body[i:i + service.DEPARTURES_CHUNK_SIZE] for i in range(0, len(body), service.DEPARTURES_CHUNK_SIZE))
+
+   def timed(fn, body):
+      start = time.perf_counter()
+      for _ in range(args.repeat):
+         fn(body)
+      return (time.perf_counter() - start) / args.repeat * 1000
+
+   for label, platformless in (("first entry matches", 0), ("match after half the payload", args.departures // 2)):
+      body = json.dumps(departures_payload(8011160, args.departures, bulky=True, platformless=platformless)).encode()
+      print(f"{label} ({len(body) / 1024:.0f} KB, {args.departures} departures)")
+      rows = (("next departure", old_next_departure, lambda b: service.next_departure_from(service.iter_departures(chunks(b)))),
+              ("operators", old_operators, lambda b: service.operators_from(service.iter_departures(chunks(b)))))
+      for name, old, new in rows:
+         print(f"   {name:>14}: full json.loads + strptime {timed(old, body):7.2f} ms, "
+               f"streaming + fromisoformat {timed(new, body):7.2f} ms")
+
+
+def bench_stops_cli(args):
+   import resource
+
+   workdir = tempfile.mkdtemp()
+   load_service(workdir)
+   import stops_cli
+
+   now = time.strftime('%Y-%m-%d-%H:%M:%S')
+   rng = random.Random(0)
+   for first, fmt in ((8000000, "ndjson"), (9000000, "csv")):
+      # each format imports new stop ids; emptying the table first would leave the
+      # search index full of deletions that slow the next import down
+      path = os.path.join(workdir, f"stops.{fmt}")
+      with open(path, "w", newline="", encoding="utf-8") as f:
+         if fmt == "csv":
+            f.write(",".join(stops_cli.COLUMNS) + "\n")
+         for i in range(args.rows):
+            row = (first + i, now, f"Stop {i}", round(rng.uniform(47.3, 55.0), 6), round(rng.uniform(5.9, 15.0), 6))
+            if fmt == "csv":
+               f.write(",".join(map(str, row)) + "\n")
+            else:
+               f.write(json.dumps(dict(zip(stops_cli.COLUMNS, row))) + "\n")
+
+      start = time.perf_counter()
+      with open(path, newline="", encoding="utf-8") as f:
+         imported, _ = stops_cli.import_file(f, fmt, args.chunk_size)
+      elapsed = time.perf_counter() - start
+      print(f"import {fmt:>6}: {imported / elapsed:10.0f} rows/s ({imported} rows, {elapsed:.2f} s)")
+
+      start = time.perf_counter()
+      with open(os.devnull, "w", newline="", encoding="utf-8") as f:
+         exported = stops_cli.export_file(f, fmt, args.chunk_size)
+      elapsed = time.perf_counter() - start
+      print(f"export {fmt:>6}: {exported / elapsed:10.0f} rows/s")
+   print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+
+def bench_validate(args):
+   service = load_service(tempfile.mkdtemp())
+   rng = random.Random(0)
+   now = time.strftime('%Y-%m-%d-%H:%M:%S')
+   rows = []
+   for i in range(args.rows):
+      row = {"name": f"Stop {i}", "latitude": rng.uniform(-90, 90), "longitude": rng.uniform(-180, 180),
+             "last_updated": now}
+      if rng.random() < args.invalid:
+         field, value = rng.choice([("name", ""), ("latitude", 95.0), ("longitude", -200.0),
+                                    ("latitude", float("nan")), ("longitude", float("inf")), ("latitude", True),
+                                    ("last_updated", "2024-02-30-00:00:00"), ("last_updated", "yesterday"),
+                                    ("last_updated", "2024-05-01-10:00:60")])
+         row[field] = value
+      rows.append(row)
+
+   start = time.perf_counter()
+   expected = [service.validate_input(row)[1] for row in rows]
+   per_row = time.perf_counter() - start
+   columns = {field: [row.get(field) for row in rows] for field in service.VALIDATED_FIELDS}
+   start = time.perf_counter()
+   import pandas  # noqa: F401  (timed on its own: the first vectorized batch of a process pays for it)
+   pandas_import = time.perf_counter() - start
+   start = time.perf_counter()
+   messages = service._validate_columns(columns, len(rows))
+   batch = time.perf_counter() - start
+   assert messages == expected, "validate_batch disagrees with validate_input"
+   print(f"validate_input per row: {len(rows) / per_row:10.0f} rows/s")
+   print(f"vectorized:             {len(rows) / batch:10.0f} rows/s "
+         f"({sum(1 for m in messages if m)} invalid rows, same messages)")
+   print(f"pandas import:          {pandas_import:10.3f} s, the time of {pandas_import * len(rows) / per_row:.0f} "
+         f"rows per row (VALIDATE_BATCH_MIN_ROWS={service.VALIDATE_BATCH_MIN_ROWS})")
+
+
+def bench_stop_cache(args):
+   service = load_service(tempfile.mkdtemp())
+   stop_ids = seed_stops(service, args.rows)
+   rng = random.Random(0)
+   includes = [None, "name", "name,latitude,longitude", "last_updated"]
+   paths = []
+   for _ in range(args.requests):
+      include = rng.choice(includes)
+      # a few hot stops, like clients polling their local station
+      stop_id = rng.choice(stop_ids[:100]) if rng.random() < 0.8 else rng.choice(stop_ids)
+      paths.append(f"/stops/{stop_id}?include={include or 'name,last_updated,latitude,longitude'}")
+
+   for label, entries in (("no cache", 0), (f"{service.STOP_CACHE_ENTRIES} entries", service.STOP_CACHE_ENTRIES)):
+      service.stop_cache = service.StopDocumentCache(entries)
+      elapsed = run_requests(service.app, paths, args.threads)
+      stats = service.stop_cache.stats()
+      print(f"GET /stops/<id> {label:>14}: {len(paths) / elapsed:9.1f} req/s, hit rate {stats['hit_rate']}")
+
+   # Consistency: readers fill the cache while a writer inserts, deletes, updates and
+   # bulk-upserts stops next to the hot ones. Afterwards every cached document must
+   # equal one rebuilt from the database; any difference is a stale link or field.
+   service.stop_cache = service.StopDocumentCache(service.STOP_CACHE_ENTRIES)
+   hot = stop_ids[:200]
+   done = threading.Event()
+
+   def reader(seed):
+      r = random.Random(seed)
+      while not done.is_set():
+         service.cached_stop(r.choice(hot), r.choice([None, ["name"]]), "localhost")
+
+   def writer():
+      r = random.Random(1)
+      now = time.strftime('%Y-%m-%d-%H:%M:%S')
+      for i in range(args.requests // 10):
+         stop_id = r.choice(hot) + r.choice([-1, 0, 1])
+         op = r.random()
+         if op < 0.3:
+            service.db_delete(stop_id)
+         elif op < 0.6:
+            if not service.db_read(stop_id):
+               service.db_insert(stop_id, now, f"New {i}", 50.0, 10.0)
+         elif op < 0.8:
+            service.db_update(stop_id, now, f"Renamed {i}", 50.0, 10.0)
+         else:
+            service.db_upsert_many([(stop_id + d, now, f"Bulk {i}", 50.0, 10.0) for d in (-1, 1)])
+
+   with ThreadPoolExecutor(max_workers=args.threads + 1) as pool:
+      readers = [pool.submit(reader, seed) for seed in range(args.threads)]
+      pool.submit(writer).result()
+      done.set()
+      for f in readers:
+         f.result()
+
+   stale = 0
+   for (stop_id, fields, host), (_, _, _, document, _) in list(service.stop_cache._entries.items()):
+      found = service.db_read_with_neighbours(stop_id)
+      fresh = found and service.stop_document(stop_id, *found[:3], sorted(fields) if fields else None, host)
+      stale += document != fresh
+   stats = service.stop_cache.stats()
+   print(f"after {args.requests // 10} concurrent writes: {stats['entries']} cached documents, {stale} stale, "
+         f"{stats['invalidations']} invalidated, {stats['rejected']} racing loads not stored")
+   assert stale == 0
+
+
+def bench_tracing(args):
+   service = load_service(tempfile.mkdtemp())
+   import tracing
+
+   stop_ids = seed_stops(service, args.rows)
+   rng = random.Random(0)
+   paths = [f"/stops/{rng.choice(stop_ids)}?include=name,last_updated,latitude,longitude"
+            for _ in range(args.requests)]
+   # the cache would hide the db spans, and alternating rounds spread out machine noise
+   service.stop_cache = service.StopDocumentCache(0)
+   timings = {False: [], True: []}
+   for _ in range(args.rounds):
+      for enabled in (False, True):
+         tracing.ENABLED = enabled
+         timings[enabled].append(run_requests(service.app, paths, 1))
+   off, on = min(timings[False]), min(timings[True])
+   print(f"tracing off: {len(paths) / off:9.1f} req/s")
+   print(f"tracing on:  {len(paths) / on:9.1f} req/s ({(on - off) / off * 100:+.1f}% time per request)")
+
+   # the same work in isolation, as end-to-end numbers on a shared machine are noisy:
+   # one trace with the db and serialize spans of a GET /stops/<id>
+   def instrumented_request():
+      token = tracing.start_trace()
+      with tracing.span("db.read_with_neighbours"):
+         pass
+      with tracing.span("serialize.json"):
+         pass
+      tracing.finish_trace(token, "GET /stops/<int:stop_id>")
+
+   tracing.ENABLED = True
+   n = 100000
+   cost = min(timeit.timeit(instrumented_request, number=n) for _ in range(3)) / n
+   print(f"tracing work per request: {cost * 1e6:.1f} us, {cost / (off / len(paths)) * 100:.1f}% of a "
+         f"{off / len(paths) * 1e6:.0f} us request")
+
+   tracing.profiler.start()
+   with_profiler = min(run_requests(service.app, paths, 1) for _ in range(args.rounds))
+   tracing.profiler.stop()
+   print(f"tracing on + sampling profiler every {tracing.profiler.interval * 1000:g} ms: "
+         f"{len(paths) / with_profiler:9.1f} req/s ({(with_profiler - off) / off * 100:+.1f}%)")
+
+
+async def time_to_first_byte(base_url, path):
+   # (seconds to the first body byte, seconds to the end of the body, status)
+   import aiohttp
+
+   async with aiohttp.ClientSession() as client:
+      start = time.perf_counter()
+      async with client.get(base_url + path) as response:
+         await response.content.readany()
+         first = time.perf_counter() - start
+         await response.read()
+         return first, time.perf_counter() - start, response.status
+
+
+def bench_streaming(args):
+   stub = StubUpstream()
+   workdir = tempfile.mkdtemp()
+   # caches off, so every request waits for the fake model
+   env = {"TRANSPORT_REST_URL": stub.start(), "PROFILE_TTL": "0", "GUIDE_TTL": "0"}
+   service = load_service(workdir, **env)
+   stop_ids = seed_stops(service, 10)
+   routes = [("/guide", "/guide"), ("/operator-profiles", f"/operator-profiles/{stop_ids[0]}")]
+
+   for kind in ("sync", "async"):
+      process, base_url = start_server(kind, workdir, env, model_latency=args.model_latency)
+      try:
+         for label, path in routes:
+            for mode, query in (("buffered", ""), ("streamed", "?stream=true")):
+               runs = [asyncio.run(time_to_first_byte(base_url, path + query)) for _ in range(args.requests)]
+               assert all(status == 200 for _, _, status in runs), runs
+               ttfb = sorted(first for first, _, _ in runs)
+               total = sorted(end for _, end, _ in runs)
+               print(f"{kind:>5} {label:<18} {mode}: TTFB p50 {percentile(ttfb, 0.5) * 1000:7.1f} ms, "
+                     f"complete p50 {percentile(total, 0.5) * 1000:7.1f} ms")
+      finally:
+         process.kill()
+         process.wait()
+   stub.stop()
+
+
+def bench_sampler(args):
+   import numpy as np
+   service = load_service(tempfile.mkdtemp())
+   stop_ids = seed_stops(service, args.rows)
+
+   # the old query: count the table, then sort every row by RANDOM()
+   old = []
+   for _ in range(5):
+      start = time.perf_counter()
+      with service.db_pool.connection() as cnx:
+         if cnx.execute("SELECT COUNT(DISTINCT stop_id) FROM stops").fetchone()[0] >= 2:
+            cnx.execute("SELECT DISTINCT stop_id FROM stops ORDER BY RANDOM() LIMIT 2").fetchall()
+      old.append(time.perf_counter() - start)
+   print(f"{args.rows} stops, COUNT DISTINCT + ORDER BY RANDOM(): {percentile(sorted(old), 0.5) * 1000:9.2f} ms p50")
+
+   sampler = service.stop_sampler = service.StopSampler(service.SAMPLER_RELOAD, service.SAMPLER_WEIGHT_REFRESH, service.SAMPLER_MAX_VIEWED)
+   start = time.perf_counter()
+   sampler.size()
+   print(f"sampler load (once per {service.SAMPLER_RELOAD:.0f} s):     {(time.perf_counter() - start) * 1000:9.2f} ms")
+
+   # popular mode: a few hundred stops have been read, most of them rarely
+   rng = random.Random(0)
+   for stop_id in rng.sample(stop_ids, 500):
+      for _ in range(rng.randint(1, 50)):
+         sampler.viewed(stop_id)
+   for mode in ("uniform", "popular"):
+      sampler.pair(mode)
+      seconds = timeit.timeit(lambda: sampler.pair(mode), number=args.samples) / args.samples
+      print(f"sampler.pair({mode!r}):{' ' * (23 - len(mode))}{seconds * 1e6:9.2f} us")
+   for mode in service.GUIDE_PAIR_MODES:
+      samples = []
+      for _ in range(args.requests):
+         start = time.perf_counter()
+         valid, _ = service.num_stops_id(mode)
+         samples.append(time.perf_counter() - start)
+         assert valid
+      print(f"num_stops_id({mode!r}) incl. row checks:{' ' * (8 - len(mode))}"
+            f"{percentile(sorted(samples), 0.5) * 1000:9.3f} ms p50, {percentile(sorted(samples), 0.99) * 1000:.3f} ms p99")
+
+   # writes reach the sampler without a reload: time merging a batch of inserts and deletes
+   now = time.strftime('%Y-%m-%d-%H:%M:%S')
+   added = [9900000 + i for i in range(args.batch)]
+   service.db_upsert_many([(stop_id, now, f"New {stop_id}", 52.5, 13.4) for stop_id in added])
+   for stop_id in stop_ids[:10]:
+      service.db_delete(stop_id)
+   start = time.perf_counter()
+   size = sampler.size()
+   print(f"merge {args.batch} inserts + 10 deletes:       {(time.perf_counter() - start) * 1000:9.2f} ms")
+   assert size == args.rows + args.batch - 10
+   ids = sampler._ids
+   assert np.all(ids[1:] > ids[:-1]) and not np.isin(stop_ids[:10], ids).any()
+
+   # uniformity: every stop of a small table is drawn about equally often
+   counts = Counter()
+   small = service.StopSampler(service.SAMPLER_RELOAD, service.SAMPLER_WEIGHT_REFRESH, service.SAMPLER_MAX_VIEWED)
+   small._ids, small._loaded_at = np.arange(10, dtype=np.int64), time.monotonic()
+   for _ in range(50000):
+      counts.update(small.pair("uniform"))
+   print(f"uniform draws over 10 ids: min {min(counts.values())}, max {max(counts.values())} of 100000")
+
+
+def import_times(workdir, env):
+   # -X importtime report of `import z5370300` in a fresh interpreter:
+   # {module: (cumulative us, nesting depth)}, depth 0 being the service module itself
+   result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {SERVICE_MODULE}"],
+                           cwd=workdir, env={**env, "PYTHONPATH": HERE}, capture_output=True, text=True, check=True)
+   times = {}
+   for line in result.stderr.splitlines():
+      match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)", line)
+      if match:
+         times[match.group(3)] = (int(match.group(1)), len(match.group(2)) // 2)
+   return times
+
+
+def bench_import_time(args):
+   # Each run imports the module in a new interpreter and an empty directory, without
+   # GOOGLE_API_KEY, as a freshly started or forked worker would.
+   workdir = tempfile.mkdtemp()
+   env = {k: v for k, v in os.environ.items() if k != "GOOGLE_API_KEY"}
+   runs = [import_times(workdir, env) for _ in range(args.runs)]
+   totals = sorted(run[SERVICE_MODULE][0] for run in runs)
+   print(f"import {SERVICE_MODULE} without GOOGLE_API_KEY: {percentile(totals, 0.5) / 1000:7.1f} ms p50 "
+         f"over {args.runs} runs (min {totals[0] / 1000:.1f} ms)")
+
+   print("heaviest direct imports:")
+   direct = [(name, cumulative) for name, (cumulative, depth) in runs[0].items() if depth == 1]
+   for name, cumulative in sorted(direct, key=lambda item: -item[1])[:args.top]:
+      print(f"   {name:<24} {cumulative / 1000:7.1f} ms")
+
+   # modules that are only imported when a request needs them
+   eager = sorted({name for run in runs for name in run if name in ("pandas", "google.generativeai")})
+   assert not eager, f"imported at start-up: {', '.join(eager)}"
+   budget = percentile(totals, 0.5) / 1000
+   assert not args.budget_ms or budget <= args.budget_ms, f"import takes {budget:.1f} ms, over {args.budget_ms} ms"
+
+
+PLACES = ["Berlin", "Hamburg", "München", "Köln", "Frankfurt", "Stuttgart", "Düsseldorf", "Leipzig", "Dortmund",
+          "Essen", "Bremen", "Dresden", "Hannover", "Nürnberg", "Duisburg", "Bochum", "Wuppertal", "Bielefeld",
+          "Bonn", "Münster", "Mannheim", "Karlsruhe", "Augsburg", "Wiesbaden", "Mönchengladbach", "Braunschweig"]
+STOP_WORDS = ["Hauptbahnhof", "Hbf", "Bahnhof", "Rathaus", "Markt", "Schule", "Kirche", "Friedhof", "Post",
+              "Schloss", "Brücke", "Straße", "Platz", "Allee", "Park", "Siedlung", "Mitte", "Nord", "Süd", "Ost", "West"]
+
+
+def stop_names(rows, seed=0):
+   # names in the style of German stops, e.g. "Köln, Rathaus 12" or "Leipzig Markt Nord"
+   rng = random.Random(seed)
+   for i in range(rows):
+      place = rng.choice(PLACES)
+      if rng.random() < 0.5:
+         yield f"{place}, {rng.choice(STOP_WORDS)} {i % 500}"
+      else:
+         yield f"{place} {rng.choice(STOP_WORDS)} {rng.choice(STOP_WORDS)}"
+
+
+def bench_search(args):
+   stub = StubUpstream(latency=args.latency)
+   service = load_service(tempfile.mkdtemp(), TRANSPORT_REST_URL=stub.start())
+   client = service.app.test_client()
+   rng = random.Random(0)
+   now = time.strftime('%Y-%m-%d-%H:%M:%S')
+   rows = [(8000000 + i, now, name, rng.uniform(47.3, 55.0), rng.uniform(5.9, 15.0))
+           for i, name in enumerate(stop_names(args.rows))]
+
+   # write cost of the search index: the same bulk upsert with and without its triggers
+   for label in ("without search triggers", "with search triggers"):
+      with service.db_pool.connection() as cnx, cnx:
+         cnx.execute('DELETE FROM stops')
+         if label.startswith("without"):
+            for trigger in ("stops_search_insert", "stops_search_update", "stops_search_delete"):
+               cnx.execute(f'DROP TRIGGER {trigger}')
+         else:
+            service.init_search_index(cnx)
+            cnx.execute('DELETE FROM stops_fts')
+      start = time.perf_counter()
+      service.import_stops(iter(rows))
+      print(f"import {args.rows} stops {label:>23}: {args.rows / (time.perf_counter() - start):9.0f} rows/s")
+
+   queries = {
+      "prefix": ["berl", "Köln Rath", "hauptbahnhof", "Leipzig Markt", "münster schl"],
+      "typo": ["hauptbanhof", "Dusseldrof", "Nurnberk Post", "Frankfrut", "Braunschwieg Markt"],
+   }
+   for kind, texts in queries.items():
+      samples = []
+      hits = Counter()
+      for _ in range(args.requests // len(texts)):
+         for text in texts:
+            start = time.perf_counter()
+            response = client.get(f"/stops/search?q={text}&limit=10")
+            samples.append(time.perf_counter() - start)
+            hits.update(stop["match"] for stop in response.json["stops"])
+      samples.sort()
+      print(f"GET /stops/search {kind:>6}: {percentile(samples, 0.5) * 1000:7.2f} ms p50, "
+            f"{percentile(samples, 0.99) * 1000:7.2f} ms p99, matches {dict(hits)}")
+
+   # PUT /stops for a stored stop, asking transport.rest vs answering from the index
+   name = rows[0][2]
+   for label, query in (("upstream", f"query={name}"), ("local max_age=3600", f"query={name}&max_age=3600")):
+      stub.calls.clear()
+      samples = []
+      for _ in range(args.requests // 10):
+         start = time.perf_counter()
+         response = client.put(f"/stops?{query}")
+         samples.append(time.perf_counter() - start)
+         assert response.status_code == 200
+      samples.sort()
+      print(f"PUT /stops {label:>18}: {percentile(samples, 0.5) * 1000:7.2f} ms p50, "
+            f"{stub.calls['locations']} upstream calls")
+   stub.stop()
+
+
+def seed_named_stops(service, rows, first=0):
+   # like seed_stops, but with stop_names() names, through the bulk import path
+   now = time.strftime('%Y-%m-%d-%H:%M:%S')
+   rng = random.Random(first)
+   service.import_stops((8000000 + i, now, name, rng.uniform(47.3, 55.0), rng.uniform(5.9, 15.0))
+                        for i, name in enumerate(stop_names(rows, seed=first), first))
+   return [8000000 + i for i in range(first, first + rows)]
+
+
+# load scenario endpoints: name -> function(rng, stop ids, location queries) returning (method, path)
+LOAD_ENDPOINTS = {
+   "stops-list": lambda rng, stop_ids, queries: ("GET", f"/stops?after={rng.choice(stop_ids)}&limit=20"),
+   "stops-put": lambda rng, stop_ids, queries: ("PUT", f"/stops?query={quote(rng.choice(queries))}"),
+   "stop": lambda rng, stop_ids, queries: ("GET", f"/stops/{rng.choice(stop_ids)}"),
+   "operator-profiles": lambda rng, stop_ids, queries: ("GET", f"/operator-profiles/{rng.choice(stop_ids)}"),
+   "guide": lambda rng, stop_ids, queries: ("GET", "/guide"),
+}
+
+
+def process_rss(pid):
+   # (current, peak) resident set size of pid in MB, from /proc; (None, None) where there is no /proc
+   try:
+      with open(f"/proc/{pid}/status") as f:
+         fields = dict(line.split(":", 1) for line in f)
+   except OSError:
+      return None, None
+   return tuple(round(int(fields[key].split()[0]) / 1024, 1) for key in ("VmRSS", "VmHWM"))
+
+
+def latency_summary(latencies):
+   # latencies sorted, in seconds; the summary is in milliseconds
+   if not latencies:
+      return {}
+   summary = {"mean": sum(latencies) / len(latencies), "max": latencies[-1]}
+   summary.update((f"p{round(p * 100)}", percentile(latencies, p)) for p in (0.5, 0.9, 0.95, 0.99))
+   return {key: round(value * 1000, 3) for key, value in summary.items()}
+
+
+def run_metadata(args):
+   def git(*command):
+      result = subprocess.run(["git", *command], cwd=HERE, capture_output=True, text=True)
+      return result.stdout.strip() if result.returncode == 0 else None
+
+   status = git("status", "--porcelain", "--untracked-files=no")
+   return {
+      "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+      "commit": git("rev-parse", "--short", "HEAD"),
+      "dirty": bool(status) if status is not None else None,
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "cpus": os.cpu_count(),
+      "settings": {key: value for key, value in vars(args).items() if key != "func"},
+   }
+
+
+def bench_load(args):
+   endpoints = args.endpoints.split(",")
+   unknown = set(endpoints) - set(LOAD_ENDPOINTS)
+   if unknown:
+      raise SystemExit(f"unknown endpoints {', '.join(sorted(unknown))}, choose from {', '.join(LOAD_ENDPOINTS)}")
+   concurrencies = [int(n) for n in args.concurrency.split(",")]
+   kinds = ["sync", "async"] if args.server == "both" else [args.server]
+   fixtures = Fixtures.load(args.fixtures) if args.fixtures else None
+   queries = fixtures.queries if fixtures else PLACES
+
+   stub = StubUpstream(latency=args.latency, fixtures=fixtures)
+   workdir = tempfile.mkdtemp()
+   env = {"TRANSPORT_REST_URL": stub.start(), "UPSTREAM_POOL_SIZE": str(max(concurrencies))}
+   service = load_service(workdir, **env)
+   report = {"meta": run_metadata(args), "results": []}
+   seeded = 0
+   for rows in sorted(int(n) for n in args.sizes.split(",")):
+      start = time.perf_counter()
+      seed_named_stops(service, rows - seeded, first=seeded)
+      seeded = rows
+      stop_ids = list(range(8000000, 8000000 + rows))
+      print(f"{rows} stops seeded in {time.perf_counter() - start:.1f} s")
+
+      for kind in kinds:
+         process, base_url = start_server(kind, workdir, env, args.model_latency)
+         try:
+            # a few requests per endpoint first, so lazy setup is not measured
+            warmup = [LOAD_ENDPOINTS[endpoint](random.Random(-1), stop_ids, queries) for endpoint in endpoints]
+            asyncio.run(load_test(base_url, warmup * 2, 1))
+            for endpoint in endpoints:
+               count = args.guide_requests if endpoint == "guide" else args.requests
+               for concurrency in concurrencies:
+                  # the same request sequence for every run and server kind
+                  rng = random.Random(f"{args.seed}:{rows}:{endpoint}:{concurrency}")
+                  paths = [LOAD_ENDPOINTS[endpoint](rng, stop_ids, queries) for _ in range(count)]
+                  stub.calls.clear()
+                  elapsed, latencies, statuses = asyncio.run(load_test(base_url, paths, concurrency))
+                  rss, peak_rss = process_rss(process.pid)
+                  result = {
+                     "server": kind, "rows": rows, "endpoint": endpoint, "concurrency": concurrency,
+                     "requests": count, "seconds": round(elapsed, 3),
+                     "throughput_rps": round(count / elapsed, 1),
+                     "latency_ms": latency_summary(latencies),
+                     "statuses": {str(status): n for status, n in sorted(statuses.items(), key=str)},
+                     "upstream_calls": dict(stub.calls),
+                     "rss_mb": rss, "peak_rss_mb": peak_rss,
+                  }
+                  report["results"].append(result)
+                  print(f"{kind:>5} {rows:>8} {endpoint:>17} c={concurrency:<4} {result['throughput_rps']:8.1f} req/s, "
+                        f"p50 {result['latency_ms'].get('p50', float('nan')):8.2f} ms, "
+                        f"p99 {result['latency_ms'].get('p99', float('nan')):8.2f} ms, "
+                        f"rss {rss} MB, statuses {result['statuses']}")
+         finally:
+            process.kill()
+            process.wait()
+   stub.stop()
+
+   if args.out:
+      with open(args.out, "w", encoding="utf-8") as f:
+         json.dump(report, f, indent=1)
+      print(f"wrote {args.out}")
+   if args.compare:
+      with open(args.compare, encoding="utf-8") as f:
+         baseline = json.load(f)
+      if compare_reports(baseline, report, args.threshold):
+         raise SystemExit(1)
+
+
+def compare_reports(baseline, current, threshold):
+   # Prints throughput and p99 changes per (server, rows, endpoint, concurrency) cell and
+   # returns the number of cells worse than the baseline by more than threshold.
+   def key(result):
+      return result["server"], result["rows"], result["endpoint"], result["concurrency"]
+
+   def change(new, old):
+      return new / old - 1 if old else float("nan")
+
+   before = {key(result): result for result in baseline["results"]}
+   print(f"baseline {baseline['meta'].get('commit')} ({baseline['meta'].get('started_at')}) -> "
+         f"current {current['meta'].get('commit')} ({current['meta'].get('started_at')})")
+   regressions = 0
+   for result in current["results"]:
+      old = before.get(key(result))
+      label = "{:>5} {:>8} {:>17} c={:<4}".format(*key(result))
+      if old is None:
+         print(f"{label} not in the baseline")
+         continue
+      throughput = change(result["throughput_rps"], old["throughput_rps"])
+      p99 = change(result["latency_ms"].get("p99", 0), old["latency_ms"].get("p99", 0))
+      worse = throughput < -threshold or p99 > threshold
+      regressions += worse
+      print(f"{label} throughput {throughput:+7.1%}, p99 {p99:+7.1%}, "
+            f"rss {old['rss_mb']} -> {result['rss_mb']} MB{'  REGRESSION' if worse else ''}")
+   print(f"{regressions} of {len(current['results'])} cells regressed by more than {threshold:.0%}")
+   return regressions
+
+
+def bench_load_compare(args):
+   with open(args.baseline, encoding="utf-8") as f:
+      baseline = json.load(f)
+   with open(args.current, encoding="utf-8") as f:
+      current = json.load(f)
+   if compare_reports(baseline, current, args.threshold):
+      raise SystemExit(1)
+
+
+def record_fixtures(args):
+   # Records /locations and /departures answers of the live API for StubUpstream to replay.
+   import requests
+
+   url = args.url.rstrip('/')
+   data = {"recorded_at": datetime.now(timezone.utc).isoformat(timespec="seconds"), "source": url,
+           "locations": {}, "departures": {}}
+
+   def fetch(path, **params):
+      # transport.rest allows 100 requests a minute
+      time.sleep(0.7)
+      response = requests.get(url + path, params=params, timeout=30)
+      response.raise_for_status()
+      return response.json()
+
+   for query in args.query or PLACES[:5]:
+      # the same parameters as the service's own calls
+      locations = fetch("/locations", query=query, results=5)
+      data["locations"][query] = locations
+      stops = [location["id"] for location in locations if location.get("type") in ("stop", "station")]
+      for stop_id in stops[:args.stops]:
+         data["departures"][stop_id] = fetch(f"/stops/{stop_id}/departures")
+   with open(args.out, "w", encoding="utf-8") as f:
+      json.dump(data, f, indent=1, ensure_ascii=False, sort_keys=True)
+   print(f"recorded {len(data['locations'])} /locations and {len(data['departures'])} /departures answers "
+         f"to {args.out}")
+
+
+def start_prefork(workdir, env, workers, kind="sync"):
+   port = free_port()
+   process = subprocess.Popen(
+      [sys.executable, os.path.join(HERE, "prefork.py"), "--workers", str(workers), "--port", str(port),
+       "--server", kind], cwd=workdir, env={**os.environ, **env}, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+   return process, wait_for_port(process, port, f"prefork server with {workers} workers")
+
+
+def _load_share(base_url, paths, concurrency):
+   return asyncio.run(load_test(base_url, paths, concurrency))
+
+
+def bench_workers(args):
+   counts = [int(n) for n in args.workers.split(",")]
+   stub = StubUpstream(latency=args.latency)
+   workdir = tempfile.mkdtemp()
+   env = {"TRANSPORT_REST_URL": stub.start()}
+   service = load_service(workdir, **env)
+   stop_ids = seed_named_stops(service, args.rows)
+   service.db_pool.close()
+   rng = random.Random(0)
+   # CPU-bound requests: stored fields only, no upstream call
+   paths = [f"/stops/{rng.choice(stop_ids)}?include=name,latitude,longitude" if i % 4 else
+            f"/stops?after={rng.choice(stop_ids)}&limit=20" for i in range(args.requests)]
+   cpus = os.cpu_count() or 1
+   print(f"{cpus} CPUs, {args.clients} client processes, concurrency {args.concurrency}")
+
+   throughput = {}
+   with ProcessPoolExecutor(max_workers=args.clients) as clients:
+      for workers in counts:
+         process, base_url = start_prefork(workdir, env, workers, args.server)
+         try:
+            # warm every worker up before measuring
+            list(clients.map(_load_share, [base_url] * args.clients, [paths[:200]] * args.clients,
+                             [args.concurrency] * args.clients))
+            shares = [paths[i::args.clients] for i in range(args.clients)]
+            runs = list(clients.map(_load_share, [base_url] * args.clients, shares,
+                                    [args.concurrency // args.clients or 1] * args.clients))
+            statuses = sum((run[2] for run in runs), Counter())
+            latencies = sorted(latency for run in runs for latency in run[1])
+            throughput[workers] = len(paths) / max(run[0] for run in runs)
+
+            # departures of a few stops asked through every worker: the shared cache
+            # should keep upstream calls at one per stop
+            stub.calls.clear()
+            first = 10 * counts.index(workers)
+            hot = [f"/stops/{stop_id}?include=next_departure" for stop_id in stop_ids[first:first + 10]] * (workers * 10)
+            list(clients.map(_load_share, [base_url] * args.clients, [hot[i::args.clients] for i in range(args.clients)],
+                             [args.concurrency // args.clients or 1] * args.clients))
+         finally:
+            process.send_signal(signal.SIGTERM)
+            process.wait(timeout=30)
+         print(f"{workers:>2} workers: {throughput[workers]:8.1f} req/s ({throughput[workers] / throughput[counts[0]]:.2f}x), "
+               f"p50 {percentile(latencies, 0.5) * 1000:6.2f} ms, p99 {percentile(latencies, 0.99) * 1000:6.2f} ms, "
+               f"statuses {dict(statuses)}; {stub.calls['departures']} upstream calls for 10 stops")
+   stub.stop()
+
+   # the check: with W workers on at least W cores, throughput should reach
+   # min-scaling * W times that of one worker
+   failed = False
+   base = throughput[counts[0]] / counts[0]
+   for workers in counts[1:]:
+      if workers > cpus:
+         print(f"{workers} workers: not checked, only {cpus} CPUs")
+         continue
+      expected = args.min_scaling * workers * base
+      if throughput[workers] < expected:
+         print(f"{workers} workers: {throughput[workers]:.1f} req/s is below the expected {expected:.1f}")
+         failed = True
+   if failed:
+      raise SystemExit(1)
+
+
+def main():
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   sub = parser.add_subparsers(dest="scenario", required=True)
+
+   p = sub.add_parser("stops-get", help="req/s of GET /stops/<id> with and without the connection pool")
+   p.add_argument("--rows", type=int, default=10000)
+   p.add_argument("--requests", type=int, default=5000)
+   p.add_argument("--threads", type=int, default=8)
+   p.add_argument("--pool-size", type=int, default=8)
+   p.set_defaults(func=bench_stops_get)
+
+   p = sub.add_parser("upsert", help="rows/s and commits/s of per-row writes vs the bulk upsert path")
+   p.add_argument("--rows", type=int, default=20000)
+   p.add_argument("--batch", type=int, default=5000)
+   p.set_defaults(func=bench_upsert)
+
+   p = sub.add_parser("departures", help="upstream calls and req/s with and without the departures cache")
+   p.add_argument("--stops", type=int, default=20)
+   p.add_argument("--requests", type=int, default=1000)
+   p.add_argument("--threads", type=int, default=16)
+   p.add_argument("--latency", type=float, default=0.05)
+   p.add_argument("--ttl", type=float, default=30)
+   p.set_defaults(func=bench_departures)
+
+   p = sub.add_parser("profiles", help="latency, model calls and tokens of /operator-profiles per profile mode")
+   p.add_argument("--requests", type=int, default=10)
+   p.add_argument("--model-latency", type=float, default=0.3)
+   p.add_argument("--token-latency", type=float, default=0.01, help="seconds per output token of the fake model")
+   p.add_argument("--drop", type=float, default=0.1, help="share of names a batched reply leaves out")
+   p.set_defaults(func=bench_profiles)
+
+   p = sub.add_parser("upstream", help="keep-alive session latency, retries and circuit breaker fail-fast")
+   p.add_argument("--requests", type=int, default=200)
+   p.set_defaults(func=bench_upstream)
+
+   p = sub.add_parser("async-vs-sync", help="throughput of the Flask server vs async_server.py under concurrency")
+   p.add_argument("--requests", type=int, default=2000)
+   p.add_argument("--concurrency", type=int, default=100)
+   p.add_argument("--latency", type=float, default=0.1)
+   p.set_defaults(func=bench_async_vs_sync)
+
+   p = sub.add_parser("stops-list", help="GET /stops latency at increasing page depth on a large table")
+   p.add_argument("--rows", type=int, default=1000000)
+   p.add_argument("--limit", type=int, default=50)
+   p.set_defaults(func=bench_stops_list)
+
+   p = sub.add_parser("nearby", help="GET /stops/nearby latency with the R*Tree vs a full scan")
+   p.add_argument("--sizes", default="100000,1000000")
+   p.add_argument("--radius", type=float, default=2000)
+   p.add_argument("--k", type=int, default=10)
+   p.set_defaults(func=bench_nearby)
+
+   p = sub.add_parser("departures-parse", help="full decode vs streaming early-exit parse of a large-hub payload")
+   p.add_argument("--departures", type=int, default=400)
+   p.add_argument("--repeat", type=int, default=20)
+   p.set_defaults(func=bench_departures_parse)
+
+   p = sub.add_parser("stops-cli", help="rows/s of stops_cli.py import and export for NDJSON and CSV")
+   p.add_argument("--rows", type=int, default=200000)
+   p.add_argument("--chunk-size", type=int, default=5000)
+   p.set_defaults(func=bench_stops_cli)
+
+   p = sub.add_parser("validate", help="rows/s of validate_input row by row vs validate_batch")
+   p.add_argument("--rows", type=int, default=200000)
+   p.add_argument("--invalid", type=float, default=0.05, help="share of rows with one invalid field")
+   p.set_defaults(func=bench_validate)
+
+   p = sub.add_parser("stop-cache", help="GET /stops/<id> with and without the document cache, plus a staleness check")
+   p.add_argument("--rows", type=int, default=100000)
+   p.add_argument("--requests", type=int, default=20000)
+   p.add_argument("--threads", type=int, default=4)
+   p.set_defaults(func=bench_stop_cache)
+
+   p = sub.add_parser("tracing", help="GET /stops/<id> cost of spans, histograms and the sampling profiler")
+   p.add_argument("--rows", type=int, default=10000)
+   p.add_argument("--requests", type=int, default=5000)
+   p.add_argument("--rounds", type=int, default=5)
+   p.set_defaults(func=bench_tracing)
+
+   p = sub.add_parser("streaming", help="time to first byte of /guide and /operator-profiles, buffered vs streamed")
+   p.add_argument("--model-latency", type=float, default=2.0, help="seconds the fake model takes for a full answer")
+   p.add_argument("--requests", type=int, default=5)
+   p.set_defaults(func=bench_streaming)
+
+   p = sub.add_parser("sampler", help="random /guide pairs: ORDER BY RANDOM() vs the in-memory sampler")
+   p.add_argument("--rows", type=int, default=1000000)
+   p.add_argument("--samples", type=int, default=100000)
+   p.add_argument("--requests", type=int, default=1000)
+   p.add_argument("--batch", type=int, default=1000)
+   p.set_defaults(func=bench_sampler)
+
+   p = sub.add_parser("import-time", help="cold import time of the service module, from python -X importtime")
+   p.add_argument("--runs", type=int, default=10)
+   p.add_argument("--top", type=int, default=8)
+   p.add_argument("--budget-ms", type=float, default=0, help="fail when the median import takes longer")
+   p.set_defaults(func=bench_import_time)
+
+   p = sub.add_parser("search", help="GET /stops/search latency, index write cost and PUT /stops served locally")
+   p.add_argument("--rows", type=int, default=1000000)
+   p.add_argument("--requests", type=int, default=500)
+   p.add_argument("--latency", type=float, default=0.05, help="seconds the stub takes to answer /locations")
+   p.set_defaults(func=bench_search)
+
+   p = sub.add_parser("load", help="throughput, latency percentiles and server RSS per endpoint, as JSON")
+   p.add_argument("--sizes", default="10000,100000", help="stops table sizes, seeded in turn")
+   p.add_argument("--concurrency", default="1,16,64", help="requests in flight, one run per level")
+   p.add_argument("--requests", type=int, default=500, help="requests per endpoint and concurrency level")
+   p.add_argument("--guide-requests", type=int, default=40, help="the same for /guide, which waits for the model")
+   p.add_argument("--endpoints", default=",".join(LOAD_ENDPOINTS))
+   p.add_argument("--server", choices=["sync", "async", "both"], default="sync")
+   p.add_argument("--fixtures", help="recorded upstream answers from record-fixtures (default: synthetic)")
+   p.add_argument("--latency", type=float, default=0.05, help="seconds the stub takes per upstream request")
+   p.add_argument("--model-latency", type=float, default=0.3)
+   p.add_argument("--seed", type=int, default=0)
+   p.add_argument("--out", help="write the report to this JSON file")
+   p.add_argument("--compare", help="report of an earlier run to compare with; exit status 1 on a regression")
+   p.add_argument("--threshold", type=float, default=0.1, help="relative change that counts as a regression")
+   p.set_defaults(func=bench_load)
+
+   p = sub.add_parser("load-compare", help="compare two load reports, exit status 1 on a regression")
+   p.add_argument("baseline")
+   p.add_argument("current")
+   p.add_argument("--threshold", type=float, default=0.1)
+   p.set_defaults(func=bench_load_compare)
+
+   p = sub.add_parser("record-fixtures", help="record live transport.rest answers for the load scenario")
+   p.add_argument("--out", required=True)
+   p.add_argument("--url", default=os.environ.get("TRANSPORT_REST_URL", "https://v6.db.transport.rest"))
+   p.add_argument("--query", action="append", help="location query to record, repeatable (default: 5 cities)")
+   p.add_argument("--stops", type=int, default=2, help="stops per query whose departures are recorded")
+   p.set_defaults(func=record_fixtures)
+
+   p = sub.add_parser("workers", help="req/s of prefork.py by worker count; fails when it does not scale")
+   p.add_argument("--workers", default="1,2,4", help="worker counts to run, the first is the baseline")
+   p.add_argument("--server", choices=["sync", "async"], default="sync")
+   p.add_argument("--rows", type=int, default=10000)
+   p.add_argument("--requests", type=int, default=5000)
+   p.add_argument("--concurrency", type=int, default=32)
+   p.add_argument("--clients", type=int, default=2, help="load generator processes")
+   p.add_argument("--latency", type=float, default=0.05)
+   p.add_argument("--min-scaling", type=float, default=0.6,
+                  help="share of linear scaling each worker count must reach where there are enough CPUs")
+   p.set_defaults(func=bench_workers)
+
+   p = sub.add_parser("_serve")
+   p.add_argument("kind", choices=["sync", "async"])
+   p.add_argument("--port", type=int, required=True)
+   p.add_argument("--workdir", required=True)
+   p.add_argument("--model-latency", type=float, default=0.0)
+   p.set_defaults(func=serve)
+
+   args = parser.parse_args()
+   args.func(args)
+
+
+if __name__ == "__main__":
+   main()
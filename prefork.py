@@ -0,0 +1,157 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Multi-process production server for the stops API in z5370300.py.
+
+`python z5370300.py` runs Flask's debug server: one process, with the
+reloader, on one core. This entry point imports the service once in a
+parent process, binds the listening socket and forks --workers copies of
+itself that all accept connections on it. Each worker serves with
+werkzeug's threaded WSGI server, or with async_server.py for --server
+async. The parent restarts workers that exit and stops them all on SIGTERM
+or SIGINT.
+
+Preloading runs the imports and the schema check before the fork, so
+workers start at once and share those pages copy-on-write; gc.freeze()
+keeps the garbage collector from writing to them. No SQLite connection is
+open at the fork.
+
+How the workers share state:
+
+   stops and jobs     the SQLite database in WAL mode. Write transactions begin
+                      IMMEDIATE under busy_timeout (see db_connection()), so
+                      writers in different processes queue on the write lock
+                      instead of failing with SQLITE_BUSY.
+   departures         a DiskCache in SHARED_CACHE_FILE behind each worker's
+                      in-memory cache: about one upstream call per stop and TTL
+                      in all, where workers that miss at the same moment may
+                      each make it.
+   Gemini answers     the operator_profiles and guides tables, as before.
+   stop documents     cached per worker; a counter in shared memory tells every
+                      worker to clear its cache when another one writes.
+
+The /guide pair sampler and the search vocabulary stay per worker and pick
+up other workers' writes at their next reload. /metrics reports on the
+worker that answers it, PREFETCH_RATE applies to each worker, and
+operator profiles and guides are single-flight only within one worker.
+
+Usage:
+
+   python prefork.py [--workers N] [--host 127.0.0.1] [--port 5000] [--server sync|async] [--access-log]
+
+WORKERS sets the default worker count (default: the number of CPUs).
+`python benchmark.py workers` measures how throughput scales with it.
+"""
+
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import z5370300 as service
+
+WORKERS = int(os.environ.get("WORKERS", os.cpu_count() or 1))
+RESTART_DELAY = 1.0     # seconds to wait before replacing a worker that died right after it started
+
+
+def preload(server):
+   # Everything done here is done once, in the parent, and inherited by the workers.
+   with service.db_pool.connection():
+      pass                                  # creates or migrates the schema
+   service.db_pool.close()                  # SQLite connections must not cross a fork
+   service.share_across_workers()
+   if server == "async":
+      import async_server                   # noqa: F401  (and aiohttp with it)
+   gc.freeze()
+
+
+def serve_worker(sock, args):
+   signal.signal(signal.SIGTERM, signal.SIG_DFL)
+   signal.signal(signal.SIGINT, signal.SIG_DFL)
+   if args.server == "async":
+      from aiohttp import web
+      import async_server
+      logs = {} if args.access_log else {"access_log": None}
+      web.run_app(async_server.make_app(), sock=sock, print=None, **logs)
+   else:
+      from werkzeug.serving import make_server
+      if not args.access_log:
+         logging.getLogger("werkzeug").setLevel(logging.ERROR)
+      make_server(args.host, args.port, service.app, threaded=True, fd=sock.fileno()).serve_forever()
+
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("--workers", type=int, default=WORKERS)
+   parser.add_argument("--host", default="127.0.0.1")
+   parser.add_argument("--port", type=int, default=5000)
+   parser.add_argument("--server", choices=["sync", "async"], default="sync")
+   parser.add_argument("--backlog", type=int, default=1024)
+   parser.add_argument("--access-log", action="store_true", help="log every request on stderr")
+   args = parser.parse_args(argv)
+   if args.workers < 1:
+      raise SystemExit("--workers must be at least 1")
+
+   sock = socket.create_server((args.host, args.port), backlog=args.backlog)
+   # every worker's select() wakes for a new connection; the ones that lose the
+   # accept() race get EAGAIN and go back to waiting instead of blocking in accept()
+   sock.setblocking(False)
+   preload(args.server)
+
+   workers = {}                             # pid -> monotonic start time
+   stopping = False
+
+   def spawn():
+      pid = os.fork()
+      if pid == 0:
+         code = 1
+         try:
+            serve_worker(sock, args)
+            code = 0
+         except BaseException:
+            traceback.print_exc()
+         finally:
+            os._exit(code)
+      workers[pid] = time.monotonic()
+
+   def stop(signum, frame):
+      nonlocal stopping
+      stopping = True
+      for pid in list(workers):
+         try:
+            os.kill(pid, signal.SIGTERM)
+         except ProcessLookupError:
+            pass
+
+   signal.signal(signal.SIGTERM, stop)
+   signal.signal(signal.SIGINT, stop)
+   for _ in range(args.workers):
+      spawn()
+   print(f"serving on http://{args.host}:{args.port} with {args.workers} {args.server} workers "
+         f"(parent pid {os.getpid()})", file=sys.stderr)
+
+   while workers:
+      try:
+         pid, status = os.wait()
+      except ChildProcessError:
+         break
+      started = workers.pop(pid, None)
+      if started is None or stopping:
+         continue
+      print(f"worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, starting a new one",
+            file=sys.stderr)
+      if time.monotonic() - started < RESTART_DELAY:
+         time.sleep(RESTART_DELAY)
+      if not stopping:
+         spawn()
+   sock.close()
+
+
+if __name__ == "__main__":
+   main()
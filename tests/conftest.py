@@ -0,0 +1,25 @@
+"""
+Shared fixtures: the service module, imported once in a scratch directory.
+"""
+
+import importlib
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def service(tmp_path_factory):
+   # db_file is a relative path, so every connection the tests open, and the database
+   # the first of them creates, lands in the scratch directory.
+   cwd = os.getcwd()
+   os.chdir(tmp_path_factory.mktemp("service"))
+   if HERE not in sys.path:
+      sys.path.insert(0, HERE)
+   try:
+      yield importlib.import_module("z5370300")
+   finally:
+      os.chdir(cwd)
@@ -0,0 +1,74 @@
+"""
+GET /guide jobs that outlive the request waiting for them.
+
+A request that gives up after GUIDE_WAIT answers 503, but its job must still
+run: the pair stays single-flight only while the job is alive, and a job that
+never runs would hand its dead id to every later request for the pair.
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+NOW = "2024-05-01-10:00:00"
+
+
+@pytest.fixture
+def guide_service(service, monkeypatch):
+   # two stops, one guide worker and a model that answers at once
+   with service.db_pool.connection() as cnx, cnx:
+      cnx.execute("DELETE FROM stops")
+      cnx.execute("DELETE FROM guides")
+   service.stop_cache.clear()
+   service.db_upsert_many([(1, NOW, "Alpha", 50.0, 10.0), (2, NOW, "Beta", 50.1, 10.1)])
+   executor = ThreadPoolExecutor(max_workers=1)
+   monkeypatch.setattr(service, "guide_executor", executor)
+   monkeypatch.setattr(service, "GUIDE_WAIT", 0.3)
+   monkeypatch.setattr(service, "generate_guide", lambda source, destination: f"{source} to {destination}")
+   yield service
+   executor.shutdown(wait=True)
+
+
+def wait_until_idle(service, timeout=5):
+   deadline = time.monotonic() + timeout
+   while service._guide_inflight and time.monotonic() < deadline:
+      time.sleep(0.01)
+   assert not service._guide_inflight
+
+
+def test_async_timeout_leaves_job_running(guide_service):
+   import async_server
+   from aiohttp.test_utils import TestClient, TestServer
+
+   # the only worker is busy, so the job of the first request is still queued when it times out
+   busy = threading.Event()
+   guide_service.guide_executor.submit(busy.wait, 5)
+
+   async def run():
+      async with TestClient(TestServer(async_server.make_app())) as client:
+         response = await client.get("/guide")
+         assert response.status == 503
+         busy.set()
+         await asyncio.to_thread(wait_until_idle, guide_service)
+         response = await client.get("/guide")
+         assert response.status == 200
+         assert (await response.text()).strip() in ("Alpha to Beta", "Beta to Alpha")
+
+   asyncio.run(run())
+
+
+def test_cancelled_job_is_replaced(guide_service):
+   busy = threading.Event()
+   guide_service.guide_executor.submit(busy.wait, 5)
+   job, future = guide_service.submit_guide_job(1, 2)
+   assert future.cancel()
+   busy.set()
+
+   retried, future = guide_service.submit_guide_job(1, 2)
+   assert retried["job_id"] != job["job_id"]
+   assert guide_service.guide_job_get(job["job_id"])["status"] == 'failed'
+   future.result(timeout=5)
+   assert guide_service.guide_job_get(retried["job_id"])["status"] == 'done'
@@ -0,0 +1,93 @@
+"""
+Link invalidation of the GET /stops/<id> document cache (StopDocumentCache).
+
+A cached document links to the previous and next stop, so every write must
+drop the documents whose links it moves, and a document loaded from the
+database before a write may not be stored after it.
+
+   python -m pytest tests
+"""
+
+import pytest
+
+FIELDS = ["name", "last_updated", "latitude", "longitude"]
+NOW = "2024-05-01-10:00:00"
+
+
+@pytest.fixture
+def stops(service):
+   # stops 10, 20, 30, 40 and 50, with every document cached
+   with service.db_pool.connection() as cnx, cnx:
+      cnx.execute("DELETE FROM stops")
+   service.stop_cache.clear()
+   service.db_upsert_many([(stop_id, NOW, f"Stop {stop_id}", 50.0, 10.0) for stop_id in (10, 20, 30, 40, 50)])
+   for stop_id in (10, 20, 30, 40, 50):
+      links(service, stop_id)
+   return service
+
+
+def links(service, stop_id):
+   # (prev, next) stop ids of the document GET /stops/<stop_id> would send, through the cache
+   found = service.cached_stop(stop_id, FIELDS, "localhost")
+   if found is None:
+      return None
+   document = found[3]
+   return tuple(int(document["_links"][rel]["href"].rsplit("/", 1)[1]) if rel in document["_links"] else None
+                for rel in ("prev", "next"))
+
+
+def test_insert_between_neighbours(stops):
+   stops.db_insert(25, NOW, "Stop 25", 50.0, 10.0)
+   assert links(stops, 20) == (10, 25)
+   assert links(stops, 25) == (20, 30)
+   assert links(stops, 30) == (25, 40)
+
+
+@pytest.mark.parametrize("deleted, neighbour, expected", [(10, 20, (None, 30)), (50, 40, (30, None))])
+def test_delete_first_or_last(stops, deleted, neighbour, expected):
+   stops.db_delete(deleted)
+   assert links(stops, deleted) is None
+   assert links(stops, neighbour) == expected
+
+
+def test_bulk_upsert_of_new_ids(stops):
+   stops.db_upsert_many([(15, NOW, "Stop 15", 50.0, 10.0), (60, NOW, "Stop 60", 50.0, 10.0),
+                         (30, NOW, "Renamed 30", 50.0, 10.0)])
+   assert links(stops, 10) == (None, 15)
+   assert links(stops, 20) == (15, 30)
+   assert links(stops, 50) == (40, 60)
+   assert links(stops, 60) == (50, None)
+   assert stops.cached_stop(30, FIELDS, "localhost")[3]["name"] == "Renamed 30"
+
+
+def test_patch(stops):
+   client = stops.app.test_client()
+   response = client.patch("/stops/30", json={"name": "Patched 30"})
+   assert response.status_code == 200
+   etag = response.headers["ETag"]
+   response = client.get("/stops/30?include=name")
+   assert response.get_json()["name"] == "Patched 30"
+   assert links(stops, 30) == (20, 40)
+   # the PATCH answer carries the tag of GET with every stored field, usable in If-Match and If-None-Match
+   response = client.get("/stops/30?include=name,latitude,longitude,last_updated", headers={"If-None-Match": etag})
+   assert response.status_code == 304
+   response = client.patch("/stops/30", json={"name": "Patched again"}, headers={"If-Match": etag})
+   assert response.status_code == 200
+
+
+def test_load_racing_a_write_is_not_stored(stops, monkeypatch):
+   stops.stop_cache.invalidate([20])
+   read = stops.db_read_with_neighbours
+
+   def read_then_write(stop_id):
+      # the insert commits after this read, before cached_stop stores what it read
+      found = read(stop_id)
+      stops.db_insert(25, NOW, "Stop 25", 50.0, 10.0)
+      return found
+
+   monkeypatch.setattr(stops, "db_read_with_neighbours", read_then_write)
+   rejected = stops.stop_cache.rejected
+   assert links(stops, 20) == (10, 30)     # the caller still gets what it read
+   assert stops.stop_cache.rejected == rejected + 1
+   monkeypatch.undo()
+   assert links(stops, 20) == (10, 25)
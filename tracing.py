@@ -0,0 +1,309 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Lightweight request tracing for the stops API.
+
+The servers open a trace for every request: Flask hooks in z5370300.py and
+a middleware in async_server.py. Code running under a request records spans
+with span() or the traced() decorator. Spans are named category.detail,
+e.g. db.read, upstream.departures or gemini.profile. Each span adds its
+time to the request's trace and to a global histogram per span name. When
+the request ends, its total time goes to a histogram per route, and the
+span totals per category are returned in a Server-Timing header:
+
+   Server-Timing: db;dur=0.41;desc="2 spans", upstream;dur=38.20;desc="1 span", total;dur=40.02
+
+Histograms have fixed log-scale buckets, so they take constant memory and
+report p50/p95/p99 within about 9%. metrics() returns them for /metrics.
+
+The trace lives in a contextvars.ContextVar. asyncio tasks and
+asyncio.to_thread carry it along; thread pools need contextvars.copy_context().
+
+Failures that are handled rather than raised, such as a departures prefetch
+or a guide job that did not work out, are reported with error(). It logs
+them on the "stops" logger and counts them per name for metrics().
+
+SamplingProfiler is an opt-in statistical profiler. It samples the stacks
+of all threads at a fixed interval and returns them as folded stacks, the
+input format of flamegraph.pl and speedscope.
+
+Configuration comes from the environment:
+
+   TRACING                   0 turns spans, histograms and Server-Timing off (default 1)
+   TRACE_PROFILER            1 starts the sampling profiler at import (default 0)
+   TRACE_PROFILER_INTERVAL   seconds between profiler samples (default 0.01)
+
+`python benchmark.py tracing` measures the overhead on GET /stops/<id>.
+A trace with its spans, histograms and header costs about 10 us, under 2%
+of an uncached GET /stops/<id> (about 0.5-0.7 ms through Flask). While the
+sampling profiler runs, requests are 20-30% slower, which is why it is
+off unless asked for.
+"""
+
+import contextvars
+import functools
+import logging
+import math
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+ENABLED = os.environ.get("TRACING", "1") != "0"
+PROFILER_INTERVAL = float(os.environ.get("TRACE_PROFILER_INTERVAL", 0.01))
+
+
+class Histogram:
+   """Latency histogram with log-scale buckets from 50 us to about 2 minutes."""
+
+   BASE = 50e-6
+   FACTOR = 2 ** 0.125
+   BUCKETS = 170
+
+   def __init__(self):
+      self.counts = [0] * (self.BUCKETS + 1)
+      self.count = 0
+      self.total = 0.0
+      self.max = 0.0
+      self._lock = threading.Lock()
+
+   def record(self, seconds):
+      if seconds <= self.BASE:
+         index = 0
+      else:
+         index = min(self.BUCKETS, int(math.log(seconds / self.BASE, self.FACTOR)) + 1)
+      with self._lock:
+         self.counts[index] += 1
+         self.count += 1
+         self.total += seconds
+         if seconds > self.max:
+            self.max = seconds
+
+   def _percentile(self, p):
+      # upper bound of the bucket holding the p-th sample, capped by the largest sample
+      rank = max(1, math.ceil(p * self.count))
+      seen = 0
+      for index, n in enumerate(self.counts):
+         seen += n
+         if seen >= rank:
+            return min(self.BASE * self.FACTOR ** index, self.max)
+      return self.max
+
+   def summary(self):
+      with self._lock:
+         if not self.count:
+            return {"count": 0}
+         return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3),
+            "p50_ms": round(self._percentile(0.50) * 1000, 3),
+            "p95_ms": round(self._percentile(0.95) * 1000, 3),
+            "p99_ms": round(self._percentile(0.99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+         }
+
+
+class Trace:
+   """Span totals of one request: name -> [count, seconds]."""
+
+   __slots__ = ("start", "spans", "_lock")
+
+   def __init__(self):
+      self.start = time.perf_counter()
+      self.spans = {}
+      self._lock = threading.Lock()
+
+   def add(self, name, seconds):
+      # spans of one request may finish on several threads, e.g. concurrent Gemini calls
+      with self._lock:
+         entry = self.spans.get(name)
+         if entry is None:
+            self.spans[name] = [1, seconds]
+         else:
+            entry[0] += 1
+            entry[1] += seconds
+
+
+_current = contextvars.ContextVar("trace", default=None)
+_routes = {}
+_spans = {}
+_errors = Counter()
+_lock = threading.Lock()
+logger = logging.getLogger("stops")
+
+
+def _histogram(table, name):
+   histogram = table.get(name)
+   if histogram is None:
+      with _lock:
+         histogram = table.setdefault(name, Histogram())
+   return histogram
+
+
+def record_span(name, seconds):
+   if not ENABLED:
+      return
+   _histogram(_spans, name).record(seconds)
+   trace = _current.get()
+   if trace is not None:
+      trace.add(name, seconds)
+
+
+class span:
+   """Context manager recording the time spent in its block as a span called name."""
+
+   __slots__ = ("name", "start")
+
+   def __init__(self, name):
+      self.name = name
+
+   def __enter__(self):
+      self.start = time.perf_counter() if ENABLED else None
+      return self
+
+   def __exit__(self, *exc):
+      if self.start is not None:
+         record_span(self.name, time.perf_counter() - self.start)
+      return False
+
+
+def traced(name):
+   """Decorator recording every call of the function as a span called name."""
+   def decorate(fn):
+      @functools.wraps(fn)
+      def wrapper(*args, **kwargs):
+         if not ENABLED:
+            return fn(*args, **kwargs)
+         start = time.perf_counter()
+         try:
+            return fn(*args, **kwargs)
+         finally:
+            record_span(name, time.perf_counter() - start)
+      return wrapper
+   return decorate
+
+
+def error(name, message, exc_info=False):
+   """Logs a handled failure of the operation called name and counts it for metrics().
+
+   Unlike spans, errors are reported with TRACING=0 too. Pass exc_info=True
+   from an except block to log the traceback of an unexpected exception.
+   """
+   with _lock:
+      _errors[name] += 1
+   logger.warning("%s: %s", name, message, exc_info=exc_info)
+
+
+def start_trace():
+   # returns a token for finish_trace, or None when tracing is off
+   if not ENABLED:
+      return None
+   return _current.set(Trace())
+
+
+def finish_trace(token, route):
+   # records the request under route and returns its Server-Timing header value
+   if token is None:
+      return None
+   trace = _current.get()
+   _current.reset(token)
+   elapsed = time.perf_counter() - trace.start
+   _histogram(_routes, route).record(elapsed)
+   return server_timing(trace, elapsed)
+
+
+def server_timing(trace, elapsed):
+   categories = {}
+   for name, (count, seconds) in trace.spans.items():
+      entry = categories.setdefault(name.split('.', 1)[0], [0, 0.0])
+      entry[0] += count
+      entry[1] += seconds
+   parts = [f'{category};dur={seconds * 1000:.2f};desc="{count} span{"s" if count != 1 else ""}"'
+            for category, (count, seconds) in categories.items()]
+   parts.append(f'total;dur={elapsed * 1000:.2f}')
+   return ', '.join(parts)
+
+
+def metrics():
+   """Per-route and per-span latency summaries and the error counts."""
+   with _lock:
+      routes = dict(_routes)
+      spans = dict(_spans)
+      errors = dict(sorted(_errors.items()))
+   return {
+      "enabled": ENABLED,
+      "routes": {name: histogram.summary() for name, histogram in sorted(routes.items())},
+      "spans": {name: histogram.summary() for name, histogram in sorted(spans.items())},
+      "errors": errors,
+   }
+
+
+def reset():
+   with _lock:
+      _routes.clear()
+      _spans.clear()
+      _errors.clear()
+
+
+class SamplingProfiler:
+   """Samples the Python stacks of all threads every interval seconds."""
+
+   def __init__(self, interval):
+      self.interval = interval
+      self.samples = 0
+      self._stacks = Counter()
+      self._lock = threading.Lock()
+      self._stop = None
+      self._thread = None
+
+   @property
+   def running(self):
+      return self._thread is not None and self._thread.is_alive()
+
+   def start(self):
+      with self._lock:
+         if self.running:
+            return
+         self._stop = threading.Event()
+         self._thread = threading.Thread(target=self._run, args=(self._stop,), name="sampling-profiler", daemon=True)
+         self._thread.start()
+
+   def stop(self):
+      with self._lock:
+         if self._stop is not None:
+            self._stop.set()
+         self._thread = None
+
+   def _run(self, stop):
+      me = threading.get_ident()
+      while not stop.wait(self.interval):
+         stacks = []
+         for ident, frame in sys._current_frames().items():
+            if ident == me:
+               continue
+            stack = []
+            while frame is not None:
+               code = frame.f_code
+               stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+               frame = frame.f_back
+            stacks.append(';'.join(reversed(stack)))
+         with self._lock:
+            self._stacks.update(stacks)
+            self.samples += 1
+
+   def folded(self):
+      # one "frame;frame;frame count" line per distinct stack, most frequent first
+      with self._lock:
+         return ''.join(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+
+   def clear(self):
+      with self._lock:
+         self._stacks.clear()
+         self.samples = 0
+
+
+profiler = SamplingProfiler(PROFILER_INTERVAL)
+if os.environ.get("TRACE_PROFILER", "0") == "1":
+   profiler.start()
@@ -0,0 +1,282 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Shared HTTP client for the upstream transport.rest API.
+
+All calls go through one pooled requests.Session, so keep-alive connections
+and TLS sessions are reused between requests. Every call has a connect and a
+read timeout. 5xx and 429 answers and network errors are retried a bounded
+number of times with jittered exponential backoff. A circuit breaker stops
+calling an upstream that keeps failing and makes callers fail fast with
+UpstreamUnavailable until a cool-down has passed.
+
+Configuration comes from the environment:
+
+   UPSTREAM_CONNECT_TIMEOUT   seconds to establish a connection (default 3)
+   UPSTREAM_READ_TIMEOUT      seconds to wait for a response (default 10)
+   UPSTREAM_RETRIES           retries after the first attempt (default 2)
+   UPSTREAM_BACKOFF           base backoff in seconds (default 0.2)
+   UPSTREAM_POOL_SIZE         keep-alive connections per host (default 20)
+   UPSTREAM_BREAKER_FAILURES  consecutive failures that open the breaker (default 5)
+   UPSTREAM_BREAKER_COOLDOWN  seconds the breaker stays open (default 30)
+"""
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import tracing
+
+CONNECT_TIMEOUT = float(os.environ.get("UPSTREAM_CONNECT_TIMEOUT", 3))
+READ_TIMEOUT = float(os.environ.get("UPSTREAM_READ_TIMEOUT", 10))
+RETRIES = int(os.environ.get("UPSTREAM_RETRIES", 2))
+BACKOFF = float(os.environ.get("UPSTREAM_BACKOFF", 0.2))
+POOL_SIZE = int(os.environ.get("UPSTREAM_POOL_SIZE", 20))
+BREAKER_FAILURES = int(os.environ.get("UPSTREAM_BREAKER_FAILURES", 5))
+BREAKER_COOLDOWN = float(os.environ.get("UPSTREAM_BREAKER_COOLDOWN", 30))
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class UpstreamUnavailable(Exception):
+   """The upstream could not be reached, kept failing, or the breaker is open."""
+
+
+class CircuitBreaker:
+   """Consecutive-failure circuit breaker with a single half-open probe."""
+
+   def __init__(self, failures, cooldown):
+      self.failures = failures
+      self.cooldown = cooldown
+      self._consecutive = 0
+      self._opened_at = None
+      self._probing = False
+      self._lock = threading.Lock()
+
+   def allow(self):
+      with self._lock:
+         if self._opened_at is None:
+            return True
+         if time.monotonic() - self._opened_at < self.cooldown or self._probing:
+            return False
+         # half-open: let one request through to test the upstream
+         self._probing = True
+         return True
+
+   def record_success(self):
+      with self._lock:
+         self._consecutive = 0
+         self._opened_at = None
+         self._probing = False
+
+   def release(self):
+      # the probe ended without an answer either way, e.g. it was cancelled
+      with self._lock:
+         self._probing = False
+
+   def record_failure(self):
+      with self._lock:
+         self._consecutive += 1
+         self._probing = False
+         if self._opened_at is not None or self._consecutive >= self.failures:
+            self._opened_at = time.monotonic()
+
+   @property
+   def state(self):
+      with self._lock:
+         if self._opened_at is None:
+            return "closed"
+         return "half-open" if time.monotonic() - self._opened_at >= self.cooldown else "open"
+
+
+class LatencyStats:
+   """Call count, error count and recent latency samples for one endpoint."""
+
+   def __init__(self, samples=1024):
+      self.count = 0
+      self.errors = 0
+      self.retries = 0
+      self.total = 0.0
+      self._samples = deque(maxlen=samples)
+
+   def record(self, elapsed, ok, retries):
+      self.count += 1
+      self.total += elapsed
+      self.retries += retries
+      if not ok:
+         self.errors += 1
+      self._samples.append(elapsed)
+
+   def summary(self):
+      samples = sorted(self._samples)
+
+      def percentile(p):
+         if not samples:
+            return None
+         return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 2)
+
+      return {
+         "count": self.count,
+         "errors": self.errors,
+         "retries": self.retries,
+         "mean_ms": round(self.total / self.count * 1000, 2) if self.count else None,
+         "p50_ms": percentile(0.50),
+         "p95_ms": percentile(0.95),
+         "p99_ms": percentile(0.99),
+      }
+
+
+def _new_session():
+   s = requests.Session()
+   adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+   s.mount("http://", adapter)
+   s.mount("https://", adapter)
+   return s
+
+
+session = _new_session()
+breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_COOLDOWN)
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _backoff(attempt, retry_after=None):
+   # retry_after is the Retry-After header of the last answer, honoured up to the largest backoff
+   if retry_after and retry_after.isdigit():
+      return min(float(retry_after), BACKOFF * 2 ** RETRIES)
+   # full jitter: anywhere between 0 and the exponential ceiling
+   return random.uniform(0, BACKOFF * 2 ** attempt)
+
+
+def get(url, endpoint="default", **kwargs):
+   """GET url through the shared session and return the response.
+
+   Raises UpstreamUnavailable when the breaker is open or when every attempt
+   ended in a network error, a timeout, or a retryable status code.
+   """
+   if not breaker.allow():
+      raise UpstreamUnavailable(f"circuit open for {endpoint}")
+   with tracing.span(f"upstream.{endpoint}"):
+      return _guarded(_get, url, endpoint, **kwargs)
+
+
+def _guarded(fn, *args, **kwargs):
+   # Runs fn, which records its own outcome, and records a failure when it raises anything
+   # else, so an unexpected error during the half-open probe cannot leave the breaker
+   # refusing every call.
+   try:
+      return fn(*args, **kwargs)
+   except UpstreamUnavailable:
+      raise
+   except Exception:
+      breaker.record_failure()
+      raise
+   except BaseException:
+      breaker.release()
+      raise
+
+
+def _get(url, endpoint, **kwargs):
+   kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+   start = time.perf_counter()
+   response = None
+   error = None
+   for attempt in range(RETRIES + 1):
+      if attempt:
+         time.sleep(_backoff(attempt - 1, response.headers.get("Retry-After") if response is not None else None))
+      try:
+         response = session.get(url, **kwargs)
+         error = None
+      except requests.RequestException as e:
+         response = None
+         error = e
+         continue
+      if response.status_code not in RETRY_STATUS:
+         break
+
+   ok = error is None and response.status_code not in RETRY_STATUS
+   with _stats_lock:
+      _stats.setdefault(endpoint, LatencyStats()).record(time.perf_counter() - start, ok, attempt)
+   if not ok:
+      breaker.record_failure()
+      reason = error if error is not None else f"status {response.status_code}"
+      raise UpstreamUnavailable(f"{endpoint} failed after {attempt + 1} attempts: {reason}")
+   breaker.record_success()
+   return response
+
+
+async def get_json_async(client, url, endpoint="default", params=None):
+   """aiohttp counterpart of get() for the async server.
+
+   client is an aiohttp.ClientSession. Returns (status, payload, size) where
+   payload is the decoded JSON body for a 200 answer and None otherwise.
+   Shares the circuit breaker and the metrics with get().
+   """
+   if not breaker.allow():
+      raise UpstreamUnavailable(f"circuit open for {endpoint}")
+   with tracing.span(f"upstream.{endpoint}"):
+      try:
+         return await _get_json_async(client, url, endpoint, params)
+      except UpstreamUnavailable:
+         raise
+      except Exception:
+         # as in _guarded(); a cancelled request only gives up the half-open probe
+         breaker.record_failure()
+         raise
+      except BaseException:
+         breaker.release()
+         raise
+
+
+async def _get_json_async(client, url, endpoint, params):
+   import aiohttp
+
+   timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+   start = time.perf_counter()
+   status = None
+   retry_after = None
+   error = None
+   for attempt in range(RETRIES + 1):
+      if attempt:
+         await asyncio.sleep(_backoff(attempt - 1, retry_after))
+      try:
+         async with client.get(url, params=params, timeout=timeout) as response:
+            status = response.status
+            retry_after = response.headers.get("Retry-After")
+            body = await response.read()
+         error = None
+      except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+         status = retry_after = None
+         error = e
+         continue
+      if status not in RETRY_STATUS:
+         break
+
+   ok = error is None and status not in RETRY_STATUS
+   with _stats_lock:
+      _stats.setdefault(endpoint, LatencyStats()).record(time.perf_counter() - start, ok, attempt)
+   if not ok:
+      breaker.record_failure()
+      reason = error if error is not None else f"status {status}"
+      raise UpstreamUnavailable(f"{endpoint} failed after {attempt + 1} attempts: {reason}")
+   breaker.record_success()
+   try:
+      payload = json.loads(body) if status == 200 else None
+   except ValueError as e:
+      raise UpstreamUnavailable(f"{endpoint} answered with a body that is not JSON: {e}") from e
+   return status, payload, len(body)
+
+
+def metrics():
+   """Per-endpoint latency summary plus the breaker state."""
+   with _stats_lock:
+      endpoints = {name: stats.summary() for name, stats in _stats.items()}
+   return {"breaker": breaker.state, "endpoints": endpoints}
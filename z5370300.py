@@ -68,25 +68,66 @@ page.
 
 # You can import more modules from the standard library here if you need them
 # (which you will, e.g. sqlite3).
+import argparse
+import codecs
+import contextvars
+import hashlib
+import json
+import math
 import os
+import queue
+import re
+import sys
+import threading
+import time
+import unicodedata
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from difflib import SequenceMatcher
+from email.utils import format_datetime, parsedate_to_datetime
 from pathlib import Path
+from urllib.parse import quote
 
 # You can import more third-party packages here if you need them, provided
 # that they've been used in the weekly labs, or specified in this assignment,
 # and their versions match.
 from dotenv import load_dotenv          # Needed to load the environment variables from the .env file
-import google.generativeai as genai     # Needed to access the Generative AI API
-from flask import Flask, request,send_file
-from flask_restx import Resource, Api,reqparse, fields
+from flask import Flask, Response, g, request,send_file
+from flask_restx import Resource, Api,reqparse, fields, inputs
+from flask_restx.representations import output_json as restx_output_json
 import requests
+import upstream                         # Shared HTTP client for transport.rest
+import tracing                          # Spans, latency histograms and Server-Timing
+from upstream import UpstreamUnavailable
 from datetime import datetime
 import sqlite3
-from pandas.io import sql
-import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta, timezone
 
 app = Flask(__name__)
 api = Api(app, title = 'A smart API for the Deutsche Bahn')
+
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+   # flask-restx's JSON output, timed as the serialize span
+   with tracing.span("serialize.json"):
+      return restx_output_json(data, code, headers)
+
+@app.before_request
+def start_request_trace():
+   g.trace = tracing.start_trace()
+
+@app.after_request
+def finish_request_trace(response):
+   route = request.url_rule.rule if request.url_rule else "unmatched"
+   timing = tracing.finish_trace(g.pop('trace', None), f"{request.method} {route}")
+   if timing:
+      response.headers["Server-Timing"] = timing
+   return response
+
 indicator_model = api.model('Q5payload',{
         'name': fields.String(description='The name of the stop'),
         'latitude': fields.Float(description='Latitude of the stop'),
@@ -94,6 +135,9 @@ indicator_model = api.model('Q5payload',{
         'last_updated': fields.String(description='The last update time in yyyy-mm-dd-hh:mm:ss format', required=False),
         'next_departure': fields.String(description='Next departure details')
     })
+bulk_patch_model = api.inherit('BulkPatchItem', indicator_model, {
+        'stop_id': fields.Integer(description='The stop to update', required=True),
+    })
 studentid = Path(__file__).stem         # Will capture your zID from the filename.
 db_file   = f"{studentid}.db"           # Use this variable when referencing the SQLite database file.
 txt_file  = f"{studentid}.txt"          # Use this variable when referencing the txt file for Q7.
@@ -102,26 +146,498 @@ txt_file  = f"{studentid}.txt"          # Use this variable when referencing the
 # Load the environment variables from the .env file
 load_dotenv('.env')
 
-# Configure the API key
-genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
+class LazyModel:
+   """Gemini model that is configured and built on first use.
+
+   Importing google.generativeai takes longer than the rest of this module,
+   so it is deferred until a request needs the model. This also means the
+   module can be imported without GOOGLE_API_KEY; the key is only checked
+   when the model is first used.
+   """
+
+   def __init__(self, name):
+      self.name = name
+      self._model = None
+      self._lock = threading.Lock()
+
+   def _load(self):
+      with self._lock:
+         if self._model is None:
+            api_key = os.environ.get("GOOGLE_API_KEY")
+            if not api_key:
+               raise RuntimeError("GOOGLE_API_KEY is not set")
+            import google.generativeai as genai     # Needed to access the Generative AI API
+            # Configure the API key
+            genai.configure(api_key=api_key)
+            self._model = genai.GenerativeModel(self.name)
+      return self._model
+
+   def __getattr__(self, attr):
+      return getattr(self._model or self._load(), attr)
 
 # Create a Gemini Pro model
-gemini = genai.GenerativeModel('gemini-pro')
+gemini = LazyModel('gemini-pro')
 
 parser_query = reqparse.RequestParser()
 parser_query.add_argument("query")
+parser_query.add_argument("max_age", type=float, help="Answer from the stored stops when every stop matching "
+                                                      "query was updated at most this many seconds ago")
 parser_query2 = reqparse.RequestParser()
 parser_query2.add_argument("include")
+parser_list = reqparse.RequestParser()
+parser_list.add_argument("after", type=int, help="Return stops with a stop_id greater than this cursor")
+parser_list.add_argument("before", type=int, help="Return stops with a stop_id smaller than this cursor")
+parser_list.add_argument("limit", type=int, default=20, help="Page size, 1 to 1000")
+parser_list.add_argument("name", help="Only stops whose name starts with this prefix (case-sensitive)")
+parser_list.add_argument("include")
+parser_search = reqparse.RequestParser()
+parser_search.add_argument("q", required=True, help="Words of the stop name, possibly partly typed or misspelt")
+parser_search.add_argument("limit", type=int, default=10, help="Maximum number of stops, 1 to 50")
+parser_nearby = reqparse.RequestParser()
+parser_nearby.add_argument("lat", type=float, required=True, help="Latitude of the search centre")
+parser_nearby.add_argument("lon", type=float, required=True, help="Longitude of the search centre")
+parser_nearby.add_argument("radius", type=float, default=1000, help="Search radius in metres, at most 100000")
+parser_nearby.add_argument("k", type=int, default=10, help="Maximum number of stops, 1 to 100")
+
+parser_stream = reqparse.RequestParser()
+parser_stream.add_argument("stream", type=inputs.boolean, default=False,
+                           help="true sends the model output as it is generated, as Server-Sent Events")
+
+parser_pair = reqparse.RequestParser()
+parser_pair.add_argument("pair", choices=("uniform", "popular", "nearby"), default="uniform",
+                         help="How a random pair is drawn: uniform, popular (weighted by stop reads) "
+                              "or nearby (destination within radius of the source)")
+parser_pair.add_argument("radius", type=float, help="Radius in metres for pair=nearby, at most 100000 (default 50000)")
+parser_guide = parser_pair.copy()
+parser_guide.add_argument("source", type=int, help="stop_id of the source stop")
+parser_guide.add_argument("destination", type=int, help="stop_id of the destination stop")
+parser_guide_get = parser_pair.copy()
+parser_guide_get.add_argument("stream", type=inputs.boolean, default=False,
+                              help="true sends the model output as it is generated, as Server-Sent Events")
+
+parser_profiler = reqparse.RequestParser()
+parser_profiler.add_argument("enabled", type=inputs.boolean, required=True, help="true starts the sampling profiler, false stops it")
+
+# Connection pool settings, overridable from the environment.
+# DB_POOL_SIZE=0 disables pooling and opens a new connection for every call.
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 8))
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", 5000))
+DB_STATEMENT_CACHE = int(os.environ.get("DB_STATEMENT_CACHE", 256))
 
 def db_connection():
-   cnx = sqlite3.connect(db_file)
+   # check_same_thread=False because pooled connections move between worker threads,
+   # but only one thread holds a connection at a time. Write transactions start with
+   # BEGIN IMMEDIATE: they wait for the write lock up front, under busy_timeout, instead
+   # of failing with SQLITE_BUSY when a read inside them has to become a write while
+   # another connection (or worker process) writes.
+   cnx = sqlite3.connect(db_file, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level="IMMEDIATE",
+                         check_same_thread=False, cached_statements=DB_STATEMENT_CACHE)
+   try:
+      cnx.execute('PRAGMA journal_mode=WAL')
+      cnx.execute('PRAGMA synchronous=NORMAL')
+      cnx.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+      cnx.execute('PRAGMA cache_size=-16000')
+      cnx.execute('PRAGMA temp_store=MEMORY')
+      cnx.execute('PRAGMA mmap_size=268435456')
+      if not _schema_ready:
+         init(cnx)
+   except BaseException:
+      cnx.close()
+      raise
    return cnx
 
-def init():
-   cnx = db_connection()
-   # create db_file in current dir
-   cursor = cnx.cursor()
-   
+class ConnectionPool:
+   """Bounded pool of SQLite connections shared by all request threads.
+
+   Connections are kept open so sqlite3's per-connection statement cache is
+   reused across requests. When all connections are checked out, callers
+   block until one is returned.
+   """
+
+   def __init__(self, size):
+      self.size = size
+      self._idle = queue.LifoQueue(maxsize=size) if size > 0 else None
+      self._created = 0
+      self._lock = threading.Lock()
+
+   def _acquire(self):
+      try:
+         return self._idle.get_nowait()
+      except queue.Empty:
+         pass
+      with self._lock:
+         if self._created < self.size:
+            self._created += 1
+            try:
+               return db_connection()
+            except BaseException:
+               # a connection that was never made must not count against the pool
+               self._created -= 1
+               raise
+      return self._idle.get()
+
+   @contextmanager
+   def connection(self):
+      if self._idle is None:
+         cnx = db_connection()
+         try:
+            yield cnx
+         finally:
+            cnx.close()
+         return
+      cnx = self._acquire()
+      try:
+         yield cnx
+      finally:
+         if cnx.in_transaction:
+            cnx.rollback()
+         self._idle.put(cnx)
+
+   def close(self):
+      if self._idle is None:
+         return
+      while True:
+         try:
+            self._idle.get_nowait().close()
+         except queue.Empty:
+            break
+      with self._lock:
+         self._created = 0
+
+db_pool = ConnectionPool(DB_POOL_SIZE)
+
+# Upstream transport.rest API. Point TRANSPORT_REST_URL at a local stub for testing.
+TRANSPORT_REST_URL = os.environ.get("TRANSPORT_REST_URL", "https://v6.db.transport.rest").rstrip('/')
+DEPARTURES_TTL = float(os.environ.get("DEPARTURES_TTL", 30))
+DEPARTURES_CACHE_BYTES = int(os.environ.get("DEPARTURES_CACHE_BYTES", 32 * 1024 * 1024))
+DEPARTURES_CHUNK_SIZE = 16 * 1024
+# on-disk cache that worker processes share, see share_across_workers()
+SHARED_CACHE_FILE = os.environ.get("SHARED_CACHE_FILE", f"{studentid}_cache.db")
+SHARED_CACHE_PURGE_EVERY = 1000         # writes between sweeps of expired entries
+
+class _Flight:
+   # one in-progress load that concurrent callers for the same key wait on
+   def __init__(self):
+      self.event = threading.Event()
+      self.value = None
+      self.error = None
+
+class DiskCache:
+   """TTL cache of JSON values in its own SQLite file, shared by every process that opens it.
+
+   Each thread of each process has its own connection, opened on first use,
+   so a forked worker never uses a connection of its parent. The file is
+   separate from db_file so cache writes do not queue behind writes to the
+   stops table. Expired entries are skipped on read and deleted every
+   SHARED_CACHE_PURGE_EVERY writes. A database error counts as a miss, or a
+   skipped write: the cache can only make a request faster, never fail it.
+   """
+
+   def __init__(self, path):
+      self.path = path
+      self._local = threading.local()
+      self._lock = threading.Lock()
+      self.hits = 0
+      self.misses = 0
+      self.writes = 0
+      self.errors = 0
+
+   def open(self):
+      cnx = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000, isolation_level=None)
+      cnx.execute('PRAGMA journal_mode=WAL')
+      cnx.execute('PRAGMA synchronous=NORMAL')
+      cnx.execute('CREATE TABLE IF NOT EXISTS cache (key PRIMARY KEY, value TEXT NOT NULL, '
+                  'expires_at REAL NOT NULL) WITHOUT ROWID')
+      return cnx
+
+   def _connection(self):
+      local = self._local
+      if getattr(local, "pid", None) != os.getpid():
+         local.cnx, local.pid = self.open(), os.getpid()
+      return local.cnx
+
+   def _count(self, counter):
+      with self._lock:
+         setattr(self, counter, getattr(self, counter) + 1)
+         return getattr(self, counter)
+
+   @tracing.traced("db.shared_cache_get")
+   def get(self, key):
+      # (value, size of its JSON, seconds it stays fresh), or None
+      try:
+         row = self._connection().execute('SELECT value, expires_at FROM cache WHERE key = ? AND expires_at > ?',
+                                          (key, time.time())).fetchone()
+      except sqlite3.Error:
+         self._count("errors")
+         return None
+      if row is None:
+         self._count("misses")
+         return None
+      self._count("hits")
+      return json.loads(row[0]), len(row[0]), row[1] - time.time()
+
+   @tracing.traced("db.shared_cache_put")
+   def put(self, key, value, ttl):
+      text = json.dumps(value)
+      now = time.time()
+      try:
+         cnx = self._connection()
+         cnx.execute('INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)', (key, text, now + ttl))
+         if self._count("writes") % SHARED_CACHE_PURGE_EVERY == 0:
+            cnx.execute('DELETE FROM cache WHERE expires_at <= ?', (now,))
+      except sqlite3.Error:
+         self._count("errors")
+
+   def stats(self):
+      with self._lock:
+         return {"hits": self.hits, "misses": self.misses, "writes": self.writes, "errors": self.errors}
+
+class DeparturesCache:
+   """In-process TTL + LRU cache for upstream departures payloads.
+
+   The cache is bounded by the total size of the cached response bodies.
+   Concurrent misses for the same key are collapsed into one loader call
+   (single flight); the other callers wait for and share its result.
+   With a shared_store (a DiskCache, set by share_across_workers()) a miss
+   is looked up there before the loader runs, and loaded values are written
+   to it, so worker processes make one upstream call per stop and TTL
+   between them rather than one each.
+   """
+
+   def __init__(self, ttl, max_bytes):
+      self.ttl = ttl
+      self.max_bytes = max_bytes
+      self.shared_store = None
+      self._entries = OrderedDict()     # key -> (expires_at, size, value)
+      self._bytes = 0
+      self._inflight = {}
+      self._lock = threading.Lock()
+      self.hits = 0
+      self.misses = 0
+      self.shared = 0
+      self.evictions = 0
+
+   def get(self, key, loader):
+      # loader() returns (value, size_in_bytes); a value of None is passed on but not cached
+      with self._lock:
+         entry = self._entries.get(key)
+         if entry is not None:
+            if entry[0] > time.monotonic():
+               self._entries.move_to_end(key)
+               self.hits += 1
+               return entry[2]
+            self._remove(key)
+         flight = self._inflight.get(key)
+         leader = flight is None
+         if leader:
+            flight = self._inflight[key] = _Flight()
+            self.misses += 1
+         else:
+            self.shared += 1
+
+      if not leader:
+         flight.event.wait()
+         if flight.error is not None:
+            raise flight.error
+         return flight.value
+
+      try:
+         value = self.load_shared(key) if self.shared_store is not None else None
+         if value is None:
+            value, size = loader()
+            self.put(key, value, size)
+         flight.value = value
+         return value
+      except Exception as e:
+         flight.error = e
+         raise
+      finally:
+         with self._lock:
+            del self._inflight[key]
+         flight.event.set()
+
+   def peek(self, key):
+      # fresh cached value or None, for callers that load asynchronously
+      with self._lock:
+         entry = self._entries.get(key)
+         if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+         self.misses += 1
+         return None
+
+   def load_shared(self, key):
+      # value another process stored in shared_store, kept here for the rest of its TTL; or None
+      found = self.shared_store.get(key)
+      if found is None:
+         return None
+      value, size, ttl = found
+      self._store(key, value, size, ttl)
+      return value
+
+   def put(self, key, value, size):
+      if value is not None and self.ttl > 0:
+         self._store(key, value, size)
+         if self.shared_store is not None:
+            self.shared_store.put(key, value, self.ttl)
+
+   def _store(self, key, value, size, ttl=None):
+      if size > self.max_bytes:
+         return
+      with self._lock:
+         if key in self._entries:
+            self._remove(key)
+         self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), size, value)
+         self._bytes += size
+         while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+   def _remove(self, key):
+      _, size, _ = self._entries.pop(key)
+      self._bytes -= size
+
+   def clear(self):
+      with self._lock:
+         self._entries.clear()
+         self._bytes = 0
+
+   def stats(self):
+      with self._lock:
+         stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+         }
+      if self.shared_store is not None:
+         stats["shared_store"] = self.shared_store.stats()
+      return stats
+
+departures_cache = DeparturesCache(DEPARTURES_TTL, DEPARTURES_CACHE_BYTES)
+
+def fetch_departures(stop_id):
+   # departures payload for stop_id, or None when the upstream did not answer 200
+   def load():
+      response = upstream.get(f'{TRANSPORT_REST_URL}/stops/{stop_id}/departures', endpoint="departures")
+      if response.status_code != 200:
+         return None, 0
+      try:
+         return response.json(), len(response.content)
+      except ValueError as e:
+         raise UpstreamUnavailable(f"departures of {stop_id} unreadable: {e}") from e
+   return departures_cache.get(stop_id, load)
+
+SPATIAL_TRIGGERS = [
+   '''CREATE TRIGGER IF NOT EXISTS stops_rtree_insert AFTER INSERT ON stops BEGIN
+         INSERT OR REPLACE INTO stops_rtree VALUES (new.stop_id, new.latitude, new.latitude, new.longitude, new.longitude);
+      END''',
+   '''CREATE TRIGGER IF NOT EXISTS stops_rtree_update AFTER UPDATE OF stop_id, latitude, longitude ON stops BEGIN
+         DELETE FROM stops_rtree WHERE id = old.stop_id;
+         INSERT OR REPLACE INTO stops_rtree VALUES (new.stop_id, new.latitude, new.latitude, new.longitude, new.longitude);
+      END''',
+   '''CREATE TRIGGER IF NOT EXISTS stops_rtree_delete AFTER DELETE ON stops BEGIN
+         DELETE FROM stops_rtree WHERE id = old.stop_id;
+      END''',
+]
+
+def init_spatial_index(cnx):
+   # R*Tree over stop coordinates for GET /stops/nearby, kept in sync with stops by triggers
+   exists = cnx.execute("SELECT 1 FROM sqlite_master WHERE name = 'stops_rtree'").fetchone()
+   cnx.execute('CREATE VIRTUAL TABLE IF NOT EXISTS stops_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+   for trigger in SPATIAL_TRIGGERS:
+      cnx.execute(trigger)
+   if not exists:
+      # index the stops stored before the R*Tree existed
+      cnx.execute('INSERT INTO stops_rtree SELECT stop_id, latitude, latitude, longitude, longitude FROM stops')
+
+# Full-text index over stop names for GET /stops/search, keyed by stop_id as rowid.
+# The triggers delete before inserting so INSERT OR REPLACE into stops stays in sync.
+SEARCH_TRIGGERS = [
+   '''CREATE TRIGGER IF NOT EXISTS stops_search_insert AFTER INSERT ON stops BEGIN
+         DELETE FROM stops_fts WHERE rowid = new.stop_id;
+         INSERT INTO stops_fts (rowid, name) VALUES (new.stop_id, new.name);
+      END''',
+   # upserts rewrite every column; only a changed name needs reindexing
+   '''CREATE TRIGGER IF NOT EXISTS stops_search_update AFTER UPDATE OF stop_id, name ON stops
+         WHEN old.stop_id != new.stop_id OR old.name IS NOT new.name BEGIN
+         DELETE FROM stops_fts WHERE rowid = old.stop_id;
+         INSERT INTO stops_fts (rowid, name) VALUES (new.stop_id, new.name);
+      END''',
+   '''CREATE TRIGGER IF NOT EXISTS stops_search_delete AFTER DELETE ON stops BEGIN
+         DELETE FROM stops_fts WHERE rowid = old.stop_id;
+      END''',
+]
+
+def init_search_index(cnx):
+   exists = cnx.execute("SELECT 1 FROM sqlite_master WHERE name = 'stops_fts'").fetchone()
+   cnx.execute("CREATE VIRTUAL TABLE IF NOT EXISTS stops_fts USING fts5(name, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')")
+   # the indexed words, read by SearchVocabulary
+   cnx.execute("CREATE VIRTUAL TABLE IF NOT EXISTS stops_fts_terms USING fts5vocab(stops_fts, 'row')")
+   for trigger in SEARCH_TRIGGERS:
+      cnx.execute(trigger)
+   if not exists:
+      # index the stops stored before the search index existed
+      cnx.execute('INSERT INTO stops_fts (rowid, name) SELECT stop_id, name FROM stops')
+
+# Time of the last change to each stop, kept by the server for Last-Modified: last_updated
+# is written by clients and may go backwards. Seconds since the epoch, to the millisecond.
+# A stop's document links to its neighbours, so inserting or deleting a stop also
+# modifies the stops on either side of it.
+MODIFIED_NOW = "(julianday('now') - 2440587.5) * 86400.0"
+
+def _touch_neighbours(row):
+   return f'''UPDATE stops_modified SET modified_at = {MODIFIED_NOW}
+         WHERE stop_id IN ((SELECT MAX(stop_id) FROM stops WHERE stop_id < {row}.stop_id),
+                           (SELECT MIN(stop_id) FROM stops WHERE stop_id > {row}.stop_id));'''
+
+MODIFIED_TRIGGERS = [
+   f'''CREATE TRIGGER IF NOT EXISTS stops_modified_insert AFTER INSERT ON stops BEGIN
+         INSERT OR REPLACE INTO stops_modified VALUES (new.stop_id, {MODIFIED_NOW});
+         {_touch_neighbours('new')}
+      END''',
+   # upserts rewrite every column; only a real change counts
+   f'''CREATE TRIGGER IF NOT EXISTS stops_modified_update AFTER UPDATE ON stops
+         WHEN old.stop_id != new.stop_id OR old.last_updated IS NOT new.last_updated OR old.name IS NOT new.name
+            OR old.latitude IS NOT new.latitude OR old.longitude IS NOT new.longitude BEGIN
+         DELETE FROM stops_modified WHERE stop_id = old.stop_id;
+         INSERT OR REPLACE INTO stops_modified VALUES (new.stop_id, {MODIFIED_NOW});
+      END''',
+   f'''CREATE TRIGGER IF NOT EXISTS stops_modified_delete AFTER DELETE ON stops BEGIN
+         DELETE FROM stops_modified WHERE stop_id = old.stop_id;
+         {_touch_neighbours('old')}
+      END''',
+]
+
+def init_modified_times(cnx):
+   exists = cnx.execute("SELECT 1 FROM sqlite_master WHERE name = 'stops_modified'").fetchone()
+   cnx.execute('CREATE TABLE IF NOT EXISTS stops_modified (stop_id INTEGER PRIMARY KEY, modified_at REAL NOT NULL)')
+   for trigger in MODIFIED_TRIGGERS:
+      cnx.execute(trigger)
+   if not exists:
+      # stops stored before the table existed count as modified now
+      cnx.execute(f'INSERT INTO stops_modified SELECT stop_id, {MODIFIED_NOW} FROM stops')
+
+# Bumped whenever init() changes the schema. Databases that already carry this
+# user_version skip the DDL, so a process only reads one pragma at start-up.
+SCHEMA_VERSION = 3
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+def init(cnx):
+   # Creates the schema on the first connection a process opens, see db_connection()
+   global _schema_ready
+   with _schema_lock:
+      if _schema_ready:
+         return
+      if cnx.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+         create_schema(cnx)
+      _schema_ready = True
+
+def create_schema(cnx):
    create_table_query = '''
       CREATE TABLE IF NOT EXISTS stops (
          stop_id INTEGER PRIMARY KEY,
@@ -131,83 +647,926 @@ def init():
          longitude REAL NOT NULL
       );
       '''
-   # Use the cursor to execute the SQL statement.
-   cursor.execute(create_table_query)
-   # Commit changes
-   cnx.commit()
-   cnx.close()
-  
+   # cache of Gemini operator descriptions, see get_operator_profile()
+   create_profiles_query = '''
+      CREATE TABLE IF NOT EXISTS operator_profiles (
+         operator_name TEXT PRIMARY KEY,
+         information TEXT NOT NULL,
+         created_at REAL NOT NULL,
+         last_used REAL NOT NULL
+      );
+      '''
+   # generated tourism guides by (source, destination) stop names, and the /guide jobs
+   create_guides_query = '''
+      CREATE TABLE IF NOT EXISTS guides (
+         source TEXT NOT NULL,
+         destination TEXT NOT NULL,
+         information TEXT NOT NULL,
+         created_at REAL NOT NULL,
+         PRIMARY KEY (source, destination)
+      );
+      '''
+   create_guide_jobs_query = '''
+      CREATE TABLE IF NOT EXISTS guide_jobs (
+         job_id TEXT PRIMARY KEY,
+         source_id INTEGER NOT NULL,
+         destination_id INTEGER NOT NULL,
+         source TEXT NOT NULL,
+         destination TEXT NOT NULL,
+         status TEXT NOT NULL,
+         error TEXT,
+         created_at REAL NOT NULL,
+         finished_at REAL
+      );
+      '''
+   # create db_file in current dir; the write lock keeps processes starting together
+   # from filling the R*Tree twice
+   with cnx:
+      cnx.execute('BEGIN IMMEDIATE')
+      if cnx.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+         return
+      cnx.execute(create_table_query)
+      cnx.execute(create_profiles_query)
+      cnx.execute(create_guides_query)
+      cnx.execute(create_guide_jobs_query)
+      cnx.execute('CREATE INDEX IF NOT EXISTS guide_jobs_created_at ON guide_jobs (created_at)')
+      cnx.execute('CREATE INDEX IF NOT EXISTS operator_profiles_last_used ON operator_profiles (last_used)')
+      # name-prefix filtering for GET /stops
+      cnx.execute('CREATE INDEX IF NOT EXISTS stops_name ON stops (name)')
+      init_spatial_index(cnx)
+      init_search_index(cnx)
+      init_modified_times(cnx)
+      cnx.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+
+
+
+STOP_CACHE_ENTRIES = int(os.environ.get("STOP_CACHE_ENTRIES", 10000))
+
+class StopDocumentCache:
+   """LRU cache of assembled GET /stops/<id> documents.
+
+   Keys are (stop_id, include set, host); values are (details, prev_stop_id,
+   next_stop_id, document, modified_at). The write helpers below invalidate every stop
+   whose document a write changes: the written stops, and for inserts and
+   deletes the stops on either side, whose prev/next links move. A write
+   also bumps a generation counter after it commits; a reader that loaded
+   from the database before that may not store its result, so a read that
+   raced a write can never put the old links back.
+
+   Writes made by other worker processes are seen through shared_writes, a
+   counter in shared memory set by share_across_workers(). Every invalidate()
+   increments it; a process that finds it moved by someone else clears its
+   whole cache, as it cannot tell which stops changed.
+   """
+
+   def __init__(self, max_entries):
+      self.max_entries = max_entries
+      self.generation = 0
+      self.shared_writes = None
+      self._seen_writes = 0
+      self._entries = OrderedDict()
+      self._keys = {}                   # stop_id -> keys cached for it
+      self._lock = threading.Lock()
+      self.hits = 0
+      self.misses = 0
+      self.rejected = 0
+      self.invalidations = 0
+      self.evictions = 0
+
+   def _sync(self):
+      # clears the cache after writes of other processes; called with self._lock held
+      if self.shared_writes is not None and self.shared_writes.value != self._seen_writes:
+         self._seen_writes = self.shared_writes.value
+         self.generation += 1
+         self._entries.clear()
+         self._keys.clear()
+
+   def get(self, key):
+      with self._lock:
+         self._sync()
+         entry = self._entries.get(key)
+         if entry is None:
+            self.misses += 1
+            return None
+         self._entries.move_to_end(key)
+         self.hits += 1
+         return entry
+
+   def put(self, key, value, generation):
+      # generation is the value of self.generation read before the database was
+      with self._lock:
+         self._sync()
+         if generation != self.generation or self.max_entries <= 0:
+            self.rejected += 1
+            return
+         self._entries[key] = value
+         self._entries.move_to_end(key)
+         self._keys.setdefault(key[0], set()).add(key)
+         while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+   def invalidate(self, stop_ids):
+      with self._lock:
+         if self.shared_writes is not None:
+            with self.shared_writes.get_lock():
+               # writes of others not yet seen are left for the next _sync()
+               if self.shared_writes.value == self._seen_writes:
+                  self._seen_writes += 1
+               self.shared_writes.value += 1
+         self.generation += 1
+         for stop_id in stop_ids:
+            for key in self._keys.pop(stop_id, ()):
+               del self._entries[key]
+               self.invalidations += 1
+
+   def _drop(self, key):
+      del self._entries[key]
+      keys = self._keys[key[0]]
+      keys.discard(key)
+      if not keys:
+         del self._keys[key[0]]
 
-init()
+   def clear(self):
+      with self._lock:
+         self.generation += 1
+         self._entries.clear()
+         self._keys.clear()
 
+   def stats(self):
+      with self._lock:
+         lookups = self.hits + self.misses
+         return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "rejected": self.rejected,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+         }
+
+stop_cache = StopDocumentCache(STOP_CACHE_ENTRIES)
+
+def share_across_workers():
+   # Called by prefork.py in the parent, before it forks the workers: the departures cache
+   # gets its on-disk tier and the stop document cache its shared write counter. Gemini
+   # answers need nothing more, they are cached in the operator_profiles and guides tables.
+   import ctypes
+   import multiprocessing
+   departures_cache.shared_store = DiskCache(SHARED_CACHE_FILE)
+   # create the file and table once, up front; no connection may be inherited by the workers
+   departures_cache.shared_store.open().close()
+   stop_cache.shared_writes = multiprocessing.Value(ctypes.c_uint64, 0)
 
+# ids of the stops next to each id, as they are before the write that inserts or deletes it
+NEIGHBOURS_QUERY = '''
+   WITH ids(id) AS (VALUES {values})
+   SELECT (SELECT MAX(stop_id) FROM stops WHERE stop_id < id),
+      (SELECT MIN(stop_id) FROM stops WHERE stop_id > id)
+   FROM ids {where}'''
 
+def _neighbour_ids(cnx, stop_ids, new_only=False):
+   # run inside the write transaction, before the write; new_only keeps ids not stored yet
+   found = set()
+   if stop_cache.max_entries <= 0:
+      return found
+   stop_ids = list(stop_ids)
+   where = 'WHERE NOT EXISTS (SELECT 1 FROM stops WHERE stop_id = id)' if new_only else ''
+   for i in range(0, len(stop_ids), 500):
+      chunk = stop_ids[i:i + 500]
+      query = NEIGHBOURS_QUERY.format(values=', '.join(['(?)'] * len(chunk)), where=where)
+      for prev_stop_id, next_stop_id in cnx.execute(query, chunk):
+         found.add(prev_stop_id)
+         found.add(next_stop_id)
+   found.discard(None)
+   return found
 
+# MAX/MIN over a range of the integer primary key are single b-tree probes
+READ_WITH_NEIGHBOURS_QUERY = '''
+   SELECT s.stop_id, s.last_updated, s.name, s.latitude, s.longitude,
+      (SELECT MAX(stop_id) FROM stops WHERE stop_id < s.stop_id),
+      (SELECT MIN(stop_id) FROM stops WHERE stop_id > s.stop_id),
+      (SELECT modified_at FROM stops_modified WHERE stop_id = s.stop_id)
+   FROM stops s WHERE s.stop_id = ?
+   '''
+
+@tracing.traced("db.read")
 def db_read(stop_id):
-   cnx = db_connection()
-   cursor = cnx.cursor()
-   cursor.execute('SELECT * FROM stops WHERE stop_id = ?', (stop_id,))
-   result = cursor.fetchall()
-   cnx.close()
-   return result
+   with db_pool.connection() as cnx:
+      return cnx.execute('SELECT * FROM stops WHERE stop_id = ?', (stop_id,)).fetchall()
+
+@tracing.traced("db.read_many")
+def db_read_many(stop_ids):
+   # {stop_id: row} for the stored ones among stop_ids, one query per 500 ids
+   rows = {}
+   stop_ids = list(stop_ids)
+   with db_pool.connection() as cnx:
+      for i in range(0, len(stop_ids), 500):
+         chunk = stop_ids[i:i + 500]
+         query = f"SELECT * FROM stops WHERE stop_id IN ({', '.join(['?'] * len(chunk))})"
+         for row in cnx.execute(query, chunk):
+            rows[row[0]] = row
+   return rows
 
+@tracing.traced("db.insert")
 def db_insert(stop_id, last_updated, name, latitude, longitude): # insert data
-   cnx = db_connection()
-   cursor = cnx.cursor()
    query = 'INSERT INTO stops (stop_id, last_updated, name, latitude, longitude) VALUES (?, ?, ?, ?, ?)'
-   cursor.execute(query, (stop_id, last_updated, name, latitude, longitude))
-   cnx.commit()
-   cnx.close()
+   with db_pool.connection() as cnx:
+      with cnx:
+         cnx.execute('BEGIN IMMEDIATE')   # read the neighbours in the write transaction
+         stale = _neighbour_ids(cnx, [stop_id])
+         cnx.execute(query, (stop_id, last_updated, name, latitude, longitude))
+   stop_cache.invalidate(stale | {stop_id})
+   stop_sampler.added([stop_id])
+   search_vocabulary.add_names([name])
 
+@tracing.traced("db.update")
 def db_update(stop_id, last_updated, name, latitude, longitude): 
-   cnx = db_connection()
-   cursor = cnx.cursor()
    query = 'UPDATE stops SET last_updated = ?, name = ?, latitude = ?, longitude = ? WHERE stop_id = ?'
-   cursor.execute(query, (last_updated, name, latitude, longitude, stop_id))
    # 提交事务
-   cnx.commit()
-   cnx.close()
+   with db_pool.connection() as cnx, cnx:
+      cnx.execute(query, (last_updated, name, latitude, longitude, stop_id))
+   # only the stop's own fields change, its neighbours' links stay the same
+   stop_cache.invalidate([stop_id])
+   search_vocabulary.add_names([name])
 
+@tracing.traced("db.update_if_unchanged")
+def db_update_if_unchanged(details, last_updated, name, latitude, longitude):
+   # compare-and-swap for If-Match: only writes while the stored row still equals details
+   query = '''UPDATE stops SET last_updated = ?, name = ?, latitude = ?, longitude = ?
+              WHERE stop_id = ? AND last_updated = ? AND name = ? AND latitude = ? AND longitude = ?'''
+   with db_pool.connection() as cnx, cnx:
+      updated = cnx.execute(query, (last_updated, name, latitude, longitude) + tuple(details)).rowcount == 1
+   stop_cache.invalidate([details[0]])
+   if updated:
+      search_vocabulary.add_names([name])
+   return updated
 
+
+@tracing.traced("db.delete")
 def db_delete(stop_id):
-   cnx = db_connection()
-   cursor = cnx.cursor()
    delete_query = "DELETE FROM stops WHERE stop_id = ?"
-   cursor.execute(delete_query, (stop_id,))
    # 提交事务
-   cnx.commit()
-   cnx.close()
+   with db_pool.connection() as cnx:
+      with cnx:
+         cnx.execute('BEGIN IMMEDIATE')   # read the neighbours in the write transaction
+         stale = _neighbour_ids(cnx, [stop_id])
+         cnx.execute(delete_query, (stop_id,))
+   stop_cache.invalidate(stale | {stop_id})
+   stop_sampler.removed([stop_id])
+
+# Rows are (stop_id, last_updated, name, latitude, longitude), the column order of the stops table.
+UPSERT_QUERY = '''
+   INSERT INTO stops (stop_id, last_updated, name, latitude, longitude) VALUES (?, ?, ?, ?, ?)
+   ON CONFLICT(stop_id) DO UPDATE SET
+      last_updated = excluded.last_updated,
+      name = excluded.name,
+      latitude = excluded.latitude,
+      longitude = excluded.longitude
+   '''
+IMPORT_CHUNK_SIZE = int(os.environ.get("IMPORT_CHUNK_SIZE", 5000))
+
+@tracing.traced("db.upsert_many")
+def db_upsert_many(rows):
+   # insert or update every row with one executemany, committed as one transaction
+   rows = list(rows)
+   stop_ids = {row[0] for row in rows}
+   with db_pool.connection() as cnx:
+      with cnx:
+         cnx.execute('BEGIN IMMEDIATE')
+         # updated stops keep their neighbours; only inserted ones move prev/next links
+         stale = _neighbour_ids(cnx, stop_ids, new_only=True)
+         cnx.executemany(UPSERT_QUERY, rows)
+   stop_cache.invalidate(stale | stop_ids)
+   stop_sampler.added(stop_ids)
+   search_vocabulary.add_names(row[2] for row in rows)
+
+def import_stops(rows, chunk_size=IMPORT_CHUNK_SIZE):
+   # Bulk-import entry point: upserts an iterable of rows in chunks of chunk_size,
+   # one transaction per chunk, so arbitrarily long inputs never sit in memory at once.
+   # Returns the number of rows written.
+   total = 0
+   chunk = []
+   for row in rows:
+      chunk.append(row)
+      if len(chunk) >= chunk_size:
+         db_upsert_many(chunk)
+         total += len(chunk)
+         chunk = []
+   if chunk:
+      db_upsert_many(chunk)
+      total += len(chunk)
+   return total
+
+class JsonStream:
+   """Minimal incremental JSON reader over an iterable of byte chunks.
+
+   Reads only as many chunks as needed to decode the next value, so a caller
+   that stops iterating early never downloads the rest of the body.
+   """
+
+   def __init__(self, chunks):
+      self._chunks = iter(chunks)
+      self._utf8 = codecs.getincrementaldecoder('utf-8')()
+      self._decoder = json.JSONDecoder()
+      self.buf = ''
+      self.pos = 0
+      self.eof = False
+
+   def _more(self):
+      chunk = next(self._chunks, None)
+      if chunk is None:
+         self.buf += self._utf8.decode(b'', final=True)
+         self.eof = True
+         return False
+      self.buf = self.buf[self.pos:] + self._utf8.decode(chunk)
+      self.pos = 0
+      return True
+
+   def peek(self):
+      # next non-whitespace character, or '' at the end of the input
+      while True:
+         while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+            self.pos += 1
+         if self.pos < len(self.buf):
+            return self.buf[self.pos]
+         if not self._more():
+            return ''
+
+   def expect(self, char):
+      if self.peek() != char:
+         raise ValueError(f"expected {char!r} at offset {self.pos} of the departures payload")
+      self.pos += 1
+
+   def value(self):
+      self.peek()
+      while True:
+         try:
+            value, end = self._decoder.raw_decode(self.buf, self.pos)
+            # a number at the very end of the buffer may continue in the next chunk
+            if end < len(self.buf) or self.eof:
+               self.pos = end
+               return value
+         except json.JSONDecodeError:
+            if self.eof:
+               raise
+         self._more()
+
+   def array_items(self):
+      self.expect('[')
+      while True:
+         char = self.peek()
+         if char == ']':
+            self.pos += 1
+            return
+         if char == ',':
+            self.pos += 1
+            continue
+         yield self.value()
+
+def iter_departures(chunks):
+   # Yield the entries of a departures payload ({"departures": [...], ...} or a bare list) one by one.
+   stream = JsonStream(chunks)
+   if stream.peek() == '[':
+      yield from stream.array_items()
+      return
+   stream.expect('{')
+   while True:
+      char = stream.peek()
+      if char in ('}', ''):
+         return
+      if char == ',':
+         stream.pos += 1
+         continue
+      key = stream.value()
+      stream.expect(':')
+      if key == 'departures':
+         yield from stream.array_items()
+      else:
+         stream.value()
+
+def stream_departures(stop_id):
+   # Departures straight off the wire; closing the generator early closes the response.
+   # A connection that drops or a body that is not JSON surfaces mid-iteration, after
+   # upstream.get() returned, and is raised as UpstreamUnavailable like a failed request.
+   response = upstream.get(f'{TRANSPORT_REST_URL}/stops/{stop_id}/departures', endpoint="departures", stream=True)
+   try:
+      if response.status_code == 200:
+         yield from iter_departures(response.iter_content(DEPARTURES_CHUNK_SIZE))
+   except (requests.RequestException, ValueError) as e:
+      raise UpstreamUnavailable(f"departures of {stop_id} unreadable: {e}") from e
+   finally:
+      response.close()
+
+def departures_list(payload):
+   # the departure entries of a decoded payload, [] when the upstream had none
+   if payload is None:
+      return []
+   return payload['departures'] if isinstance(payload, dict) else payload
+
+def stop_departures(stop_id):
+   # With the departures cache on, the payload is decoded once and shared for DEPARTURES_TTL.
+   # With DEPARTURES_TTL=0 it is streamed, and callers stop reading as soon as they have an answer.
+   if departures_cache.ttl > 0:
+      return departures_list(fetch_departures(stop_id))
+   return stream_departures(stop_id)
+
+def departure_time(departure):
+   # 'when' is ISO 8601 with a UTC offset; it is null for cancelled departures
+   when = departure.get('when')
+   return datetime.fromisoformat(when) if when else None
 
 def get_next_departure(stop_id):
-    url = f'https://v6.db.transport.rest/stops/{stop_id}/departures'
-    response = requests.get(url)
-    if response.status_code == 200:
-        departures = response.json()
-        for departure in departures['departures']:
-            if departure['platform'] and departure['direction']:
-               
-               current_time = datetime.now(timezone.utc)
-               maximum_from_now = current_time + timedelta(minutes=120)
-               when = datetime.strptime(departure['when'], "%Y-%m-%dT%H:%M:%S%z")
-               if current_time <= when <= maximum_from_now:
-                  return f"Platform {departure['platform']} towards {departure['direction']}"
+    return next_departure_from(stop_departures(stop_id))
+
+def next_departure_from(departures):
+    # the first departure with a platform and direction in the next 120 minutes
+    current_time = datetime.now(timezone.utc)
+    maximum_from_now = current_time + timedelta(minutes=120)
+    for departure in departures:
+        if departure['platform'] and departure['direction']:
+            when = departure_time(departure)
+            if when is not None and current_time <= when <= maximum_from_now:
+               return f"Platform {departure['platform']} towards {departure['direction']}"
     return None
 
 def get_prev_and_next_stop(current_stop_id):
-    conn = db_connection()
-    cursor = conn.cursor()
-    
-    # Query to find the previous stop ID
-    cursor.execute('SELECT stop_id FROM stops WHERE stop_id < ? ORDER BY stop_id DESC LIMIT 1', (current_stop_id,))
-    prev_stop_id = cursor.fetchone()
-    
-    # Query to find the next stop ID
-    cursor.execute('SELECT stop_id FROM stops WHERE stop_id > ? ORDER BY stop_id ASC LIMIT 1', (current_stop_id,))
-    next_stop_id = cursor.fetchone()
-    
-    conn.close()
+    with db_pool.connection() as conn:
+        # Query to find the previous stop ID
+        prev_stop_id = conn.execute('SELECT stop_id FROM stops WHERE stop_id < ? ORDER BY stop_id DESC LIMIT 1', (current_stop_id,)).fetchone()
+
+        # Query to find the next stop ID
+        next_stop_id = conn.execute('SELECT stop_id FROM stops WHERE stop_id > ? ORDER BY stop_id ASC LIMIT 1', (current_stop_id,)).fetchone()
+
     return prev_stop_id, next_stop_id
 
+@tracing.traced("db.read_with_neighbours")
+def db_read_with_neighbours(stop_id):
+   # The stored row plus the ids of its previous and next stops and its stops_modified
+   # time, in one indexed query. Returns (details, prev_stop_id, next_stop_id,
+   # modified_at), or None when the stop does not exist.
+   with db_pool.connection() as cnx:
+      row = cnx.execute(READ_WITH_NEIGHBOURS_QUERY, (stop_id,)).fetchone()
+   if row is None:
+      return None
+   return row[:5], row[5], row[6], row[7]
+
+def cached_stop(stop_id, fields, host):
+   # db_read_with_neighbours plus the document built from it, through stop_cache.
+   # Returns (details, prev_stop_id, next_stop_id, document, modified_at) or None; the
+   # document is a copy the caller may add next_departure to.
+   key = (stop_id, frozenset(fields) if fields else None, host)
+   entry = stop_cache.get(key)
+   if entry is None:
+      generation = stop_cache.generation
+      found = db_read_with_neighbours(stop_id)
+      if found is None:
+         return None
+      details, prev_stop_id, next_stop_id, modified_at = found
+      entry = (details, prev_stop_id, next_stop_id,
+               stop_document(stop_id, details, prev_stop_id, next_stop_id, fields, host), modified_at)
+      stop_cache.put(key, entry, generation)
+   # only stored stops are counted: ids of 404s would grow the counter without bound
+   stop_sampler.viewed(stop_id)
+   details, prev_stop_id, next_stop_id, document, modified_at = entry
+   return details, prev_stop_id, next_stop_id, dict(document), modified_at
+
+@tracing.traced("db.neighbour_links")
+def get_neighbour_links(stop_ids):
+   # Batch variant for list endpoints: {stop_id: (prev_stop_id, next_stop_id)} for every
+   # id in stop_ids, whether or not it is stored, resolved with one query per 500 ids.
+   neighbours = {}
+   stop_ids = list(stop_ids)
+   with db_pool.connection() as cnx:
+      for i in range(0, len(stop_ids), 500):
+         chunk = stop_ids[i:i + 500]
+         values = ', '.join(['(?)'] * len(chunk))
+         query = f'''
+            WITH ids(id) AS (VALUES {values})
+            SELECT id,
+               (SELECT MAX(stop_id) FROM stops WHERE stop_id < id),
+               (SELECT MIN(stop_id) FROM stops WHERE stop_id > id)
+            FROM ids'''
+         for stop_id, prev_stop_id, next_stop_id in cnx.execute(query, chunk):
+            neighbours[stop_id] = (prev_stop_id, next_stop_id)
+   return neighbours
+
+STOPS_PAGE_MAX = 1000
+
+def prefix_upper_bound(prefix):
+   # The least string above every string that starts with prefix: the prefix with its last
+   # character bumped, after dropping trailing U+10FFFF, which has no successor. None when
+   # the prefix is all U+10FFFF. Surrogates are skipped, they cannot be encoded for SQLite.
+   prefix = prefix.rstrip('\U0010ffff')
+   if not prefix:
+      return None
+   bumped = ord(prefix[-1]) + 1
+   if 0xD800 <= bumped <= 0xDFFF:
+      bumped = 0xE000
+   return prefix[:-1] + chr(bumped)
+
+@tracing.traced("db.stops_page")
+def stops_page(after=None, before=None, limit=20, name_prefix=None, fields=None, host='localhost'):
+   # One page of GET /stops, ordered by stop_id and paged with a stop_id cursor
+   # (keyset pagination), so deep pages cost the same as the first one.
+   conditions = []
+   params = []
+   if name_prefix:
+      # name >= prefix AND name < prefix_upper_bound(prefix) is an index range on stops_name
+      upper = prefix_upper_bound(name_prefix)
+      if upper is not None:
+         conditions.append('name >= ? AND name < ?')
+         params += [name_prefix, upper]
+      else:
+         conditions.append('name >= ? AND substr(name, 1, ?) = ?')
+         params += [name_prefix, len(name_prefix), name_prefix]
+   where = ' AND '.join(conditions) or '1'
+
+   with db_pool.connection() as cnx:
+      if before is not None:
+         rows = cnx.execute(f'SELECT * FROM stops WHERE {where} AND stop_id < ? ORDER BY stop_id DESC LIMIT ?',
+                            params + [before, limit + 1]).fetchall()
+         has_prev = len(rows) > limit
+         rows = rows[:limit][::-1]
+         has_next = True
+      else:
+         cursor = after if after is not None else -1
+         rows = cnx.execute(f'SELECT * FROM stops WHERE {where} AND stop_id > ? ORDER BY stop_id LIMIT ?',
+                            params + [cursor, limit + 1]).fetchall()
+         has_next = len(rows) > limit
+         rows = rows[:limit]
+         has_prev = after is not None
+      if rows:
+         # the page we came from may have been emptied since; only link to pages with rows
+         probe = f'SELECT EXISTS (SELECT 1 FROM stops WHERE {where} AND stop_id {{}} ?)'
+         if has_prev:
+            has_prev = cnx.execute(probe.format('<'), params + [rows[0][0]]).fetchone()[0] == 1
+         if has_next and before is not None:
+            has_next = cnx.execute(probe.format('>'), params + [rows[-1][0]]).fetchone()[0] == 1
+
+   neighbours = get_neighbour_links(row[0] for row in rows)
+   stops = [stop_document(row[0], row, *neighbours[row[0]], fields, host) for row in rows]
+
+   query = f'&limit={limit}'
+   if name_prefix:
+      query += f'&name={quote(name_prefix)}'
+   if fields:
+      query += f'&include={",".join(fields)}'
+   links = {}
+   if rows:
+      links['self'] = {"href": f'http://{host}/stops?after={rows[0][0] - 1}{query}'}
+      if has_next:
+         links['next'] = {"href": f'http://{host}/stops?after={rows[-1][0]}{query}'}
+      if has_prev:
+         links['prev'] = {"href": f'http://{host}/stops?before={rows[0][0]}{query}'}
+   return {"stops": stops, "count": len(stops), "_links": links}
+
+EARTH_RADIUS_M = 6371008.8
+DEGREES_PER_METRE = 180.0 / (np.pi * EARTH_RADIUS_M)    # along a meridian, on the sphere haversine uses
+NEARBY_BOX_PAD = 1.001                                  # margin of the R*Tree box for rounding
+NEARBY_MAX_RADIUS = 100000
+NEARBY_MAX_K = 100
+
+def haversine(lat, lon, lats, lons):
+   # great-circle distance in metres from (lat, lon) to every point of the lats/lons arrays
+   lat, lon = np.radians(lat), np.radians(lon)
+   lats, lons = np.radians(lats), np.radians(lons)
+   a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+   return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+@tracing.traced("db.nearby")
+def nearby_stops(lat, lon, radius, k):
+   # The k stored stops closest to (lat, lon) within radius metres, nearest first, as
+   # (row, distance) pairs. The R*Tree narrows the search to the bounding box of the
+   # circle; exact distances are then computed for all candidates at once.
+   dlat = radius * DEGREES_PER_METRE * NEARBY_BOX_PAD
+   lat_range = (max(-90.0, lat - dlat), min(90.0, lat + dlat))
+   # a degree of longitude is shortest at the poleward edge of the box, so that edge sets its width
+   cos_lat = np.cos(np.radians(max(abs(lat_range[0]), abs(lat_range[1]))))
+   dlon = 180.0 if cos_lat < 1e-6 else min(180.0, dlat / cos_lat)
+   lon_ranges = [(lon - dlon, lon + dlon)]
+   # boxes that cross the antimeridian are split in two
+   if lon - dlon < -180:
+      lon_ranges = [(-180.0, lon + dlon), (lon - dlon + 360, 180.0)]
+   elif lon + dlon > 180:
+      lon_ranges = [(lon - dlon, 180.0), (-180.0, lon + dlon - 360)]
+
+   rows = []
+   with db_pool.connection() as cnx:
+      for min_lon, max_lon in lon_ranges:
+         rows += cnx.execute('''
+            SELECT s.* FROM stops_rtree r JOIN stops s ON s.stop_id = r.id
+            WHERE r.max_lat >= ? AND r.min_lat <= ? AND r.max_lon >= ? AND r.min_lon <= ?
+            ''', (lat_range[0], lat_range[1], min_lon, max_lon)).fetchall()
+   if not rows:
+      return []
+   distances = haversine(lat, lon, np.fromiter((r[3] for r in rows), float, len(rows)),
+                         np.fromiter((r[4] for r in rows), float, len(rows)))
+   inside = np.flatnonzero(distances <= radius)
+   if len(inside) > k:
+      inside = inside[np.argpartition(distances[inside], k - 1)[:k]]
+   inside = inside[np.argsort(distances[inside], kind='stable')]
+   return [(rows[i], float(distances[i])) for i in inside]
+
+def nearby_document(lat, lon, radius, k, host):
+   stops = []
+   for row, distance in nearby_stops(lat, lon, radius, k):
+      stops.append({
+         'stop_id': row[0],
+         'name': row[2],
+         'latitude': row[3],
+         'longitude': row[4],
+         'last_updated': row[1],
+         'distance': round(distance, 1),
+         '_links': {'self': {"href": f'http://{host}/stops/{row[0]}'}}
+      })
+   return {"stops": stops, "count": len(stops)}
+
+def nearby_args_valid(lat, lon, radius, k):
+   return (-90 <= lat <= 90 and -180 <= lon <= 180 and 0 < radius <= NEARBY_MAX_RADIUS
+           and 1 <= k <= NEARBY_MAX_K)
+
+SEARCH_MAX_LIMIT = 50
+# Each FTS query reads at most SEARCH_SCAN matches and keeps the SEARCH_CANDIDATES with
+# the shortest names, which are then ranked here; misspelt terms are replaced by up to
+# SEARCH_CORRECTIONS words of the index scoring at least SEARCH_MIN_SIMILARITY.
+# SEARCH_VOCABULARY_RELOAD works like SAMPLER_RELOAD. With 1M stops, sorting every match
+# of a common prefix took 28 ms p50 and 177 ms p99; reading 5000 matches, about 15 ms p50
+# and 35 ms p99 (`python benchmark.py search`).
+SEARCH_SCAN = int(os.environ.get("SEARCH_SCAN", 5000))
+SEARCH_CANDIDATES = 500
+SEARCH_CORRECTIONS = 3
+SEARCH_MIN_SIMILARITY = 0.7
+SEARCH_VOCABULARY_RELOAD = float(os.environ.get("SEARCH_VOCABULARY_RELOAD", 300))
+
+def search_terms(text):
+   # lower-case words without accents, like the unicode61 tokenizer with remove_diacritics
+   text = unicodedata.normalize('NFKD', text.lower())
+   return re.findall(r'\w+', ''.join(c for c in text if not unicodedata.combining(c)))
+
+def trigrams(word):
+   return {word[i:i + 3] for i in range(len(word) - 2)}
+
+def similarity(term, word):
+   # 0 to 1; term is also compared with the start of word, so partly typed words score high
+   return max(SequenceMatcher(None, term, word).ratio(), SequenceMatcher(None, term, word[:len(term)]).ratio())
+
+def match_score(alternatives, name):
+   # How well name matches the query, from 0 to 1: the mean over the query terms of the
+   # best (similarity, word) alternative starting a word of name, times the share of
+   # that word it covers. "berl" scores 0.67 on "Berlin", "berlin" 1.0.
+   words = search_terms(name)
+   total = 0.0
+   for options in alternatives:
+      total += max((score * len(option) / len(word) for score, option in options
+                    for word in words if word.startswith(option)), default=0.0)
+   return total / len(alternatives)
+
+class SearchVocabulary:
+   """Words of the indexed stop names, for correcting misspelt search terms.
+
+   The words are read from stops_fts_terms on first use and reloaded every
+   SEARCH_VOCABULARY_RELOAD seconds. Names written through this module are
+   added in between. Words of deleted stops stay until the next reload; a
+   correction to such a word simply finds no stops. Candidate corrections
+   are the words sharing the most trigrams with the term, looked up in an
+   in-memory trigram index, and only those few are scored.
+   """
+
+   def __init__(self, reload_interval):
+      self.reload_interval = reload_interval
+      self._words = None
+      self._by_trigram = None
+      self._loaded_at = 0.0
+      self._lock = threading.Lock()
+      self._load_lock = threading.Lock()
+
+   def _add(self, words):
+      # called with self._lock held
+      for word in words:
+         if word not in self._words:
+            self._words.add(word)
+            for trigram in trigrams(word):
+               self._by_trigram.setdefault(trigram, set()).add(word)
+
+   def add_names(self, names):
+      with self._lock:
+         if self._words is not None:
+            self._add(word for name in names for word in search_terms(name))
+
+   def _stale(self):
+      return self._words is None or time.monotonic() - self._loaded_at >= self.reload_interval
+
+   def _load(self, cnx):
+      # cnx is the caller's connection: taking a second one from db_pool while holding
+      # one could wait forever once concurrent searches hold the whole pool
+      with self._load_lock:
+         if not self._stale():
+            return                      # another request loaded it while this one waited
+         words = [row[0] for row in cnx.execute('SELECT term FROM stops_fts_terms')]
+         with self._lock:
+            self._words, self._by_trigram = set(), {}
+            self._add(words)
+            self._loaded_at = time.monotonic()
+
+   def corrections(self, cnx, term, n=SEARCH_CORRECTIONS):
+      # up to n (similarity, word) pairs of indexed words close to term, best first;
+      # empty for terms under three letters. cnx is used to (re)load the words.
+      if self._stale():
+         self._load(cnx)
+      shared = Counter()
+      with self._lock:
+         for trigram in trigrams(term):
+            shared.update(self._by_trigram.get(trigram, ()))
+      scored = []
+      for word, _ in shared.most_common(10 * n):
+         score = similarity(term, word)
+         if word != term and score >= SEARCH_MIN_SIMILARITY:
+            scored.append((score, word))
+      return sorted(scored, reverse=True)[:n]
+
+search_vocabulary = SearchVocabulary(SEARCH_VOCABULARY_RELOAD)
+
+def _search_candidates(cnx, alternatives):
+   # rows whose names have, for every term, a word starting with one of its alternatives
+   expression = ' AND '.join('(' + ' OR '.join(f'"{word}"*' for _, word in options) + ')'
+                             for options in alternatives)
+   return cnx.execute('''
+      SELECT s.* FROM (SELECT rowid FROM stops_fts WHERE stops_fts MATCH ? LIMIT ?) f
+      JOIN stops s ON s.stop_id = f.rowid ORDER BY length(s.name), s.stop_id LIMIT ?
+      ''', (expression, SEARCH_SCAN, SEARCH_CANDIDATES)).fetchall()
+
+@tracing.traced("db.search")
+def search_stops(query, limit, fuzzy=True):
+   # Stored stops matching query as (row, match, score) triples, best first. Stops
+   # with a word starting with every query term come first ("prefix"). If there are
+   # fewer than limit of them and fuzzy is set, misspelt terms are corrected against
+   # the indexed words and the matches of the corrected query fill the rest ("fuzzy").
+   # score is match_score; ties go to the shorter name. The FTS query is not ranked
+   # by bm25, which would score every match of a common prefix; of the first
+   # SEARCH_SCAN matches it keeps the SEARCH_CANDIDATES shortest names, as a matching
+   # word covers more of a short name, and only those are ranked.
+   terms = search_terms(query)
+   if not terms:
+      return []
+
+   def ranked(rows, match, alternatives):
+      hits = [(row, match, match_score(alternatives, row[2])) for row in rows]
+      return sorted(hits, key=lambda hit: (-hit[2], len(hit[0][2])))
+
+   exact = [[(1.0, term)] for term in terms]
+   with db_pool.connection() as cnx:
+      hits = ranked(_search_candidates(cnx, exact), "prefix", exact)[:limit]
+      if not fuzzy or len(hits) >= limit:
+         return hits
+      alternatives = [options + search_vocabulary.corrections(cnx, term) for term, options in zip(terms, exact)]
+      if all(len(options) == 1 for options in alternatives):
+         return hits
+      rows = _search_candidates(cnx, alternatives)
+   found = {row[0] for row, _, _ in hits}
+   corrected = ranked((row for row in rows if row[0] not in found), "fuzzy", alternatives)
+   return hits + corrected[:limit - len(hits)]
+
+def search_document(query, limit, host):
+   stops = []
+   for row, match, score in search_stops(query, limit):
+      stops.append({
+         'stop_id': row[0],
+         'name': row[2],
+         'latitude': row[3],
+         'longitude': row[4],
+         'last_updated': row[1],
+         'match': match,
+         'score': round(score, 3),
+         '_links': {'self': {"href": f'http://{host}/stops/{row[0]}'}}
+      })
+   return {"stops": stops, "count": len(stops)}
+
+# max_age of PUT /stops above this (ten years) is refused, like negative and non-finite
+# values: timedelta() cannot represent nan, inf or much more than a million years
+MAX_AGE_LIMIT = 10 * 365 * 24 * 3600
+
+def max_age_valid(max_age):
+   return math.isfinite(max_age) and 0 <= max_age <= MAX_AGE_LIMIT
+
+def local_locations(query, max_age, host, limit=5):
+   # PUT /stops answered from the search index: the body for up to limit stops whose
+   # names match query, or None when nothing matches or a match was last updated more
+   # than max_age seconds ago, in which case the caller asks transport.rest.
+   hits = search_stops(query or '', limit, fuzzy=False)
+   cutoff = (datetime.now() - timedelta(seconds=max_age)).strftime(TIMESTAMP_FORMAT)
+   # yyyy-mm-dd-hh:mm:ss strings sort like the times they encode
+   if not hits or any(row[1] < cutoff for row, _, _ in hits):
+      return None
+   put_list = [{"stop_id": row[0], "last_updated": row[1], "_links": {"self": {"href": f"http://{host}/stops/{row[0]}"}}}
+               for row, _, _ in hits]
+   return {"message": sorted(put_list, key=lambda x: x['stop_id'])}
+
+def stop_document(stop_id, details, prev_stop_id, next_stop_id, fields, host):
+   # HAL representation of a stored stop, restricted to the fields in include (None for all).
+   # next_departure is left to the caller because it needs an upstream call.
+   data = {
+      'stop_id': stop_id,
+      '_links': {
+            'self': {"href": f'http://{host}/stops/{stop_id}'}
+      }
+   }  
+   if next_stop_id is not None:
+      data['_links']['next'] = {"href": f'http://{host}/stops/{next_stop_id}'}
+   if prev_stop_id is not None:
+      data['_links']['prev'] = {"href": f'http://{host}/stops/{prev_stop_id}'}
+
+   if not fields or 'name' in fields:
+      data['name'] = details[2]
+   # Add latitude and longitude here similarly
+   if not fields or 'last_updated' in fields:
+      data['last_updated'] = details[1]
+   if not fields or 'latitude' in fields:
+      data['latitude'] = details[3]
+   # Add latitude and longitude here similarly
+   if not fields or 'longitude' in fields:
+      data['longitude'] = details[4] 
+   return data
+
+def stop_version(details):
+   # opaque version of a stored row; changes whenever any of its columns does
+   stop_id, last_updated, name, latitude, longitude = details
+   row = (stop_id, last_updated, name, float(latitude), float(longitude))
+   return hashlib.sha1(repr(row).encode()).hexdigest()[:16]
+
+def stop_etag(details, prev_stop_id, next_stop_id, fields, host, next_departure=None):
+   # ETag of GET /stops/<id>: the row version plus a digest of everything else the body
+   # is built from, so neighbour changes or a new next_departure change the tag too
+   variant = repr((prev_stop_id, next_stop_id, sorted(fields) if fields else None, host, next_departure))
+   return f'"{stop_version(details)}-{hashlib.sha1(variant.encode()).hexdigest()[:8]}"'
+
+STORED_FIELDS = ['last_updated', 'latitude', 'longitude', 'name']
+
+def patched_etag(stop_id, row, host):
+   # ETag of a PATCH answer, in the format of stop_etag(): the tag GET
+   # /stops/<id>?include=last_updated,latitude,longitude,name gives for the row written
+   found = db_read_with_neighbours(stop_id)
+   prev_stop_id, next_stop_id = found[1:3] if found is not None else (None, None)
+   return stop_etag((stop_id,) + row, prev_stop_id, next_stop_id, STORED_FIELDS, host)
+
+def last_modified(modified_at):
+   # Last-Modified from the stops_modified time, or None within a second of the change:
+   # HTTP dates have whole seconds, and a date handed out then could also cover a second
+   # change in the same second. Any date a client holds was sent at least a second after
+   # the change it describes, so a later change always has a later date.
+   if modified_at is None or time.time() - modified_at < 1:
+      return None
+   return format_datetime(datetime.fromtimestamp(int(modified_at), timezone.utc), usegmt=True)
+
+def _tags(header):
+   return [tag.strip().removeprefix('W/') for tag in header.split(',') if tag.strip()]
+
+def not_modified(etag, modified, if_none_match, if_modified_since):
+   # RFC 9110 evaluation for GET: If-None-Match (weak comparison) wins over If-Modified-Since.
+   # modified is None when the body does not only depend on the row, e.g. with next_departure.
+   if if_none_match:
+      tags = _tags(if_none_match)
+      return '*' in tags or etag.removeprefix('W/') in tags
+   if if_modified_since and modified:
+      try:
+         return parsedate_to_datetime(modified) <= parsedate_to_datetime(if_modified_since)
+      except (TypeError, ValueError):
+         return False
+   return False
+
+def if_match(header, details):
+   # If-Match for PATCH: compares the row-version part of the tags against the stored row.
+   # RFC 9110 requires the strong comparison here, so weak (W/) tags never match.
+   if not header:
+      return True
+   version = stop_version(details)
+   for tag in (tag.strip() for tag in header.split(',')):
+      if tag == '*' or (not tag.startswith('W/') and tag.strip('"').split('-')[0] == version):
+         return True
+   return False
+
+def merge_updates(details, updates):
+   # fill the fields a PATCH leaves out from the stored row, then validate the result
+   fill_updates(details, updates)
+   return validate_input(updates)
+
+def fill_updates(details, updates):
+   if 'name' not in updates:
+       updates['name'] = details[2]
+   if 'last_updated' not in updates:
+       updates['last_updated'] = datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
+   if 'latitude' not in updates:
+       updates['latitude'] = details[3] 
+   if 'longitude' not in updates:
+       updates['longitude'] = details[4] 
+
+def _is_number(value):
+   # true and false are not coordinates, though Python compares them as 1 and 0
+   return isinstance(value, (int, float)) and not isinstance(value, bool)
+
 def validate_input(updates):
     
     if 'name' in updates and updates['name'] == '' :
@@ -217,67 +1576,1059 @@ def validate_input(updates):
         return False, 'Next departure cannot be blank'
     
     
-    if 'latitude' in updates and not (-90 <= updates['latitude'] <= 90):
+    if 'latitude' in updates and not (_is_number(updates['latitude']) and -90 <= updates['latitude'] <= 90):
         return False, 'Latitude must be between -90 and 90'
-    if 'longitude' in updates and not (-180 <= updates['longitude'] <= 180):
+    if 'longitude' in updates and not (_is_number(updates['longitude']) and -180 <= updates['longitude'] <= 180):
         return False, 'Longitude must be between -180 and 180'
     
     
     if 'last_updated' in updates:
         try:
             datetime.strptime(updates['last_updated'], '%Y-%m-%d-%H:%M:%S')
-        except ValueError:
+        except (TypeError, ValueError):
             return False, 'Last updated must be in the format yyyy-mm-dd-hh:mm:ss'
     
     return True, ''
+
+TIMESTAMP_FORMAT = '%Y-%m-%d-%H:%M:%S'
+VALIDATED_FIELDS = ('name', 'next_departure', 'latitude', 'longitude', 'last_updated')
+# JSON types of the indicator_model fields, for bodies that flask-restx has not validated
+PAYLOAD_TYPES = {'name': 'string', 'latitude': 'number', 'longitude': 'number',
+                 'last_updated': 'string', 'next_departure': 'string'}
+
+def _json_type(value, kind):
+   if isinstance(value, bool):
+      return False
+   if kind == 'string':
+      return isinstance(value, str)
+   if kind == 'integer':
+      return isinstance(value, int)
+   return isinstance(value, (int, float))
+
+def payload_errors(item, bulk=False):
+   # {field: message} for the fields of a PATCH body that do not match indicator_model
+   # (bulk_patch_model when bulk), in the words flask-restx's validation uses. A field
+   # sent as null is invalid, not absent.
+   errors = {}
+   if bulk:
+      if 'stop_id' not in item:
+         errors['stop_id'] = "'stop_id' is a required property"
+      elif not _json_type(item['stop_id'], 'integer'):
+         errors['stop_id'] = f"{item['stop_id']!r} is not of type 'integer'"
+   for field, kind in PAYLOAD_TYPES.items():
+      if field in item and not _json_type(item[field], kind):
+         errors[field] = f"{item[field]!r} is not of type '{kind}'"
+   return errors
+
+# The strings datetime.strptime accepts for TIMESTAMP_FORMAT, without the calendar check;
+# strptime's own pattern allows seconds 60 and 61, which datetime() then rejects.
+TIMESTAMP_PATTERN = (r'\d\d\d\d-(?:1[0-2]|0[1-9]|[1-9])-(?:3[01]|[12]\d|0[1-9]|[1-9]| [1-9])'
+                     r'-(?:2[0-3]|[0-1]\d|\d):(?:[0-5]\d|\d):(?:[0-5]\d|\d)')
+# Until pandas is imported, validate_batch checks batches below this many rows one by
+# one: importing pandas takes about as long as validate_input needs for 20000 rows.
+VALIDATE_BATCH_MIN_ROWS = int(os.environ.get("VALIDATE_BATCH_MIN_ROWS", 20000))
+
+def validate_batch(columns):
+   # validate_input for bulk writes. columns maps a field to one value per row, None
+   # where the row leaves the field out. Returns one message per row, '' when the row
+   # is valid, otherwise the message validate_input gives for that row.
+   n = len(next(iter(columns.values()))) if columns else 0
+   if n < VALIDATE_BATCH_MIN_ROWS and 'pandas' not in sys.modules:
+      return [validate_input({field: values[i] for field, values in columns.items() if values[i] is not None})[1]
+              for i in range(n)]
+   return _validate_columns(columns, n)
+
+def _validate_columns(columns, n):
+   # the vectorized validate_batch, with NumPy/pandas
+   messages = np.full(n, '', dtype=object)
+   import pandas as pd     # only bulk writes need pandas; importing it costs ~0.4 s
+   # rules are applied last to first, so the first rule a row breaks sets its message
+   if 'last_updated' in columns:
+      values = pd.Series(columns['last_updated'], dtype=object)
+      present = np.fromiter((value is not None for value in columns['last_updated']), bool, n)
+      # the pattern checks the ranges of the fields, the parse the calendar
+      matched = values.str.fullmatch(TIMESTAMP_PATTERN).fillna(False).to_numpy(dtype=bool)
+      parsed = pd.to_datetime(values.where(matched), format=TIMESTAMP_FORMAT, errors='coerce')
+      bad = present & ~(matched & parsed.notna().to_numpy())
+      # matching rows pandas rejects (e.g. non-ASCII digits) are re-checked with strptime
+      for i in np.flatnonzero(bad & matched):
+         try:
+            datetime.strptime(values[i], TIMESTAMP_FORMAT)
+            bad[i] = False
+         except ValueError:
+            pass
+      messages[bad] = 'Last updated must be in the format yyyy-mm-dd-hh:mm:ss'
+   for field, bound, text in (('longitude', 180, 'Longitude must be between -180 and 180'),
+                              ('latitude', 90, 'Latitude must be between -90 and 90')):
+      if field in columns:
+         present = np.fromiter((value is not None for value in columns[field]), bool, n)
+         numbers = np.fromiter((value if _is_number(value) else np.nan for value in columns[field]), float, n)
+         # NaN fails both comparisons, so present non-numbers, NaN and inf are all out of range
+         with np.errstate(invalid='ignore'):
+            messages[present & ~((-bound <= numbers) & (numbers <= bound))] = text
+   for field, text in (('next_departure', 'Next departure cannot be blank'), ('name', 'Name cannot be blank')):
+      if field in columns:
+         messages[np.asarray(columns[field], dtype=object) == ''] = text
+   return messages.tolist()
+
+BULK_PATCH_MAX = 10000
+
+def bulk_patch(items, host='localhost'):
+   # PATCH /stops: a list of single-stop PATCH bodies, each with its stop_id. Either
+   # every update is applied, in one transaction, or none is and the response lists
+   # the failing rows. Returns (body, status).
+   if not isinstance(items, list) or not 0 < len(items) <= BULK_PATCH_MAX:
+      return {"message": "Invalid field in request"}, 400
+   for item in items:
+      if not isinstance(item, dict) or type(item.get('stop_id')) is not int or '_links' in item or len(item) < 2:
+         return {"message": "Invalid field in request"}, 400
+
+   stored = db_read_many({item['stop_id'] for item in items})
+   errors = []
+   merged = []
+   for index, item in enumerate(items):
+      details = stored.get(item['stop_id'])
+      if details is None:
+         errors.append({"index": index, "stop_id": item['stop_id'], "message": "Not found."})
+         continue
+      updates = {key: value for key, value in item.items() if key != 'stop_id'}
+      problems = payload_errors(updates)
+      if problems:
+         errors.append({"index": index, "stop_id": item['stop_id'], "message": '; '.join(problems.values())})
+         continue
+      fill_updates(details, updates)
+      merged.append((index, item['stop_id'], updates))
+
+   columns = {field: [updates.get(field) for _, _, updates in merged] for field in VALIDATED_FIELDS}
+   for (index, stop_id, _), message in zip(merged, validate_batch(columns)):
+      if message:
+         errors.append({"index": index, "stop_id": stop_id, "message": message})
+   if errors:
+      errors.sort(key=lambda error: error["index"])
+      return {"message": "Invalid field in request", "errors": errors}, 400
+
+   db_upsert_many([(stop_id, updates['last_updated'], updates['name'], updates['latitude'], updates['longitude'])
+                   for _, stop_id, updates in merged])
+   return {"message": [{
+      "stop_id": stop_id,
+      "last_updated": updates['last_updated'],
+      "_links": {"self": {"href": f"http://{host}/stops/{stop_id}"}}
+   } for _, stop_id, updates in merged]}, 200
+
+
 def get_departing_info(stop_id):
-   url = f'https://v6.db.transport.rest/stops/{stop_id}/departures'
-   response = requests.get(url)
-   if response.status_code == 200:
-      departures = response.json()
-      name_list = []
-      for departure in departures['departures']:  
-         #print(departure)
-         current_time = datetime.now(timezone.utc)
-         maximum_from_now = current_time + timedelta(minutes=90)
-         when = datetime.strptime(departure['when'], "%Y-%m-%dT%H:%M:%S%z")
-         if current_time <= when <= maximum_from_now:
-            operator_name = departure['line']['operator']['name']
-            if operator_name not in name_list:
-               name_list.append(operator_name)
-            if len(name_list) == 5:
-               return name_list
+   return operators_from(stop_departures(stop_id))
+
+def operators_from(departures):
+   # up to five distinct operators departing in the next 90 minutes
+   name_list = []
+   current_time = datetime.now(timezone.utc)
+   maximum_from_now = current_time + timedelta(minutes=90)
+   for departure in departures:  
+      #print(departure)
+      when = departure_time(departure)
+      if when is not None and current_time <= when <= maximum_from_now:
+         operator_name = departure['line']['operator']['name']
+         if operator_name not in name_list:
+            name_list.append(operator_name)
+         if len(name_list) == 5:
+            return name_list
    return name_list
 
-def num_stops_id():
-   # 连接到SQLite数据库
-   conn = db_connection()
-   cursor = conn.cursor()
+# Optional background prefetching of departures for the most requested stops.
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "0") == "1"
+PREFETCH_TOP_N = int(os.environ.get("PREFETCH_TOP_N", 50))             # how many hot stops to keep warm
+PREFETCH_INTERVAL = float(os.environ.get("PREFETCH_INTERVAL", 30))     # seconds between refreshes of one stop
+PREFETCH_MAX_AGE = float(os.environ.get("PREFETCH_MAX_AGE", 300))      # older snapshots are not served
+PREFETCH_WORKERS = int(os.environ.get("PREFETCH_WORKERS", 4))
+PREFETCH_RATE = float(os.environ.get("PREFETCH_RATE", 2))              # upstream calls per second, all workers together
 
-   # 执行查询
-   query = "SELECT COUNT(DISTINCT stop_id) FROM stops"
-   cursor.execute(query)
+class TokenBucket:
+   # blocking rate limiter: acquire() returns once a token is available
+   def __init__(self, rate, burst=1):
+      self.rate = rate
+      self.burst = burst
+      self._tokens = burst
+      self._last = time.monotonic()
+      self._lock = threading.Lock()
 
-   # 获取查询结果
-   count = cursor.fetchone()[0]
-   
+   def acquire(self):
+      while True:
+         with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+               self._tokens -= 1
+               return
+            wait = (1 - self._tokens) / self.rate
+         time.sleep(wait)
+
+class DeparturesPrefetcher:
+   """Keeps precomputed departure answers for the most requested stops.
+
+   Request handlers call record() for every stop they serve. A scheduler
+   thread refreshes the PREFETCH_TOP_N most requested stops every
+   PREFETCH_INTERVAL seconds on a small worker pool, throttled by a global
+   token bucket, and stores the upcoming departures and operators so the
+   request path can answer without waiting on the upstream.
+   """
+
+   def __init__(self, top_n, interval, max_age, workers, rate):
+      self.top_n = top_n
+      self.interval = interval
+      self.max_age = max_age
+      self.workers = workers
+      self.bucket = TokenBucket(rate)
+      self.counts = Counter()
+      self.snapshots = {}
+      self.refreshes = 0
+      self.errors = 0
+      self._pending = set()
+      self._last_decay = time.time()
+      self._lock = threading.Lock()
+      self._thread = None
+      self._executor = None
+
+   def record(self, stop_id):
+      with self._lock:
+         self.counts[stop_id] += 1
+         if self._thread is None:
+            # started lazily so forked worker processes each get their own thread
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="prefetch")
+            self._thread = threading.Thread(target=self._run, name="prefetch-scheduler", daemon=True)
+            self._thread.start()
+
+   def lookup(self, stop_id):
+      # (snapshot, age in seconds) if a fresh enough snapshot exists, else None
+      snapshot = self.snapshots.get(stop_id)
+      if snapshot is None:
+         return None
+      age = time.time() - snapshot["fetched_at"]
+      return (snapshot, age) if age <= self.max_age else None
+
+   def _run(self):
+      while True:
+         now = time.time()
+         with self._lock:
+            hot = [stop_id for stop_id, _ in self.counts.most_common(self.top_n)]
+            if now - self._last_decay >= self.interval:
+               # halve the counts once per interval so the ranking follows recent traffic
+               for stop_id in list(self.counts):
+                  self.counts[stop_id] //= 2
+               self.counts += Counter()
+               self._last_decay = now
+            due = [stop_id for stop_id in hot if stop_id not in self._pending and
+                   now - self.snapshots.get(stop_id, {}).get("fetched_at", 0) >= self.interval]
+            self._pending.update(due)
+         for stop_id in due:
+            self._executor.submit(self.refresh, stop_id)
+         time.sleep(1.0)
+
+   def refresh(self, stop_id):
+      try:
+         self.bucket.acquire()
+         response = upstream.get(f'{TRANSPORT_REST_URL}/stops/{stop_id}/departures', endpoint="departures")
+         if response.status_code != 200:
+            return
+         payload = response.json()
+         departures_cache.put(stop_id, payload, len(response.content))
+         departures = departures_list(payload)
+         now = datetime.now(timezone.utc)
+         upcoming = []
+         for departure in departures:
+            when = departure_time(departure)
+            if departure['platform'] and departure['direction'] and when is not None and when >= now:
+               upcoming.append((when, f"Platform {departure['platform']} towards {departure['direction']}"))
+         self.snapshots[stop_id] = {
+            "fetched_at": time.time(),
+            "upcoming": sorted(upcoming)[:20],
+            "operators": operators_from(departures),
+         }
+         self.refreshes += 1
+      except Exception as e:
+         self.errors += 1
+         tracing.error("prefetch.departures", f"stop {stop_id}: {e}")
+      finally:
+         with self._lock:
+            self._pending.discard(stop_id)
+
+   def stats(self):
+      with self._lock:
+         return {"tracked": len(self.counts), "snapshots": len(self.snapshots),
+                 "refreshes": self.refreshes, "errors": self.errors}
+
+prefetcher = DeparturesPrefetcher(PREFETCH_TOP_N, PREFETCH_INTERVAL, PREFETCH_MAX_AGE, PREFETCH_WORKERS, PREFETCH_RATE)
+
+def staleness(snapshot, age):
+   return {
+      "source": "prefetch",
+      "fetched_at": datetime.fromtimestamp(snapshot["fetched_at"]).strftime('%Y-%m-%d-%H:%M:%S'),
+      "age_seconds": round(age, 1),
+   }
+
+def prefetched_next_departure(stop_id):
+   # (next_departure, staleness) from the prefetcher, or None when it has nothing fresh for stop_id
+   if not PREFETCH_ENABLED:
+      return None
+   prefetcher.record(stop_id)
+   found = prefetcher.lookup(stop_id)
+   if found is None:
+      return None
+   snapshot, age = found
+   current_time = datetime.now(timezone.utc)
+   maximum_from_now = current_time + timedelta(minutes=120)
+   for when, text in snapshot["upcoming"]:
+      if current_time <= when <= maximum_from_now:
+         return text, staleness(snapshot, age)
+   return None, staleness(snapshot, age)
+
+def prefetched_operators(stop_id):
+   # (operators, staleness) from the prefetcher, or None when it has nothing fresh for stop_id
+   if not PREFETCH_ENABLED:
+      return None
+   prefetcher.record(stop_id)
+   found = prefetcher.lookup(stop_id)
+   if found is None:
+      return None
+   snapshot, age = found
+   return snapshot["operators"], staleness(snapshot, age)
+
+# Random stop pairs for /guide. SAMPLER_RELOAD bounds how long writes made by other
+# processes stay invisible; SAMPLER_WEIGHT_REFRESH how stale popularity weights may get.
+SAMPLER_RELOAD = float(os.environ.get("SAMPLER_RELOAD", 300))
+SAMPLER_WEIGHT_REFRESH = float(os.environ.get("SAMPLER_WEIGHT_REFRESH", 10))
+SAMPLER_MAX_VIEWED = int(os.environ.get("SAMPLER_MAX_VIEWED", 100000))
+GUIDE_PAIR_MODES = ("uniform", "popular", "nearby")
+GUIDE_PAIR_RADIUS = 50000
+
+class StopSampler:
+   """Random stop ids without scanning or sorting the stops table.
+
+   The stop ids are kept in a sorted NumPy array, loaded on first use. The
+   write helpers report inserted and deleted ids, and these are merged in
+   before the next sample. A full reload every SAMPLER_RELOAD seconds picks up
+   writes made by other processes. A uniform pick is one random index. A
+   popularity-weighted pick is a binary search over cumulative weights: one
+   plus the number of GET /stops/<id> reads of each stop. The weights are
+   rebuilt when ids change, and otherwise at most every
+   SAMPLER_WEIGHT_REFRESH seconds. When more than max_viewed stops have
+   read counts, all counts are halved and the stops left at zero dropped,
+   so the counter stays bounded and recent reads weigh more.
+
+   `python benchmark.py sampler` measures this at 1M stops. A uniform or
+   weighted pair takes 10-20 us, against about 300 ms for the old
+   COUNT(DISTINCT) plus ORDER BY RANDOM() query. A reload takes about 0.6 s
+   and merging 1000 inserts takes about 10 ms.
+   """
+
+   def __init__(self, reload_interval, weight_refresh, max_viewed):
+      self.reload_interval = reload_interval
+      self.weight_refresh = weight_refresh
+      self.max_viewed = max_viewed
+      self._ids = None
+      self._loaded_at = 0.0
+      self._added = set()
+      self._removed = set()
+      self._views = Counter()
+      self._cumulative = None
+      self._weights_at = 0.0
+      self._rng = np.random.default_rng()
+      self._lock = threading.Lock()
+      self._reload_lock = threading.Lock()
+      # forked workers would otherwise all draw the same pairs
+      os.register_at_fork(after_in_child=self._reseed)
+
+   def _reseed(self):
+      self._rng = np.random.default_rng()
+
+   def added(self, stop_ids):
+      with self._lock:
+         if self._ids is not None:
+            self._added.update(stop_ids)
+            self._removed.difference_update(stop_ids)
+
+   def removed(self, stop_ids):
+      with self._lock:
+         if self._ids is not None:
+            self._removed.update(stop_ids)
+            self._added.difference_update(stop_ids)
+         for stop_id in stop_ids:
+            self._views.pop(stop_id, None)
+
+   def viewed(self, stop_id):
+      with self._lock:
+         self._views[stop_id] += 1
+         while len(self._views) > self.max_viewed:
+            self._views = Counter({key: views // 2 for key, views in self._views.items() if views > 1})
+            self._cumulative = None
+
+   def _stale(self):
+      # an empty or single-stop array is reloaded on every use, which is cheap while it stays that small
+      return (self._ids is None or len(self._ids) < 2
+              or time.monotonic() - self._loaded_at >= self.reload_interval)
+
+   def _reload(self):
+      with self._reload_lock:
+         if not self._stale():
+            return
+         with self._lock:
+            # writes committed while the table is read land in the fresh sets
+            self._added, self._removed = set(), set()
+            self._ids = self._ids if self._ids is not None else np.empty(0, dtype=np.int64)
+         with db_pool.connection() as cnx:
+            count = cnx.execute('SELECT COUNT(*) FROM stops').fetchone()[0]
+            ids = np.fromiter((row[0] for row in cnx.execute('SELECT stop_id FROM stops ORDER BY stop_id')),
+                              dtype=np.int64, count=count)
+         with self._lock:
+            self._ids = ids
+            self._cumulative = None
+            self._loaded_at = time.monotonic()
+
+   @staticmethod
+   def _positions(ids, values):
+      # where values are, or would be inserted, in the sorted ids, and which are present
+      values = np.fromiter(values, dtype=np.int64, count=len(values))
+      positions = np.searchsorted(ids, values)
+      present = ids[np.minimum(positions, len(ids) - 1)] == values if len(ids) else np.zeros(len(values), bool)
+      return values, positions, present
+
+   def _current(self):
+      # the id array with pending writes merged in; called with self._lock held.
+      # Each merge is a binary search per id plus one copy of the array.
+      if self._added:
+         added, positions, present = self._positions(self._ids, sorted(self._added))
+         self._ids = np.insert(self._ids, positions[~present], added[~present])
+         self._added.clear()
+         self._cumulative = None
+      if self._removed:
+         _, positions, present = self._positions(self._ids, self._removed)
+         self._ids = np.delete(self._ids, positions[present])
+         self._removed.clear()
+         self._cumulative = None
+      return self._ids
+
+   def size(self):
+      if self._stale():
+         self._reload()
+      with self._lock:
+         return len(self._current())
+
+   def pair(self, mode="uniform"):
+      # two distinct stop ids, or None when fewer than two stops are stored
+      if self.size() < 2:
+         return None
+      with self._lock:
+         ids = self._current()
+         if mode == "popular":
+            now = time.monotonic()
+            if self._cumulative is None or now - self._weights_at >= self.weight_refresh:
+               weights = np.ones(len(ids))
+               if self._views:
+                  _, positions, known = self._positions(ids, self._views.keys())
+                  weights[positions[known]] += np.fromiter(self._views.values(), dtype=float,
+                                                           count=len(self._views))[known]
+               self._cumulative = np.cumsum(weights)
+               self._weights_at = now
+            cumulative = self._cumulative
+            first = np.searchsorted(cumulative, self._rng.random() * cumulative[-1], side='right')
+            # the second draw skips the weight of the first stop instead of retrying
+            start = cumulative[first - 1] if first else 0.0
+            point = self._rng.random() * (cumulative[-1] - (cumulative[first] - start))
+            second = np.searchsorted(cumulative, point + (cumulative[first] - start) * (point >= start), side='right')
+         else:
+            first = self._rng.integers(len(ids))
+            second = self._rng.integers(len(ids) - 1)
+            second += second >= first
+         return int(ids[first]), int(ids[second])
+
+   def random(self):
+      return self._rng.random()
+
+   def stats(self):
+      with self._lock:
+         return {
+            "ids": None if self._ids is None else len(self._ids),
+            "pending_writes": len(self._added) + len(self._removed),
+            "viewed_stops": len(self._views),
+         }
+
+stop_sampler = StopSampler(SAMPLER_RELOAD, SAMPLER_WEIGHT_REFRESH, SAMPLER_MAX_VIEWED)
+
+def random_stop_near(source, radius):
+   # The stop closest to a uniformly random point of the disc of radius metres around
+   # the source row, if it lies inside the disc. The search around that point widens
+   # step by step, so in dense areas the R*Tree only visits a few candidates.
+   lat, lon = source[3], source[4]
+   distance = radius * np.sqrt(stop_sampler.random())
+   bearing = 2 * np.pi * stop_sampler.random()
+   target_lat = float(np.clip(lat + distance * np.cos(bearing) * DEGREES_PER_METRE, -90, 90))
+   target_lon = lon + distance * np.sin(bearing) * DEGREES_PER_METRE / max(np.cos(np.radians(lat)), 1e-6)
+   target_lon = float((target_lon + 180) % 360 - 180)
+   for search in (radius / 64, radius / 8, radius):
+      for row, _ in nearby_stops(target_lat, target_lon, search, 2):
+         if row[0] != source[0] and haversine(lat, lon, row[3], row[4]) <= radius:
+            return row[0]
+   return None
+
+def pair_args_valid(mode, radius):
+   return mode in GUIDE_PAIR_MODES and (radius is None or 0 < radius <= NEARBY_MAX_RADIUS)
+
+@tracing.traced("db.random_pair")
+def num_stops_id(mode="uniform", radius=None):
+   # Two distinct stored stop ids as (True, [source, destination]), or (False, None).
+   # mode is uniform, popular (weighted by GET /stops/<id> reads) or nearby (the
+   # destination is a random stop within radius metres of a uniform source,
+   # GUIDE_PAIR_RADIUS by default).
+   radius = radius or GUIDE_PAIR_RADIUS
+   for _ in range(5):
+      pair = stop_sampler.pair("popular" if mode == "popular" else "uniform")
+      if pair is None:
+         return False, None
+      if mode == "nearby":
+         source = db_read(pair[0])
+         if not source:
+            stop_sampler.removed([pair[0]])
+            continue
+         destination = random_stop_near(source[0], radius)
+         if destination is None:
+            continue
+         pair = (pair[0], destination)
+      stored = db_read_many(pair)
+      missing = [stop_id for stop_id in pair if stop_id not in stored]
+      if not missing:
+         return True, list(pair)
+      stop_sampler.removed(missing)
+   return False, None
+
+# Operator profiles are cached in the operator_profiles table for PROFILE_TTL seconds.
+# Only the PROFILE_CACHE_MAX_ENTRIES most recently used profiles are kept.
+PROFILE_TTL = float(os.environ.get("PROFILE_TTL", 7 * 24 * 3600))
+PROFILE_CACHE_MAX_ENTRIES = int(os.environ.get("PROFILE_CACHE_MAX_ENTRIES", 1000))
+# Profile generation fan-out: at most PROFILE_WORKERS model calls run at once, each
+# gets PROFILE_CALL_TIMEOUT seconds, and a request waits at most PROFILE_DEADLINE in total.
+PROFILE_WORKERS = int(os.environ.get("PROFILE_WORKERS", 8))
+PROFILE_CALL_TIMEOUT = float(os.environ.get("PROFILE_CALL_TIMEOUT", 15))
+PROFILE_DEADLINE = float(os.environ.get("PROFILE_DEADLINE", 20))
+# PROFILE_MODE=batched asks for up to PROFILE_BATCH_MAX uncached profiles in one model
+# call, see get_operator_profiles(); per-operator makes one call per profile. /metrics
+# reports calls, tokens and latency of both for comparison.
+PROFILE_MODE = os.environ.get("PROFILE_MODE", "per-operator")
+PROFILE_BATCH_MAX = int(os.environ.get("PROFILE_BATCH_MAX", 20))
+profile_executor = ThreadPoolExecutor(max_workers=PROFILE_WORKERS, thread_name_prefix="profile")
+
+@tracing.traced("db.profile_get")
+def profile_cache_get(operator):
+   # (information, created_at) for a cached profile, or None
+   with db_pool.connection() as cnx, cnx:
+      row = cnx.execute('SELECT information, created_at FROM operator_profiles WHERE operator_name = ?', (operator,)).fetchone()
+      if row is not None:
+         cnx.execute('UPDATE operator_profiles SET last_used = ? WHERE operator_name = ?', (time.time(), operator))
+   return row
+
+@tracing.traced("db.profile_put")
+def profile_cache_put(operator, information):
+   now = time.time()
+   with db_pool.connection() as cnx, cnx:
+      cnx.execute('''
+         INSERT INTO operator_profiles (operator_name, information, created_at, last_used) VALUES (?, ?, ?, ?)
+         ON CONFLICT(operator_name) DO UPDATE SET
+            information = excluded.information, created_at = excluded.created_at, last_used = excluded.last_used
+         ''', (operator, information, now, now))
+      # evict the least recently used profiles beyond the size limit
+      cnx.execute('''
+         DELETE FROM operator_profiles WHERE operator_name IN (
+            SELECT operator_name FROM operator_profiles ORDER BY last_used DESC LIMIT -1 OFFSET ?)
+         ''', (PROFILE_CACHE_MAX_ENTRIES,))
+
+def profile_prompt(operator):
+   return f"please tell me about {operator}. Only return the text without newline signal"
+
+def batch_profile_prompt(operators):
+   # the names go on a line of their own as a JSON list, so quotes in them cannot break the prompt
+   return ("please tell me about each of these operators:\n"
+           f"{json.dumps(operators, ensure_ascii=False)}\n"
+           "Only return a JSON object that maps every name, exactly as given, to the text about it "
+           "without newline signal")
+
+def parse_batch_profiles(text, operators):
+   # {operator: profile} for the operators the reply of batch_profile_prompt describes.
+   # Names are matched ignoring case and surrounding spaces; text around the JSON
+   # object (e.g. a markdown fence) is ignored. An unusable reply gives {}.
+   start, end = text.find('{'), text.rfind('}')
+   if start < 0 or end < start:
+      return {}
+   try:
+      data = json.loads(text[start:end + 1])
+   except ValueError:
+      return {}
+   if not isinstance(data, dict):
+      return {}
+   wanted = {operator.strip().casefold(): operator for operator in operators}
+   profiles = {}
+   for key, value in data.items():
+      operator = wanted.get(str(key).strip().casefold())
+      if operator is not None and isinstance(value, str) and value.strip():
+         profiles[operator] = value.replace('\n', '')
+   return profiles
+
+class ProfileUsage:
+   """Model calls, tokens and latency of operator profile generation.
+
+   Calls are counted by kind: "single" for profile_prompt and "batch" for
+   batch_profile_prompt. Token counts come from the usage metadata of the
+   response, when the client library reports it. Requests are counted by
+   PROFILE_MODE, so /metrics compares what each mode costs per profile and
+   how long a GET /operator-profiles/<id> waits for the model.
+   """
+
+   def __init__(self):
+      self._calls = {}
+      self._requests = {}
+      self._lock = threading.Lock()
+
+   def record_call(self, kind, seconds, response=None, profiles=0):
+      # response is None when the call failed
+      usage = getattr(response, "usage_metadata", None)
+      with self._lock:
+         entry = self._calls.get(kind)
+         if entry is None:
+            entry = self._calls[kind] = {"calls": 0, "failed": 0, "profiles": 0, "prompt_tokens": 0,
+                                         "output_tokens": 0, "calls_with_usage": 0, "latency": tracing.Histogram()}
+         entry["calls"] += 1
+         entry["failed"] += response is None
+         entry["profiles"] += profiles
+         if usage is not None:
+            entry["calls_with_usage"] += 1
+            entry["prompt_tokens"] += usage.prompt_token_count
+            entry["output_tokens"] += usage.candidates_token_count
+      entry["latency"].record(seconds)
+
+   def record_request(self, mode, seconds, generated):
+      # generated: profiles that were not served fresh from the cache
+      with self._lock:
+         entry = self._requests.get(mode)
+         if entry is None:
+            entry = self._requests[mode] = {"requests": 0, "generated": 0, "latency": tracing.Histogram()}
+         entry["requests"] += 1
+         entry["generated"] += generated
+      entry["latency"].record(seconds)
+
+   def stats(self):
+      with self._lock:
+         calls = {kind: dict(entry) for kind, entry in self._calls.items()}
+         requests = {mode: dict(entry) for mode, entry in self._requests.items()}
+      for entry in calls.values():
+         entry["latency"] = entry["latency"].summary()
+         if entry["calls_with_usage"] and entry["profiles"]:
+            tokens = entry["prompt_tokens"] + entry["output_tokens"]
+            entry["tokens_per_profile"] = round(tokens / entry["profiles"] * entry["calls"] / entry["calls_with_usage"], 1)
+      for entry in requests.values():
+         entry["latency"] = entry["latency"].summary()
+      return {"mode": PROFILE_MODE, "calls": calls, "requests": requests}
+
+profile_usage = ProfileUsage()
+
+def generate_operator_profile(operator):
+   start = time.perf_counter()
+   try:
+      with tracing.span("gemini.profile"):
+         response = gemini.generate_content(profile_prompt(operator), request_options={"timeout": PROFILE_CALL_TIMEOUT})
+         optinfo = response.text
+   except Exception:
+      profile_usage.record_call("single", time.perf_counter() - start)
+      raise
+   profile_usage.record_call("single", time.perf_counter() - start, response, 1)
+   return optinfo.replace('\n', '')
+
+def generate_operator_profiles_batched(operators):
+   # One model call for all operators; returns {operator: profile} for the names the
+   # reply describes, which may be fewer than asked for.
+   start = time.perf_counter()
+   try:
+      with tracing.span("gemini.profile_batch"):
+         response = gemini.generate_content(batch_profile_prompt(operators), request_options={"timeout": PROFILE_CALL_TIMEOUT})
+         profiles = parse_batch_profiles(response.text, operators)
+   except Exception:
+      profile_usage.record_call("batch", time.perf_counter() - start)
+      raise
+   profile_usage.record_call("batch", time.perf_counter() - start, response, len(profiles))
+   return profiles
+
+def get_operator_profile(operator):
+   # Serve a fresh cached profile, otherwise ask Gemini and cache the answer.
+   # If the model call fails, fall back to the cached text even when it has expired.
+   cached = profile_cache_get(operator)
+   if cached is not None and time.time() - cached[1] < PROFILE_TTL:
+      return cached[0]
+   try:
+      optinfo = generate_operator_profile(operator)
+   except Exception:
+      if cached is not None:
+         return cached[0]
+      raise
+   profile_cache_put(operator, optinfo)
+   return optinfo
+
+def _profiles_concurrently(operators, call_deadline):
+   # {operator: profile} for the get_operator_profile calls that finish before call_deadline
+   # (a time.monotonic() value), all running at once on profile_executor
+   # copy_context() so spans recorded on the pool threads land in the request's trace
+   futures = [(operator, profile_executor.submit(contextvars.copy_context().run, get_operator_profile, operator))
+              for operator in operators]
+   found = {}
+   for operator, future in futures:
+      try:
+         found[operator] = future.result(timeout=max(0, call_deadline - time.monotonic()))
+      except FutureTimeoutError:
+         future.cancel()
+      except Exception as e:
+         tracing.error("gemini.profile", f"{operator}: {e}")
+   return found
+
+def _profiles_batched(operators):
+   # {operator: profile} from batch_profile_prompt calls, PROFILE_BATCH_MAX names each,
+   # for the operators without a fresh cached profile; fresh ones come from the cache
+   found = {}
+   stale = []
+   for operator in operators:
+      cached = profile_cache_get(operator)
+      if cached is not None and time.time() - cached[1] < PROFILE_TTL:
+         found[operator] = cached[0]
+      else:
+         stale.append(operator)
+   batches = [stale[i:i + PROFILE_BATCH_MAX] for i in range(0, len(stale), PROFILE_BATCH_MAX)]
+   futures = [profile_executor.submit(contextvars.copy_context().run, generate_operator_profiles_batched, batch)
+              for batch in batches]
+   deadline = time.monotonic() + PROFILE_CALL_TIMEOUT
+   for batch, future in zip(batches, futures):
+      try:
+         generated = future.result(timeout=max(0, deadline - time.monotonic()))
+      except Exception as e:
+         future.cancel()
+         tracing.error("gemini.profile_batch", f"{len(batch)} operators: {e!r}")
+         continue
+      for operator, optinfo in generated.items():
+         profile_cache_put(operator, optinfo)
+      found.update(generated)
+   return found, len(stale)
+
+def get_operator_profiles(operators):
+   # Returns (profiles, missing): profiles keeps the order of operators and only holds
+   # the lookups that finished in time; missing lists the operators that timed out or failed.
+   # With PROFILE_MODE=per-operator every profile is looked up concurrently with
+   # get_operator_profile. With PROFILE_MODE=batched the profiles that are not cached
+   # are asked for in one prompt first, and only names the reply leaves out, or all of
+   # them if the call fails, fall back to get_operator_profile.
+   start = time.monotonic()
+   found = {}
+   generated = None
+   if PROFILE_MODE == "batched":
+      found, generated = _profiles_batched(operators)
+   rest = [operator for operator in operators if operator not in found]
+   if rest:
+      call_deadline = min(time.monotonic() + PROFILE_CALL_TIMEOUT, start + PROFILE_DEADLINE)
+      found.update(_profiles_concurrently(rest, call_deadline))
+   profile_usage.record_request(PROFILE_MODE, time.monotonic() - start, len(rest) if generated is None else generated)
+   profiles = [{"operator_name": operator, "information": found[operator]} for operator in operators if operator in found]
+   missing = [operator for operator in operators if operator not in found]
+   return profiles, missing
+
+def warm_operator_profiles():
+   # Precompute profiles for every operator currently departing from a known stop.
+   # Returns the number of profiles that had to be generated.
+   with db_pool.connection() as cnx:
+      stop_ids = [row[0] for row in cnx.execute('SELECT stop_id FROM stops ORDER BY stop_id')]
+   operators = []
+   for stop_id in stop_ids:
+      try:
+         departing = get_departing_info(stop_id)
+      except UpstreamUnavailable as e:
+         tracing.error("warm.departures", f"skipping stop {stop_id}: {e}")
+         continue
+      for operator in departing:
+         if operator not in operators:
+            operators.append(operator)
+   stale = []
+   for operator in operators:
+      cached = profile_cache_get(operator)
+      if cached is None or time.time() - cached[1] >= PROFILE_TTL:
+         stale.append(operator)
+   generated = 0
+   if PROFILE_MODE == "batched":
+      found, _ = _profiles_batched(stale)
+      generated += len(found)
+      stale = [operator for operator in stale if operator not in found]
+   for operator in stale:
+      try:
+         profile_cache_put(operator, generate_operator_profile(operator))
+         generated += 1
+      except Exception as e:
+         tracing.error("warm.profile", f"{operator}: {e}")
+   return generated
+
+# /guide runs as jobs on guide_executor. Each job writes its result to its own file in
+# GUIDE_DIR; finished guides are cached by (source, destination) for GUIDE_TTL seconds,
+# and jobs with their files are dropped GUIDE_JOB_RETENTION seconds after creation.
+GUIDE_DIR = Path(os.environ.get("GUIDE_DIR", f"{studentid}_guides")).absolute()
+GUIDE_TTL = float(os.environ.get("GUIDE_TTL", 7 * 24 * 3600))
+GUIDE_WORKERS = int(os.environ.get("GUIDE_WORKERS", 4))
+GUIDE_WAIT = float(os.environ.get("GUIDE_WAIT", 120))
+GUIDE_JOB_RETENTION = float(os.environ.get("GUIDE_JOB_RETENTION", 24 * 3600))
+guide_executor = ThreadPoolExecutor(max_workers=GUIDE_WORKERS, thread_name_prefix="guide")
+_guide_inflight = {}                    # (source, destination) -> (job_id, future)
+_guide_lock = threading.Lock()
+_guide_last_cleanup = 0.0
+
+@tracing.traced("db.guide_get")
+def guide_cache_get(source, destination):
+   # (information, created_at) for a cached guide, or None
+   with db_pool.connection() as cnx:
+      return cnx.execute('SELECT information, created_at FROM guides WHERE source = ? AND destination = ?',
+                         (source, destination)).fetchone()
+
+@tracing.traced("db.guide_put")
+def guide_cache_put(source, destination, information):
+   with db_pool.connection() as cnx, cnx:
+      cnx.execute('''
+         INSERT INTO guides (source, destination, information, created_at) VALUES (?, ?, ?, ?)
+         ON CONFLICT(source, destination) DO UPDATE SET
+            information = excluded.information, created_at = excluded.created_at
+         ''', (source, destination, information, time.time()))
+
+def guide_job_path(job_id):
+   return GUIDE_DIR / f"{job_id}.txt"
 
-   # 检查结果
-   if count >= 2:
-      query_random = "SELECT DISTINCT stop_id FROM stops ORDER BY RANDOM() LIMIT 2"
-      cursor.execute(query_random)
-      results = cursor.fetchall()
-      stop_ids = [item[0] for item in results]
-      conn.close()
-      return True, stop_ids
+@tracing.traced("db.guide_job_get")
+def guide_job_get(job_id):
+   # the guide_jobs row of job_id as a dict, or None
+   with db_pool.connection() as cnx:
+      cursor = cnx.execute('SELECT * FROM guide_jobs WHERE job_id = ?', (job_id,))
+      row = cursor.fetchone()
+      if row is None:
+         return None
+      return dict(zip([column[0] for column in cursor.description], row))
+
+def _guide_job_finish(job_id, status, error=None):
+   with db_pool.connection() as cnx, cnx:
+      cnx.execute('UPDATE guide_jobs SET status = ?, error = ?, finished_at = ? WHERE job_id = ?',
+                  (status, error, time.time(), job_id))
+
+def _write_guide(job_id, information):
+   # write then rename, so a reader never streams a half-written result
+   GUIDE_DIR.mkdir(exist_ok=True)
+   path = guide_job_path(job_id)
+   partial = path.with_suffix('.part')
+   with open(partial, 'w') as f:
+      print(information, file = f)
+   partial.replace(path)
+
+def generate_guide(source_name, destination_name):
+   with tracing.span("gemini.guide"):
+      info = gemini.generate_content(guide_prompt(source_name, destination_name)).text
+   return info.replace('\n', '')
+
+def _run_guide_job(job_id, source_name, destination_name):
+   try:
+      with db_pool.connection() as cnx, cnx:
+         cnx.execute("UPDATE guide_jobs SET status = 'running' WHERE job_id = ?", (job_id,))
+      info = generate_guide(source_name, destination_name)
+      guide_cache_put(source_name, destination_name, info)
+      _write_guide(job_id, info)
+      _guide_job_finish(job_id, 'done')
+   except Exception as e:
+      tracing.error("guide.job", f"{job_id}: {e}", exc_info=True)
+      _guide_job_finish(job_id, 'failed', str(e))
+      raise
+   finally:
+      with _guide_lock:
+         _guide_inflight.pop((source_name, destination_name), None)
+
+def _cleanup_guide_jobs():
+   # drop expired jobs and their files, at most once a minute
+   global _guide_last_cleanup
+   now = time.time()
+   if now - _guide_last_cleanup < 60:
+      return
+   _guide_last_cleanup = now
+   with db_pool.connection() as cnx, cnx:
+      expired = [row[0] for row in cnx.execute('SELECT job_id FROM guide_jobs WHERE created_at < ?',
+                                               (now - GUIDE_JOB_RETENTION,))]
+      cnx.execute('DELETE FROM guide_jobs WHERE created_at < ?', (now - GUIDE_JOB_RETENTION,))
+   for job_id in expired:
+      guide_job_path(job_id).unlink(missing_ok=True)
+
+def submit_guide_job(source_id=None, destination_id=None, mode="uniform", radius=None):
+   # Create a /guide job for the given stops, or for a random pair drawn by num_stops_id
+   # (mode, radius) when both are None.
+   # Returns (job, future). future is None when the job is done already (a cached
+   # pair), and a pair that is being generated returns the job doing it. Returns
+   # (None, None) when there are fewer than two stops or an id is unknown.
+   _cleanup_guide_jobs()
+   if source_id is None:
+      valid, stop_ids = num_stops_id(mode, radius)
+      if not valid:
+         return None, None
+      source_id, destination_id = stop_ids
+   stored = db_read_many([source_id, destination_id])
+   if source_id not in stored or destination_id not in stored:
+      return None, None
+   pair = (stored[source_id][2], stored[destination_id][2])
+
+   with _guide_lock:
+      inflight = _guide_inflight.get(pair)
+      if inflight is not None and not inflight[1].done():
+         return guide_job_get(inflight[0]), inflight[1]
+      if inflight is not None:
+         # a job cancelled while queued never ran _run_guide_job to clean up after it
+         del _guide_inflight[pair]
+         if inflight[1].cancelled():
+            _guide_job_finish(inflight[0], 'failed', 'cancelled')
+      job_id = uuid.uuid4().hex
+      cached = guide_cache_get(*pair)
+      fresh = cached is not None and time.time() - cached[1] < GUIDE_TTL
+      now = time.time()
+      with db_pool.connection() as cnx, cnx:
+         cnx.execute('INSERT INTO guide_jobs VALUES (?, ?, ?, ?, ?, ?, NULL, ?, ?)',
+                     (job_id, source_id, destination_id, pair[0], pair[1],
+                      'done' if fresh else 'queued', now, now if fresh else None))
+      if fresh:
+         _write_guide(job_id, cached[0])
+         future = None
+      else:
+         future = guide_executor.submit(contextvars.copy_context().run, _run_guide_job, job_id, *pair)
+         _guide_inflight[pair] = (job_id, future)
+   return guide_job_get(job_id), future
+
+def sse(event, data):
+   # one Server-Sent Events message; data is JSON so it never spans lines
+   return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def stream_model(prompt, span, **kwargs):
+   # Text chunks of a streamed Gemini answer, newlines stripped chunk by chunk. The
+   # spans are recorded by hand: the body is sent after the request's trace has ended.
+   start = time.perf_counter()
+   first = True
+   try:
+      for chunk in gemini.generate_content(prompt, stream=True, **kwargs):
+         if first:
+            tracing.record_span(f"{span}.first_chunk", time.perf_counter() - start)
+            first = False
+         text = chunk.text.replace('\n', '')
+         if text:
+            yield text
+   finally:
+      tracing.record_span(span, time.perf_counter() - start)
+
+def _stream_operator_profile(operator, cached, events):
+   # runs on profile_executor; puts chunk events, then one profile or error event
+   parts = []
+   try:
+      for text in stream_model(profile_prompt(operator), "gemini.profile_stream",
+                               request_options={"timeout": PROFILE_CALL_TIMEOUT}):
+         parts.append(text)
+         events.put(("chunk", {"operator_name": operator, "text": text}))
+   except Exception as e:
+      if cached is not None:
+         # as get_operator_profile: an expired profile beats none
+         events.put(("profile", {"operator_name": operator, "information": cached[0]}))
+      else:
+         events.put(("error", {"operator_name": operator, "message": str(e)}))
+      return
+   information = ''.join(parts)
+   profile_cache_put(operator, information)
+   events.put(("profile", {"operator_name": operator, "information": information}))
+
+def stream_operator_profiles(stop_id, operators):
+   # Streaming counterpart of get_operator_profiles: yields (event, data) pairs.
+   # Fresh cached profiles come first as profile events; the others are generated
+   # concurrently and their chunk events interleave. A final done event lists the
+   # operators that failed or missed PROFILE_DEADLINE.
+   events = queue.Queue()
+   pending = set()
+   for operator in operators:
+      cached = profile_cache_get(operator)
+      if cached is not None and time.time() - cached[1] < PROFILE_TTL:
+         yield "profile", {"operator_name": operator, "information": cached[0]}
+      else:
+         pending.add(operator)
+         profile_executor.submit(_stream_operator_profile, operator, cached, events)
+   deadline = time.monotonic() + PROFILE_DEADLINE
+   missing = []
+   while pending:
+      try:
+         event, data = events.get(timeout=max(0, deadline - time.monotonic()))
+      except queue.Empty:
+         break
+      if event != "chunk":
+         pending.discard(data["operator_name"])
+      if event == "error":
+         missing.append(data["operator_name"])
+      yield event, data
+   missing += [operator for operator in operators if operator in pending]
+   yield "done", {"stop_id": stop_id, "missing_operators": missing}
+
+def stream_guide(source_name, destination_name):
+   # Streaming counterpart of a /guide job: yields (event, data) pairs and caches the
+   # whole guide once the model has finished. A cached pair is sent as one chunk.
+   cached = guide_cache_get(source_name, destination_name)
+   if cached is not None and time.time() - cached[1] < GUIDE_TTL:
+      yield "chunk", {"text": cached[0]}
    else:
-      conn.close()
-      return False, None
+      parts = []
+      try:
+         for text in stream_model(guide_prompt(source_name, destination_name), "gemini.guide_stream"):
+            parts.append(text)
+            yield "chunk", {"text": text}
+      except Exception as e:
+         tracing.error("gemini.guide_stream", e)
+         yield "error", {"message": "Service Unavailable"}
+         return
+      guide_cache_put(source_name, destination_name, ''.join(parts))
+   yield "done", {"source": source_name, "destination": destination_name}
 
-   
+def random_guide_pair(mode="uniform", radius=None):
+   # (source name, destination name) of two random stops, or None
+   valid, stop_ids = num_stops_id(mode, radius)
+   if not valid:
+      return None
+   stored = db_read_many(stop_ids)
+   return stored[stop_ids[0]][2], stored[stop_ids[1]][2]
+
+def guide_job_document(job, host):
+   data = {
+      "job_id": job["job_id"],
+      "status": job["status"],
+      "source": {"stop_id": job["source_id"], "name": job["source"]},
+      "destination": {"stop_id": job["destination_id"], "name": job["destination"]},
+      "created_at": datetime.fromtimestamp(job["created_at"]).strftime('%Y-%m-%d-%H:%M:%S'),
+      "_links": {"self": {"href": f"http://{host}/guide/jobs/{job['job_id']}"}},
+   }
+   if job["status"] == 'done':
+      data["_links"]["result"] = {"href": f"http://{host}/guide/jobs/{job['job_id']}/result"}
+   if job["status"] == 'failed':
+      data["message"] = job["error"]
+   return data
+
+def guide_prompt(source_name, destination_name):
+   return f"I need a tourist explore guidence. I will tell you source place and destination place. The guidence should includes substantial information about at least one point of interest at the source. The guidence should also includes substantial information about at least one point of interest at the destination and includes other substantial information to enhance a tourist's experience using the guide.Please tell me the tour plan and POI details. The source is {source_name}, destination pa is {destination_name}"
 
 @api.route('/stops')
 class StopsList(Resource):
+   @api.response(200, "Ok")
+   @api.response(400, "Invalid field in request")
+   @api.doc(description = "List stored stops, ordered by stop_id. Page with the after/before cursors from the "
+                          "next/prev links; include selects fields as for a single stop (next_departure is not listed).")
+   @api.expect(parser_list, validate = True)
+   def get(self):
+      args = parser_list.parse_args()
+      if not 1 <= args["limit"] <= STOPS_PAGE_MAX or (args["after"] is not None and args["before"] is not None):
+         return {"message": "Invalid field in request"}, 400
+      fields = args["include"].split(',') if args["include"] else None
+      return stops_page(args["after"], args["before"], args["limit"], args["name"], fields, request.host), 200
+
    @api.response(200, "Ok")
    @api.response(201, "Created")
    @api.response(400, "Invalid field in request")
@@ -287,9 +2638,19 @@ class StopsList(Resource):
    @api.expect(parser_query, validate = True)
    def put(self):
       
-      query = parser_query.parse_args().get("query")
-      url = f'https://v6.db.transport.rest/locations?query={query}&results=5'
-      response = requests.get(url)      
+      args = parser_query.parse_args()
+      query = args.get("query")
+      if args["max_age"] is not None:
+         if not max_age_valid(args["max_age"]):
+            return {"message": "Invalid field in request"}, 400
+         local = local_locations(query, args["max_age"], request.host)
+         if local is not None:
+            return local, 200
+      url = f'{TRANSPORT_REST_URL}/locations'
+      try:
+         response = upstream.get(url, endpoint="locations", params={"query": query, "results": 5})
+      except UpstreamUnavailable:
+         return {"message": "Service Unavailable."}, 503
       code = response.status_code
       if code == 400:
          return {"message": "Invalid field in request"}, 400
@@ -299,7 +2660,7 @@ class StopsList(Resource):
          return {"message": "Service Unavailable."}, 503
       
       put_list = []
-      
+      rows = []
         
       for item in response.json():
          put_dict = {}
@@ -314,20 +2675,48 @@ class StopsList(Resource):
          # put_dict["longitude"] = item["location"]["longitude"]
          href = f"http://{request.host}/stops/{stop_id}"
          put_dict["_links"] = {"self" : {"href": href}}
-         # read => len(res) => >0 => yes => update
-         # no => insert
-         data = db_read(stop_id)
-         print(data)
-         if len(data) == 0:
-            db_insert(stop_id, put_dict["last_updated"], name, item["location"]["latitude"],  item["location"]["longitude"])
-         else:
-            db_update(stop_id, put_dict["last_updated"], name, item["location"]["latitude"], item["location"]["longitude"])
+         rows.append((int(stop_id), put_dict["last_updated"], name, item["location"]["latitude"], item["location"]["longitude"]))
          put_list.append(put_dict)
          
+      # insert new stops and update existing ones in a single transaction
+      db_upsert_many(rows)
 
       put_list = sorted(put_list, key = lambda x: x['stop_id'])
 
       return {"message": put_list}, 200
+
+   @api.response(200, "Ok")
+   @api.response(400, "Invalid field in request")
+   @api.doc(description = "Update many stops at once. Every item is validated as for PATCH /stops/<id>; "
+                          "if any fails, nothing is written and the failing items are listed.")
+   @api.expect([bulk_patch_model], validate=True)
+   def patch(self):
+      return bulk_patch(request.json, request.host)
+@api.route('/stops/search')
+class StopsSearch(Resource):
+   @api.response(200, "Ok")
+   @api.response(400, "Invalid field in request")
+   @api.doc(description = "Stored stops whose names match q. Names with a word starting with every word of q "
+                          "come first (match=prefix), then names close to q despite typos (match=fuzzy).")
+   @api.expect(parser_search, validate = True)
+   def get(self):
+      args = parser_search.parse_args()
+      if not 1 <= args["limit"] <= SEARCH_MAX_LIMIT:
+         return {"message": "Invalid field in request"}, 400
+      return search_document(args["q"], args["limit"], request.host), 200
+
+@api.route('/stops/nearby')
+class StopsNearby(Resource):
+   @api.response(200, "Ok")
+   @api.response(400, "Invalid field in request")
+   @api.doc(description = "The k stored stops nearest to lat/lon within radius metres, nearest first")
+   @api.expect(parser_nearby, validate = True)
+   def get(self):
+      args = parser_nearby.parse_args()
+      if not nearby_args_valid(args["lat"], args["lon"], args["radius"], args["k"]):
+         return {"message": "Invalid field in request"}, 400
+      return nearby_document(args["lat"], args["lon"], args["radius"], args["k"], request.host), 200
+
 @api.route('/stops/<int:stop_id>')
 class stops(Resource):
    @api.response(200, "Ok")
@@ -337,42 +2726,41 @@ class stops(Resource):
    @api.doc(description = "Retrieve a stop")
    @api.expect(parser_query2, validate = True)
    def get(self, stop_id):
-      details = db_read(stop_id)
-      print(details)
-      if len(details) == 0:
-         return {"message": "Not found."}, 404
-      details = details[0]
-      prev_stop_id, next_stop_id = get_prev_and_next_stop(stop_id)
-      data = {
-         'stop_id': stop_id,
-         '_links': {
-               'self': {"href": f'http://{request.host}/stops/{stop_id}'}
-         }
-      }  
-      if next_stop_id:
-         data['_links']['next'] = {"href": f'http://{request.host}/stops/{next_stop_id[0]}'}
-      if prev_stop_id:
-         data['_links']['prev'] = {"href": f'http://{request.host}/stops/{prev_stop_id[0]}'}
-
       fields = parser_query2.parse_args().get("include")
       
       if fields:
          fields = fields.split(',')
-      if not fields or 'name' in fields:
-         data['name'] = details[2]
-      # Add latitude and longitude here similarly
-      if not fields or 'last_updated' in fields:
-         data['last_updated'] = details[1]
-      if not fields or 'latitude' in fields:
-         data['latitude'] = details[3]
-      # Add latitude and longitude here similarly
-      if not fields or 'longitude' in fields:
-         data['longitude'] = details[4] 
+      found = cached_stop(stop_id, fields, request.host)
+      if found is None:
+         return {"message": "Not found."}, 404
+      details, prev_stop_id, next_stop_id, data, modified_at = found
+      next_departure = staleness = None
       if not fields or 'next_departure' in fields:
-         data['next_departure'] = get_next_departure(stop_id)
-         if not data['next_departure']:
+         prefetched = prefetched_next_departure(stop_id)
+         if prefetched is not None:
+            next_departure, staleness = prefetched
+         else:
+            try:
+               next_departure = get_next_departure(stop_id)
+            except UpstreamUnavailable:
+               return {"message": "Service Unavailable."}, 503
+         if not next_departure:
             return {"message": "next_departure Not found."}, 404
-      return data, 200
+         modified = None
+      else:
+         modified = last_modified(modified_at)
+      headers = {"ETag": stop_etag(details, prev_stop_id, next_stop_id, fields, request.host, next_departure)}
+      if modified:
+         headers["Last-Modified"] = modified
+      if not_modified(headers["ETag"], modified, request.headers.get("If-None-Match"),
+                      request.headers.get("If-Modified-Since")):
+         return Response(status=304, headers=headers)
+
+      if next_departure:
+         data['next_departure'] = next_departure
+         if staleness is not None:
+            data['_staleness'] = staleness
+      return data, 200, headers
    @api.response(200, "OK")
    @api.response(400, "Invalid field in request")
    @api.response(404, "Not found")
@@ -387,7 +2775,8 @@ class stops(Resource):
    @api.response(200, "Ok")
    @api.response(400, "Invalid field in request")
    @api.response(404, "Not found")
-   @api.doc(description = "Update a stop")
+   @api.response(412, "Precondition Failed")
+   @api.doc(description = "Update a stop. Send the ETag of a previous GET in If-Match to only update an unchanged stop.")
    @api.expect(indicator_model, validate=True)
    def patch(self, stop_id):
      
@@ -401,18 +2790,18 @@ class stops(Resource):
       
      if 'stop_id' in updates or '_links' in updates:
         return {"message": "Invalid field in request"}, 400
-     if 'name' not in updates:
-         updates['name'] = details[2]
-     if 'last_updated' not in updates:
-         updates['last_updated'] = datetime.now().strftime('%Y-%m-%d-%H:%M:%S')
-     if 'latitude' not in updates:
-         updates['latitude'] = details[3] 
-     if 'longitude' not in updates:
-         updates['longitude'] = details[4] 
-
-     valid, message = validate_input(updates) 
+     precondition = request.headers.get("If-Match")
+     if not if_match(precondition, details):
+        return {"message": "Precondition Failed"}, 412
+     valid, message = merge_updates(details, updates)
      if valid:
-        db_update(stop_id, updates['last_updated'], updates['name'], updates['latitude'], updates['longitude'])
+        row = (updates['last_updated'], updates['name'], updates['latitude'], updates['longitude'])
+        if precondition:
+           # the row may have changed since it was read above
+           if not db_update_if_unchanged(details, *row):
+              return {"message": "Precondition Failed"}, 412
+        else:
+           db_update(stop_id, *row)
         return {
                "stop_id": stop_id,
                "last_updated": updates.get('last_updated', datetime.now().strftime('%Y-%m-%d-%H:%M:%S')),
@@ -421,7 +2810,7 @@ class stops(Resource):
                      "href": f"http://{request.host}/stops/{stop_id}"
                   }
                }
-         }, 200
+         }, 200, {"ETag": patched_etag(stop_id, row, request.host)}
      else:
         return {"message": message}, 400                
 
@@ -431,72 +2820,175 @@ class OperatorProfiles(Resource):
     @api.response(400, "Bad Request")
     @api.response(404, "Not found")
     @api.response(503, "Service Unavailable")
-    @api.doc(description = "Retrieve operator profiles ")
+    @api.doc(description = "Retrieve operator profiles. With stream=true the profiles arrive as Server-Sent "
+                           "Events: chunk events while they are generated, a profile event per operator, then done.")
+    @api.expect(parser_stream, validate = True)
     def get(self, stop_id):
      details = db_read(stop_id)
      if len(details) == 0:
         return {"message": "Not found."}, 404
      details = details[0]
-     name = get_departing_info(stop_id)  
+     prefetched = prefetched_operators(stop_id)
+     if prefetched is not None:
+        name = prefetched[0]
+     else:
+        try:
+           name = get_departing_info(stop_id)
+        except UpstreamUnavailable:
+           return {"message": "Service Unavailable."}, 503
      print(name)
      if len(name) == 0:
         return {"message": "Not found."}, 404
+     if parser_stream.parse_args()["stream"]:
+        events = stream_operator_profiles(stop_id, name)
+        return Response((sse(event, data) for event, data in events), mimetype='text/event-stream', headers=SSE_HEADERS)
       
-     profiles = []
-     for operator in name:  # 取前5个或全部，哪个少取哪个
-        optinfo = gemini.generate_content(f"please tell me about {operator}. Only return the text without newline signal").text
-        optinfo = optinfo.replace('\n', '')
-        profiles.append({
-               "operator_name": operator,
-               "information": optinfo
-         })
-      
-     return {
+     # 取前5个或全部，哪个少取哪个
+     profiles, missing = get_operator_profiles(name)
+     if len(profiles) == 0:
+        return {"message": "Service Unavailable."}, 503
+     result = {
          "stop_id": stop_id,
          "profiles": profiles
-      }, 200
+      }
+     if missing:
+        # partial result: some model calls timed out or failed
+        result["missing_operators"] = missing
+     return result, 200
 
 @api.route('/guide')
 class TourismGuide(Resource):
     @api.response(200, "OK")
     @api.response(400, "Bad Request")
     @api.response(503, "Service Unavailable")
-    @api.doc(description = "Create a tourism guide")
+    @api.doc(description = "Create a tourism guide and wait for it. POST /guide does not wait; with "
+                           "stream=true the guide arrives as Server-Sent Events while it is generated.")
+    @api.expect(parser_guide_get, validate = True)
     def get(self):
-     
-      # 检查数据库中是否有足够的停靠站
-     vaild, stop_ids = num_stops_id()
-     if not vaild:
+     args = parser_guide_get.parse_args()
+     if not pair_args_valid(args["pair"], args["radius"]):
         return {"message": "Bad Request"}, 400
-   #   print(stop_ids)
-   
-     source_stop_id = stop_ids[0]
-     destination_stop_id = stop_ids[1]
-     
-     data_source = db_read(source_stop_id) 
-     data_source = data_source[0]
-     data_destination = db_read(destination_stop_id) 
-     data_destination = data_destination[0]
-     data_source_name = data_source[2]
-     data_destination_name = data_destination[2]
-   #   print(data_source_name)  
-   #   print(data_destination_name)
-     info = gemini.generate_content(f"I need a tourist explore guidence. I will tell you source place and destination place. The guidence should includes substantial information about at least one point of interest at the source. The guidence should also includes substantial information about at least one point of interest at the destination and includes other substantial information to enhance a tourist's experience using the guide.Please tell me the tour plan and POI details. The source is {data_source_name}, destination pa is {data_destination_name}").text
-     info = info.replace('\n', '')
-     print(info)
-
-        # 创建 TXT 文件并返回
-     with open(txt_file, 'w') as f:
-         print(info, file = f)
-        
-     return send_file(txt_file, as_attachment=True, attachment_filename=txt_file),200
+     if args["stream"]:
+        pair = random_guide_pair(args["pair"], args["radius"])
+        if pair is None:
+           return {"message": "Bad Request"}, 400
+        return Response((sse(event, data) for event, data in stream_guide(*pair)),
+                        mimetype='text/event-stream', headers=SSE_HEADERS)
+     job, future = submit_guide_job(mode=args["pair"], radius=args["radius"])
+     if job is None:
+        return {"message": "Bad Request"}, 400
+     if future is not None:
+        try:
+           future.result(timeout=GUIDE_WAIT)
+        except Exception:
+           return {"message": "Service Unavailable"}, 503
+     return guide_result(job["job_id"])
+
+    @api.response(200, "OK, the guide is cached and the job is done")
+    @api.response(202, "Accepted, poll the job")
+    @api.response(400, "Bad Request")
+    @api.doc(description = "Start a tourism guide job for two stops, or for a random pair when none are given")
+    @api.expect(parser_guide, validate = True)
+    def post(self):
+     args = parser_guide.parse_args()
+     if (args["source"] is None) != (args["destination"] is None):
+        return {"message": "Bad Request"}, 400
+     if not pair_args_valid(args["pair"], args["radius"]):
+        return {"message": "Bad Request"}, 400
+     job, future = submit_guide_job(args["source"], args["destination"], args["pair"], args["radius"])
+     if job is None:
+        return {"message": "Bad Request"}, 400
+     data = guide_job_document(job, request.host)
+     return data, 200 if job["status"] == 'done' else 202, {"Location": data["_links"]["self"]["href"]}
+
+def guide_result(job_id):
+   # the result file of a finished job, streamed from disk
+   return send_file(guide_job_path(job_id), mimetype='text/plain', as_attachment=True, download_name=txt_file)
+
+@api.route('/guide/jobs/<string:job_id>')
+class TourismGuideJob(Resource):
+    @api.response(200, "OK")
+    @api.response(404, "Not found")
+    @api.doc(description = "Status of a tourism guide job")
+    def get(self, job_id):
+     job = guide_job_get(job_id)
+     if job is None:
+        return {"message": "Not found."}, 404
+     return guide_job_document(job, request.host), 200
+
+@api.route('/guide/jobs/<string:job_id>/result')
+class TourismGuideResult(Resource):
+    @api.response(200, "OK")
+    @api.response(202, "Accepted, the job is still running")
+    @api.response(404, "Not found")
+    @api.response(503, "Service Unavailable")
+    @api.doc(description = "Download the guide of a finished job")
+    def get(self, job_id):
+     job = guide_job_get(job_id)
+     if job is None:
+        return {"message": "Not found."}, 404
+     if job["status"] == 'failed':
+        return {"message": "Service Unavailable"}, 503
+     if job["status"] != 'done':
+        return guide_job_document(job, request.host), 202
+     return guide_result(job_id)
+
+def service_metrics():
+   # body of GET /metrics, shared with async_server.py
+   return {
+      # metrics are per process: each worker of prefork.py answers with its own
+      "pid": os.getpid(),
+      **tracing.metrics(),
+      "upstream": upstream.metrics(),
+      "caches": {
+         "departures": departures_cache.stats(),
+         "stop_documents": stop_cache.stats(),
+      },
+      "prefetcher": prefetcher.stats(),
+      "operator_profiles": profile_usage.stats(),
+   }
+
+@api.route('/metrics')
+class Metrics(Resource):
+   @api.response(200, "OK")
+   @api.doc(description = "Per-route and per-span latency percentiles, error counts, upstream and cache statistics")
+   def get(self):
+      return service_metrics(), 200
+
+@api.route('/metrics/profile')
+class Profile(Resource):
+   @api.response(200, "OK")
+   @api.doc(description = "Folded stacks collected by the sampling profiler (flamegraph.pl / speedscope input)")
+   def get(self):
+      return Response(tracing.profiler.folded(), mimetype='text/plain', headers={
+         "X-Profiler-Running": str(tracing.profiler.running).lower(),
+         "X-Profiler-Samples": str(tracing.profiler.samples),
+      })
+
+   @api.response(200, "OK")
+   @api.doc(description = "Start or stop the sampling profiler; starting clears earlier samples")
+   @api.expect(parser_profiler, validate = True)
+   def put(self):
+      if parser_profiler.parse_args()["enabled"]:
+         if not tracing.profiler.running:
+            tracing.profiler.clear()
+         tracing.profiler.start()
+      else:
+         tracing.profiler.stop()
+      return {"running": tracing.profiler.running, "samples": tracing.profiler.samples}, 200
 
 if __name__ == "__main__":
-    # Here's a quick example of using the Generative AI API:
-   app.run(debug=True)
+   cli = argparse.ArgumentParser()
+   cli.add_argument("command", nargs="?", choices=["serve", "warm-profiles"], default="serve")
+   command = cli.parse_args().command
+   if command == "warm-profiles":
+      print(f"generated {warm_operator_profiles()} operator profiles")
+   else:
+      # development server; prefork.py runs the service with several worker processes
+      # Here's a quick example of using the Generative AI API:
+      app.run(debug=True)
    
-   question = "Give me some facts about UNSW!"
-   response = gemini.generate_content(question)
-   print(question)
-   print(response.text)
-
+      question = "Give me some facts about UNSW!"
+      response = gemini.generate_content(question)
+      print(question)
+      print(response.text)